@@ -6,11 +6,98 @@ import csv
 from openem.models import ImageModel
 from openem.models import Preprocessor
 from openem.image import crop
+from openem.Detect import detectionBoxes
+from openem.columnar import FrameTable, readColumns
 
 from collections import namedtuple
 Classification=namedtuple('Classification', ['species', 'cover', 'frame', 'video_id'])
 
+class ClassificationBatch(FrameTable):
+    """ Classifications of many frames as a struct of arrays, see
+        openem.columnar.
+
+        Indexing by frame number gives a view behaving as the list of
+        Classification of that frame; Classification tuples are only
+        built for the rows accessed. The columns are contiguous arrays:
+        species (N,S), cover (N,3), frames (N,) and video_id (N,).
+    """
+    columns = ('species', 'cover', 'video_id')
+
+    def __init__(self, species, cover, frame, video_id, frame_count=None,
+                 first_frame=0):
+        """ Create a batch from per-row arrays, in any frame order
+
+        frame_count: number of frames; defaults to up to the last frame
+                     with a classification
+        first_frame: frame number of the first frame
+        """
+        order = self._order(frame)
+        self.species = np.ascontiguousarray(species[order])
+        self.cover = np.ascontiguousarray(cover[order])
+        self.video_id = video_id[order]
+        super(ClassificationBatch, self).__init__(frame[order],
+                                                  frame_count,
+                                                  first_frame)
+
+    @classmethod
+    def fromClassifications(cls, classifications, first_frame=0,
+                            video_id=None):
+        """ Create a batch from a list of lists of Classification, one list
+            per frame starting at `first_frame`. Rows without a video_id
+            get `video_id`. """
+        rows, frames = cls._flatten(classifications, first_frame)
+        return cls(np.array([row.species for row in rows], dtype=np.float64),
+                   np.array([row.cover for row in rows], dtype=np.float64),
+                   frames,
+                   np.array([video_id if row.video_id is None
+                             else row.video_id for row in rows],
+                            dtype=object),
+                   len(classifications),
+                   first_frame)
+
+    def withSpecies(self, species, threshold=0.0):
+        """ Returns the classifications whose most likely species is
+            `species` (index into the species scores), with a score of at
+            least `threshold` """
+        scores = self.species[self._rows()]
+        best = np.argmax(scores, axis=1)
+        return self.select((best == species) & (np.max(scores, axis=1)
+                                                >= threshold))
+
+    def _record(self, row):
+        return Classification(species=self.species[row].tolist(),
+                              cover=self.cover[row].tolist(),
+                              frame=int(self.frames[row]),
+                              video_id=self.video_id[row])
+
+    def _pandasColumns(self, rows):
+        columns = {'frame': self.frames[rows],
+                   'video_id': self.video_id[rows]}
+        for idx in range(self.species.shape[1]):
+            columns[f'species_{idx}'] = self.species[rows,idx]
+        for idx in range(self.cover.shape[1]):
+            columns[f'cover_{idx}'] = self.cover[rows,idx]
+        return columns
+
 class IO:
+    def load(filepath_like):
+        """ Load a classification CSV (or Parquet) file into a
+            ClassificationBatch. Much faster than from_csv for long
+            videos and accepted wherever its list of lists is. """
+        # frame, video_id, one column per species, then 3 cover columns
+        names, columns = readColumns(filepath_like, str_columns=[1])
+        species_names = names[2:-3]
+        cover_names = names[-3:]
+        species = np.stack([columns[name] for name in species_names],
+                           axis=1).astype(np.float64)
+        cover = np.stack([columns[name] for name in cover_names],
+                         axis=1).astype(np.float64)
+        return ClassificationBatch(
+            species,
+            cover,
+            columns[names[0]].astype(np.float64).astype(np.int64),
+            columns[names[1]].astype(str).astype(object))
+
     def from_csv(filepath_like):
         classifications=[]
         with open(filepath_like, 'r') as csv_file:
@@ -62,6 +149,9 @@ class Classifier(ImageModel):
                                         'cat_cover_1:0'],
                                          **kwargs
                                        )
+        self._detection_crops = []
+        self._detection_cookies = []
+
     def addImage(self, image, cookie=None):
         """ Add an image to process in the underlying ImageModel after
             running preprocessing on it specific to this model.
@@ -71,11 +161,111 @@ class Classifier(ImageModel):
         """
         return self._addImage(image, self.preprocessor, cookie)
 
+    def addImages(self, images, cookies=None):
+        """ Add a stack of same-sized images to process in the underlying
+            ImageModel, preprocessing them as a batch.
+
+        images: np.ndarray (N,H,W,C) or list of images to add to the model's
+                current batch
+        cookies: list of per-image cookies (or None)
+        """
+        return self._addImages(images, self.preprocessor, cookies)
+
+    def addDetections(self, image, detections, ids=None, frame=None,
+                      video_id=None):
+        """ Add the crop of each detection in a frame to process with
+            processDetections, which returns the results with their
+            detection's id.
+
+            The crops are views of the frame, resized and preprocessed
+            straight into the model's batch as with addImages, so no copy
+            of each crop is made; the frame must not be modified until
+            processDetections is called. Detections entirely outside of
+            the frame are skipped.
+
+        image: np.ndarray the frame (not pre-processed) the detections
+               were found in
+        detections: list of Detection, DetectionRecords or a frame of a
+                    DetectionBatch, in (x, y, w, h) frame coordinates
+        ids: id of each detection; defaults to its index in detections
+        frame: frame number to set in each Classification
+        video_id: video id to set in each Classification
+        """
+        if ids is None:
+            ids = range(len(detections))
+        boxes = detectionBoxes(detections)
+        height, width = image.shape[:2]
+        x0 = np.clip(boxes[:,0].astype(np.int64), 0, width)
+        y0 = np.clip(boxes[:,1].astype(np.int64), 0, height)
+        x1 = np.clip((boxes[:,0] + boxes[:,2]).astype(np.int64), 0, width)
+        y1 = np.clip((boxes[:,1] + boxes[:,3]).astype(np.int64), 0, height)
+
+        crops = []
+        cookies = []
+        for idx, detection_id in enumerate(ids):
+            if x1[idx] <= x0[idx] or y1[idx] <= y0[idx]:
+                continue
+            crops.append(image[y0[idx]:y1[idx], x0[idx]:x1[idx]])
+            cookies.append({"detection": detection_id,
+                            "frame": frame,
+                            "video_id": video_id})
+        self._detection_crops.extend(crops)
+        self._detection_cookies.extend(cookies)
+
     def process(self):
         tensors, cookies = super(Classifier, self).process()
         if tensors is None:
             return tensors
+        with self._stage('postprocess'):
+            return self._postprocess(tensors, cookies)
+
+    def processDetections(self):
+        """ Process the detection crops added with addDetections, along
+            with any images already added.
+
+        Any number of crops may be added; they are fed to the model as
+        the frame ring has room for them, processing in between.
+
+        Returns a list of (detection id, Classification) tuples in the
+        order the detections were added, or None if there are none
+        """
+        crops = self._detection_crops
+        cookies = self._detection_cookies
+        self._detection_crops = []
+        self._detection_cookies = []
+
+        results = []
+        chunk_size = self._ring.slot_count
+        for start in range(0, len(crops), chunk_size):
+            # Free the ring before adding so it can hold the whole chunk
+            self._processReady(results)
+            self._addImages(crops[start:start+chunk_size],
+                            self.preprocessor,
+                            cookies[start:start+chunk_size])
+        self._processReady(results)
+        if len(results) == 0:
+            return None
+        return results
+
+    def _processReady(self, results):
+        """ Process every image in the ring, appending a (detection id,
+            Classification) tuple per image to results """
+        while self._ring.ready() > 0:
+            tensors, cookies = super(Classifier, self).process()
+            if tensors is None:
+                return
+            with self._stage('postprocess'):
+                batch_results = self._postprocess(tensors, cookies)
+            results.extend(
+                (None if cookie is None else cookie["detection"], result)
+                for cookie, result in zip(cookies, batch_results))
+
+    def _streamResults(self, result, cookies, **kwargs):
+        return self._postprocess(result, cookies)
 
+    def _postprocess(self, tensors, cookies):
+        """ Split the batched network outputs into a Classification per
+            image """
         # These tensors are potentially batched by image
         species = tensors[0]
         cover = tensors[1]
@@ -83,10 +273,18 @@ class Classifier(ImageModel):
         results_by_image=[]
         for image_idx, image_species in enumerate(species):
             image_cover = cover[image_idx]
+            # Crops added by addDetections know their frame
+            cookie = cookies[image_idx]
+            if type(cookie) == dict and "detection" in cookie:
+                frame = cookie["frame"]
+                video_id = cookie["video_id"]
+            else:
+                frame = None
+                video_id = None
             classification = Classification(species=image_species,
                                             cover=image_cover,
-                                            frame=None,
-                                            video_id=None)
+                                            frame=frame,
+                                            video_id=video_id)
             results_by_image.append(classification)
         return results_by_image
         
@@ -2,11 +2,13 @@
 import tensorflow as tf
 import numpy as np
 import cv2
-import math
+import itertools
 
 from openem.models import ImageModel
 from openem.models import Preprocessor
+from openem.models import SequenceModel
 from openem.image import crop
+from openem.columnar import FrameTable
 
 KEYFRAME_OFFSET = 32
 MIN_SPACING = 1
@@ -21,9 +23,181 @@ def peak_sum(array, idx, width):
         sum_value += array[idx+width]
     return sum_value
 
-class KeyframeFinder:
-    """ Model to find keyframes of a given species """
-    def __init__(self, model_path, img_width, img_height, gpu_fraction=1.0):
+def findKeyframePeaks(scores, clear, peak_threshold=PEAK_THRESHOLD,
+                      area_threshold=AREA_THRESHOLD, min_spacing=MIN_SPACING):
+    """ Find keyframes from the keyframe network's per-frame scores.
+
+        Peaks are visited from the highest score down. A peak of at least
+        `peak_threshold` whose sum with its neighbours `min_spacing` frames
+        either side (see peak_sum) exceeds `area_threshold` yields a
+        keyframe: the clearest frame within `min_spacing` of the peak.
+        Either way that neighbourhood is then suppressed, scoring 0 for
+        any later peaks.
+
+        This gives the same keyframes as repeatedly taking the argmax of
+        the scores and zeroing around it, but visits each frame once.
+
+    scores : np.ndarray
+             (N,) scores of a sequence, or (M,N) for M sequences
+    clear : np.ndarray
+            Clear cover score of each frame, the same shape as scores;
+            frames scoring 0 are never picked
+    peak_threshold, area_threshold, min_spacing : thresholds as above,
+                                                  defaulting to the module's;
+                                                  peak_threshold must be
+                                                  positive
+
+    Returns the sorted keyframe indices of a sequence as an np.ndarray, or
+    a list of them for each of M sequences
+    """
+    scores = np.asarray(scores)
+    if scores.ndim == 2:
+        return [findKeyframePeaks(row, clear_row, peak_threshold,
+                                  area_threshold, min_spacing)
+                for row, clear_row in zip(scores, clear)]
+
+    clear = np.asarray(clear)
+    length = len(scores)
+    # Descending score, earliest first among equal scores as argmax picks
+    candidates = np.nonzero(scores >= peak_threshold)[0]
+    order = candidates[np.argsort(-scores[candidates], kind='stable')]
+    suppressed = np.zeros(length, dtype=bool)
+    keyframes = []
+    for max_idx in order:
+        if suppressed[max_idx]:
+            continue
+        area_sum = scores[max_idx]
+        if max_idx - min_spacing > 0 and not suppressed[max_idx-min_spacing]:
+            area_sum += scores[max_idx-min_spacing]
+        if max_idx + min_spacing < length and \
+           not suppressed[max_idx+min_spacing]:
+            area_sum += scores[max_idx+min_spacing]
+
+        low_idx = max(max_idx-min_spacing,0)
+        limit = min(max_idx+min_spacing+1,length)
+        if area_sum > area_threshold:
+            area_clear = clear[low_idx:limit]
+            clear_idx = np.argmax(area_clear)
+            if area_clear[clear_idx] > 0.0:
+                keyframes.append(low_idx + clear_idx)
+        suppressed[low_idx:limit] = True
+    return np.sort(np.array(keyframes, dtype=np.int64))
+
+def sequenceFeatures(present, species, cover, location, confidence,
+                     detection_species, img_width, img_height,
+                     num_features=None):
+    """ Returns the keyframe network input rows of a sequence of frames.
+
+        Shared by training and inference so both build identical features.
+        The layout of a row is: Species, Cover, Normalized Location,
+        Confidence, SSD Species; optionally repeated for two models. Frames
+        without a detection only have the first (no species) feature set.
+
+    present : np.ndarray
+              (N,) bool, set for each frame with a detection
+    species : np.ndarray
+              (P,S) species scores of the classification of each present
+              frame
+    cover : np.ndarray
+            (P,C) cover scores of the classification of each present frame
+    location : np.ndarray
+               (P,4) detection (x, y, w, h) in pixels of each present frame
+    confidence : np.ndarray
+                 (P,) detection confidence of each present frame
+    detection_species : np.ndarray
+                        (P,) detection species of each present frame
+    img_width : Width of the image input to the detector (pixels)
+    img_height : Height of the image input to the detector (pixels)
+    num_features : Length of a row; the features are repeated to fill it.
+                   Defaults to one copy.
+
+    Returns an (N, num_features) float64 array
+    """
+    present = np.asarray(present, dtype=bool)
+    rows = None
+    if np.any(present):
+        location = np.asarray(location, dtype=np.float64).reshape(-1, 4)
+        single = np.concatenate(
+            [np.asarray(species, dtype=np.float64).reshape(len(location), -1),
+             np.asarray(cover, dtype=np.float64).reshape(len(location), -1),
+             location / np.array([img_width, img_height,
+                                  img_width, img_height], dtype=np.float64),
+             np.asarray(confidence, dtype=np.float64).reshape(-1, 1),
+             np.asarray(detection_species, dtype=np.float64).reshape(-1, 1)],
+            axis=1)
+        num_fea = single.shape[1]
+        if num_features is None:
+            num_features = num_fea
+        # We expect either 1 or 2 models per sequence
+        num_of_models = int(num_features / num_fea)
+        if num_of_models != 2 and num_of_models != 1:
+            raise Exception('Bad Feature Length')
+        rows = np.zeros((len(present), num_features))
+        rows[present, :num_of_models * num_fea] = np.tile(single,
+                                                          num_of_models)
+    elif num_features is None:
+        raise Exception('Feature length required without detections')
+
+    if rows is None:
+        rows = np.zeros((len(present), num_features))
+    rows[~present, 0] = 1.0
+    return rows
+
+def _sequenceColumns(classifications, detections):
+    """ Returns the arguments of sequenceFeatures describing a sequence,
+        plus the clear cover score of each frame's first classification
+        (0 if none), for per-frame classifications and detections """
+    if isinstance(detections, FrameTable) and \
+       isinstance(classifications, FrameTable):
+        # Columnar results; the first row of each frame is looked up in
+        # the arrays directly
+        first_detection = detections.first()
+        first_classification = classifications.first()
+        present = first_detection >= 0
+        detection_rows = first_detection[present]
+        classification_rows = first_classification[present]
+        if np.any(classification_rows < 0):
+            raise IndexError("Frame has a detection but no classification")
+        clear = np.zeros(len(first_classification))
+        classified = first_classification >= 0
+        clear[classified] = \
+            classifications.cover[first_classification[classified], 2]
+        return (present,
+                classifications.species[classification_rows],
+                classifications.cover[classification_rows],
+                detections.location[detection_rows],
+                detections.confidence[detection_rows],
+                detections.species[detection_rows],
+                clear)
+
+    present = np.array([len(frame) > 0 for frame in detections], dtype=bool)
+    frames = np.nonzero(present)[0]
+    first_detections = [detections[idx][0] for idx in frames]
+    first_classifications = [classifications[idx][0] for idx in frames]
+    clear = np.array([frame[0].cover[2] if len(frame) > 0 else 0.0
+                      for frame in classifications], dtype=np.float64)
+    return (present,
+            [c.species for c in first_classifications],
+            [c.cover for c in first_classifications],
+            [d.location for d in first_detections],
+            [d.confidence for d in first_detections],
+            [d.species for d in first_detections],
+            clear)
+
+class KeyframeFinder(SequenceModel):
+    """ Model to find keyframes of a given species
+
+        Keyframes can be found for a whole video at once with process, or
+        incrementally with addFrame / finish (or stream) as each frame's
+        classifications and detections become available. Either way the
+        video is run through the network in fixed-size windows: each window
+        finds the keyframes of sequenceSize() frames, and also sees the
+        KEYFRAME_OFFSET frames either side of them as context. Only the
+        frames of the windows not yet run are held, so memory does not grow
+        with the length of the video.
+    """
+    def __init__(self, model_path, img_width, img_height, gpu_fraction=1.0,
+                 **kwargs):
         """ Initialize a keyframe finder model. Gives a list of keyframes for
             each species. Caveats of this model:
 
@@ -35,23 +209,21 @@ class KeyframeFinder:
         img_height: Height of image input to decttor (pixels)
         gpu_fraction : float
                        Fraction of GPU allowed to be used by this object.
+
+        Other keyword arguments (batch_size, the number of windows run
+        through the network at once, optimize, cpu_only, registry, ...) are
+        those of openem.models.SequenceModel. The graph is not optimized
+        with TensorRT unless optimize=True is passed.
         """
-         # Create session first with requested gpu_fraction parameter
-        config = tf.compat.v1.ConfigProto()
-        config.gpu_options.allow_growth = True
-        config.gpu_options.per_process_gpu_memory_fraction = gpu_fraction
-        self.tf_session = tf.compat.v1.Session(config=config)
-
-        with tf.io.gfile.GFile(model_path, 'rb') as graph_file:
-            # Load graph off of disk into a graph definition
-            graph_def = tf.compat.v1.GraphDef()
-            graph_def.ParseFromString(graph_file.read())
-            self.input_tensor, self.output_tensor = tf.import_graph_def(
-                    graph_def,
-                    return_elements=['input_1:0', 'cumsum_values_1:0'])
+        super(KeyframeFinder, self).__init__(model_path,
+                                             gpu_fraction=gpu_fraction,
+                                             input_name='input_1:0',
+                                             output_name='cumsum_values_1:0',
+                                             **kwargs)
 
         self.img_width = img_width
         self.img_height = img_height
+        self.reset()
 
     def process(self, classifications, detections):
         """ Process the list of classifications and detections, which
@@ -61,166 +233,168 @@ class KeyframeFinder:
             a list of detection or classification in a given frame
 
             classifications: list of list of openem.Classify.Classfication
-            detections: list of list of openem.Detect.Detection
+                             or openem.Classify.ClassificationBatch
+            detections: list of list of openem.Detect.Detection or
+                        openem.Detect.DetectionBatch
+
+            Returns the sorted list of keyframes
         """
-        det_len = len(detections)
         if len(classifications) != len(detections):
             raise Exception("Classifications / Detections difer in length!")
+        return list(self.stream(classifications, detections))
+
+    def stream(self, classifications, detections):
+        """ Find keyframes over iterables of per-frame classifications and
+            detections, e.g. generators reading a long video. See process
+            for the format of each frame.
+
+            Yields keyframes in order as soon as their window is run
+        """
+        self.reset()
+        frames = zip(classifications, detections)
+        # Frames are added a batch of windows at a time so their features
+        # are built together
+        chunk_size = self.sequenceSize() * self.batch_size
+        while True:
+            chunk = list(itertools.islice(frames, chunk_size))
+            if len(chunk) == 0:
+                break
+            yield from self.addFrames([frame[0] for frame in chunk],
+                                      [frame[1] for frame in chunk])
+        yield from self.finish()
+
+    def reset(self):
+        """ Discard any frames added and start a new video """
+        # Feature rows and clear score of each frame still needed
+        self._features = np.zeros((0, self.featureCount()))
+        self._clear = np.zeros(0)
+        # Frame number of the first of those frames
+        self._first_frame = 0
+        self._frame_count = 0
+        self._next_window = 0
+        # (first frame, network input, clear scores) of each pending window
+        self._windows = []
+
+    def addFrame(self, classifications, detections):
+        """ Add the classifications and detections of the next frame of the
+            video.
+
+            classifications: list of openem.Classify.Classification
+            detections: list of openem.Detect.Detection
+
+            Returns a list of any keyframes found in windows completed by
+            this frame
+        """
+        return self.addFrames([classifications], [detections])
+
+    def addFrames(self, classifications, detections):
+        """ Add the classifications and detections of the next frames of
+            the video. See process for the format.
 
+            Returns a list of any keyframes found in windows completed by
+            these frames
+        """
+        if len(classifications) != len(detections):
+            raise Exception("Classifications / Detections difer in length!")
+        keyframes = []
         sequence_length = self.sequenceSize()
-        sequence_count = math.ceil(det_len / sequence_length)
-        overall_keyframes = []
-
-        sequences=[] # The sequence of features to run the network on
-        seq_class=[] # the underlying classifictions for each sequence
-        # Iterate over each sequence to generate a batch request
-        for sequence_idx in range(sequence_count):
-            start_idx = sequence_idx*sequence_length
-            end_idx = max((sequence_idx+1)*sequence_length,len(detections))
-            classification_sublist=classifications[start_idx:end_idx]
-            detections_sublist=detections[start_idx:end_idx]
-            sequences.append(self._generateSequence(classification_sublist,
-                                                    detections_sublist))
-            seq_class.append(classification_sublist)
-
-        # Now that each sequence is setup, run the network on all of them
-        # TODO: May have practical limitations here if we have a huge
-        # video
-        return self._processSequences(sequences, seq_class)
+        chunk_size = sequence_length * self.batch_size
+        # Keep to a batch of windows at a time so few are held at once
+        for start in range(0, len(detections), chunk_size):
+            stop = start + chunk_size
+            with self._stage('preprocess'):
+                *columns, clear = _sequenceColumns(
+                    classifications[start:stop],
+                    detections[start:stop])
+                features = sequenceFeatures(*columns,
+                                            self.img_width,
+                                            self.img_height,
+                                            self.featureCount())
+            self._features = np.concatenate((self._features, features))
+            self._clear = np.concatenate((self._clear, clear))
+            self._frame_count += len(features)
+
+            # A window is complete once the context after it has arrived
+            while self._frame_count >= \
+                  (self._next_window + 1) * sequence_length + KEYFRAME_OFFSET:
+                self._addWindow()
+                if len(self._windows) >= self.batch_size:
+                    keyframes.extend(self._processWindows())
+        return keyframes
 
+    def finish(self):
+        """ Run the windows left at the end of the video, then reset.
+
+            Returns a list of the keyframes found in them
+        """
+        while self._next_window * self.sequenceSize() < self._frame_count:
+            self._addWindow()
+        keyframes = self._processWindows()
+        self.reset()
+        return keyframes
 
     def sequenceSize(self):
         """ Returns the effective number of frames one can process in an
             individual sequence """
-        return int(self.input_tensor.shape[1]-(KEYFRAME_OFFSET*2))
-
-    def _normalizeDetection(self, detection):
-        """ Normalize a detection coordinates to be relative coordinates """
-        return np.array([detection[0] / self.img_width,
-                         detection[1] / self.img_height,
-                         detection[2] / self.img_width,
-                         detection[3] / self.img_height])
-
-    def _generateSequence(self, classifications, detections):
-        """ Handle an individual sequence, returns frame offsets
-            unique to that sequence based on the output length.
-        """
-        det_len = len(detections)
-
-        # Convert classifications and detections to input required for network
-        seq_len = int(self.input_tensor.shape[1])
-        fea_len = int(self.input_tensor.shape[2])
-        input_data = np.zeros((seq_len,fea_len))
-
-        # Add padding before and after sequence based on KEYFRAME_OFFSET
-        input_data[:KEYFRAME_OFFSET,0] = np.ones(KEYFRAME_OFFSET)
-        input_data[det_len:det_len+KEYFRAME_OFFSET,0] = np.ones(KEYFRAME_OFFSET)
-        # Iterate through each frame of the data
-        for idx, frame_detections in enumerate(detections):
-            # We have already padded before and after
-            seq_idx = idx + KEYFRAME_OFFSET
-
-            # Skip through frames with no detections
-            if len(frame_detections) == 0:
-                input_data[seq_idx][0] = 1.0
-                continue
-
-            detection = frame_detections[0]
-            classification = classifications[idx][0]
-
-            # Do a size check on input
-            # We expect either 1 or 2 models per sequence
-            num_species = len(classification.species)
-            num_cover = len(classification.cover)
-            num_loc = len(detection.location)
-            num_fea = num_species + num_cover + num_loc + 2
-            num_of_models = int(fea_len / num_fea)
-
-            if num_of_models != 2 and num_of_models != 1:
-                raise Exception('Bad Feature Length')
-
-            # Layout of the feature is:
-            # Species, Cover, Normalized Location, Confidence, SSD Species
-            # Optional duplicate
-
-            for model_idx in range(num_of_models):
-                # Calculate indices of vector based on model_idx
-                fea_idx = model_idx * num_fea
-                species_stop = fea_idx + num_species
-                cover_stop = species_stop + num_cover
-                loc_stop = cover_stop + num_loc
-                ssd_conf = loc_stop
-                ssd_species = ssd_conf + 1
-
-                input_data[seq_idx,fea_idx:species_stop] = \
-                    classification.species
-                input_data[seq_idx,species_stop:cover_stop] = \
-                    classification.cover
-                input_data[seq_idx,cover_stop:loc_stop] = \
-                    self._normalizeDetection(detection.location)
-                input_data[seq_idx, ssd_conf] = detection.confidence
-                input_data[seq_idx, ssd_species] = detection.species
-        return input_data
-
-    def _findKeyframeSegments(self,array, classifications):
-        """ Based on a sequence result and the underlying classifications,
-            find the best keyframes """
-        keyframes=[]
-        while True:
-            max_idx = np.argmax(array)
-            max_value = array[max_idx]
-            if max_value < PEAK_THRESHOLD:
-                return keyframes
-
-            area_sum = peak_sum(array, max_idx, MIN_SPACING)
-            low_idx = max(max_idx-MIN_SPACING,0)
-            limit = min(max_idx+MIN_SPACING+1,len(array))
-            if area_sum > AREA_THRESHOLD:
-                max_clear = 0.0
-                clear_idx = None
-                for area_idx in range(low_idx,limit):
-                    # The actual frame is KEYFRAME_OFFSET away from the
-                    # result vector due to padding
-                    class_idx = area_idx - KEYFRAME_OFFSET
-
-                    # If there are no detections don't attemt to extract
-                    # then don't attempt to extract cover info
-                    if len(classifications[class_idx]) == 0:
-                        continue
-                    element_cover = classifications[class_idx][0].cover[2]
-                    if element_cover > max_clear:
-                        max_clear = element_cover
-                        clear_idx = area_idx
-
-                if clear_idx is not None:
-                    keyframes.append(clear_idx)
-                    keyframes.sort()
-
-            # Zero out the area identified
-            for clear_idx in range(low_idx, limit):
-                array[clear_idx] = 0.0
-
-    def _processSequences(self, sequences, seq_classes):
-        """ Process a result of sequences and returns the list of keyframes """
-
-        result = self.tf_session.run(self.output_tensor,
-                                     feed_dict={self.input_tensor:
-                                                np.array(sequences)})
-
-        keyframes=[]
-        assert self.sequenceSize() == result.shape[1]
-
-        # Iterate over the output and if we found a match, add it to the
-        # keyframe lists
+        return self.sequenceLength() - KEYFRAME_OFFSET*2
 
+    def _addWindow(self):
+        """ Build the network input of the next window from the buffered
+            frames and queue it to be run """
+        sequence_length = self.sequenceSize()
+        seq_len = self.sequenceLength()
+        fea_len = self.featureCount()
+        window_start = self._next_window * sequence_length
+        context_start = window_start - KEYFRAME_OFFSET
+
+        input_data = np.zeros((seq_len, fea_len))
+        # Before the start of the video is padding; after the end is zeros
+        pad = max(0, -context_start)
+        input_data[:pad,0] = 1.0
+        first = max(0, context_start) - self._first_frame
+        stop = min(context_start + seq_len, self._frame_count) \
+               - self._first_frame
+        if stop > first:
+            input_data[pad:pad+stop-first] = self._features[first:stop]
+
+        clear = np.zeros(sequence_length)
+        first = window_start - self._first_frame
+        stop = min(window_start + sequence_length, self._frame_count) \
+               - self._first_frame
+        clear[:stop-first] = self._clear[first:stop]
+        self._windows.append((window_start, input_data, clear))
+        self._next_window += 1
+
+        # Drop the frames no later window needs
+        drop = self._next_window * sequence_length - KEYFRAME_OFFSET \
+               - self._first_frame
+        if drop > 0:
+            self._features = self._features[drop:]
+            self._clear = self._clear[drop:]
+            self._first_frame += drop
+
+    def _processWindows(self):
+        """ Run the pending windows, at most batch_size at a time, and
+            returns their keyframes """
+        if len(self._windows) == 0:
+            return []
+        result = self.runSequences([window[1] for window in self._windows])
+        if result is None:
+            return []
+        assert self.sequenceSize() == result.shape[1]
 
-        # Process each sequence result adding its actual frame number
+        # Process each window result adding its actual frame number
         # to the overall list
-        for seq_idx,array in enumerate(result):
-            sequence_keyframes = self._findKeyframeSegments(
-                array,
-                seq_classes[seq_idx])
-            for keyframe in sequence_keyframes:
-                keyframes.append(keyframe + (seq_idx*self.sequenceSize()))
-
+        keyframes = []
+        with self._stage('postprocess'):
+            for (window_start, _, clear), array in zip(self._windows, result):
+                for keyframe in self._findKeyframeSegments(array, clear):
+                    keyframes.append(keyframe + window_start)
+        self._windows = []
         return keyframes
+
+    def _findKeyframeSegments(self, array, clear):
+        """ Based on a sequence result and the clear cover score of the
+            first classification of each frame in it (0 if none), find the
+            best keyframes """
+        return findKeyframePeaks(array, clear).tolist()
@@ -5,37 +5,92 @@ import numpy as np
 from openem.models import ImageModel
 
 import cv2
-import math
 import copy
 
-from openem.Detect import Detection
-from openem.image import force_aspect
+from openem.Detect import DetectionRecords, detectionDtype
+from openem.Detect.tiling import TiledDetection
+from openem.image import aspect_padded_shape, letterbox
 
 class RetinaNetPreprocessor:
     """ Perform preprocessinig for RetinaNet inputs
         Meets the callable interface of openem.Detect.Preprocessor
+
+        Images are letterboxed to the network's aspect ratio in a single
+        resize of the original frame (see openem.image.letterbox); only the
+        network sized result is converted to float.
     """
     def __init__(self,meanImage=None):
         self.mean_image = meanImage
+        self._scratch = None
+
+    def _mean(self):
+        if self.mean_image is not None:
+            return self.mean_image.astype(np.float32)
+        # Use the ImageNet mean image by default; which in BGR is:
+        return np.array([103.939, 116.779, 123.68 ], dtype=np.float32)
 
     def __call__(self, image, requiredWidth, requiredHeight):
         #TODO: (Provide way to optionally convert channel ordering?)
         #image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        image = image.astype(np.float32)
-
-        required_aspect = requiredWidth / requiredHeight
-        image = force_aspect(image, required_aspect)
-        resized_image = cv2.resize(image, (requiredWidth, requiredHeight))
-        if self.mean_image:
-            for dim in [0,1,2]:
-                resized_image[:,:,dim] -= self.mean_image[:,:,dim]
-        else:
-            # Use the ImageNet mean image by default; which in BGR is:
-            imagenet_mean = np.array([103.939, 116.779, 123.68 ])
-            resized_image -= imagenet_mean
+        resized_image = self.resize(image, requiredWidth, requiredHeight)
+        resized_image = resized_image.astype(np.float32)
+        resized_image -= self._mean()
         return resized_image
 
-class RetinaNetDetector(ImageModel):
+    def resize(self, image, requiredWidth, requiredHeight, out=None):
+        """ Letterbox the image to the required size, keeping its type, for
+            models that subtract the mean in the graph (see graphTransform)
+
+        out: Optional destination of shape (requiredHeight, requiredWidth, C);
+             letterboxed into directly if it has the image's type
+        """
+        if out is not None and out.dtype == image.dtype:
+            resized_image, _, _ = letterbox(image,
+                                            (requiredHeight, requiredWidth),
+                                            out=out)
+            return resized_image
+        resized_image, _, _ = letterbox(image,
+                                        (requiredHeight, requiredWidth))
+        if out is None:
+            return resized_image
+        out[:] = resized_image
+        return out
+
+    def graphTransform(self, tensor):
+        """ Returns the mean subtracted float32 network input of a batch of
+            resized raw images, in the graph """
+        return tf.cast(tensor, tf.float32) - self._mean()
+
+    def batch(self, images, requiredWidth, requiredHeight, out=None):
+        """ Preprocess a stack of same-sized images into a single float32
+            batch tensor, subtracting the mean from the whole batch at once.
+
+        images: np.ndarray (N,H,W,C) or sequence of same-sized images
+        out: Optional preallocated float32 destination of shape
+             (N, requiredHeight, requiredWidth, C)
+        """
+        count = len(images)
+        if out is None:
+            out = np.empty((count, requiredHeight, requiredWidth,
+                            images[0].shape[2]),
+                           dtype=np.float32)
+
+        # Each image is letterboxed into a reused buffer of its own type
+        # and converted to float on assignment into the batch
+        shape = (requiredHeight, requiredWidth, images[0].shape[2])
+        if self._scratch is None or self._scratch.shape != shape or \
+           self._scratch.dtype != images[0].dtype:
+            self._scratch = np.empty(shape, dtype=images[0].dtype)
+        for idx in range(count):
+            out[idx] = self.resize(images[idx],
+                                   requiredWidth,
+                                   requiredHeight,
+                                   out=self._scratch)
+
+        out -= self._mean()
+        return out
+
+class RetinaNetDetector(TiledDetection, ImageModel):
     def __init__(self, modelPath, meanImage=None, gpuFraction=1.0, imageShape=(360,720), **kwargs):
         """ Initialize the RetinaNet Detector model
         modelPath: str
@@ -46,6 +101,15 @@ class RetinaNetDetector(ImageModel):
         image_shape: tuple
                    (height, width) of the image to feed into the detector network.
         """
+        # Set before the graph is loaded in case it is prepended for
+        # uint8 input
+        if meanImage is not None:
+            resized_mean = cv2.resize(meanImage,(imageShape[1],
+                                                 imageShape[0]))
+            self.preprocessor=RetinaNetPreprocessor(meanImage=resized_mean)
+        else:
+            self.preprocessor=RetinaNetPreprocessor(meanImage=None)
+
         super(RetinaNetDetector,self).__init__(modelPath,
                                                image_dims=imageShape,
                                                gpu_fraction=gpuFraction,
@@ -57,84 +121,99 @@ class RetinaNetDetector(ImageModel):
         self.image_shape = imageShape
         self.network_aspect = imageShape[1] / imageShape[0]
 
-        if meanImage:
-            resized_mean = cv2.resize(meanImage,(imageShape[1],
-                                                 imageShape[0]))
-            self.preprocessor=RetinaNetPreprocesser(meanImage=resized_mean)
-        else:
-            self.preprocessor=RetinaNetPreprocessor(meanImage=None)
+    def _paddedSize(self, image):
+        """ Determine the actual shape of the image as it goes into the
+            network to account for padding to aspect ratio """
+        return aspect_padded_shape(image.shape, self.network_aspect)
 
     def addImage(self, image, cookie=None):
-        # Determine the actual shape of the image as it goes into the network
-        # To account for padding to aspect ratio
-        img_height = image.shape[0]
-        img_width = image.shape[1]
-        img_aspect = img_width / img_height
-        if math.isclose(img_aspect, self.network_aspect):
-            img_size = image.shape[:2]
-        elif img_aspect < self.network_aspect:
-            #Image is boxer than we want
-            new_width = round(img_height * self.network_aspect)
-            img_size = (img_height, new_width)
-        else:
-            new_height = round(img_width / self.network_aspect)
-            img_size = (new_height,img_width)
-
         if cookie is None:
             cookie = {}
-        cookie.update({"size": img_size})
+        cookie.update({"size": self._paddedSize(image)})
         return super(RetinaNetDetector, self)._addImage(image,
                                                         self.preprocessor,
                                                         cookie)
 
-    def format_results(self, detections, sizes, threshold, **kwargs):
-        # clip to image shape
-        detections[:, :, 0] = np.maximum(0, detections[:, :, 0])
-        detections[:, :, 1] = np.maximum(0, detections[:, :, 1])
-        detections[:, :, 2] = np.minimum(self.image_shape[1], detections[:, :, 2])
-        detections[:, :, 3] = np.minimum(self.image_shape[0], detections[:, :, 3])
-
-        num_images = detections.shape[0]
-        for idx in range(num_images):
-            # correct boxes for image scale
-            # Keep in mind there is a shift here potentially to force
-            # an aspect ratio.
-            h_scale = self.image_shape[0] / sizes[idx][0]
-            w_scale = self.image_shape[1] / sizes[idx][1]
-
-            detections[idx, :, 0] /= w_scale
-            detections[idx, :, 1] /= h_scale
-            detections[idx, :, 2] /= w_scale
-            detections[idx, :, 3] /= h_scale
+    def addImages(self, images, cookies=None):
+        """ Add a stack of same-sized images, preprocessing them as a batch.
 
+        images: np.ndarray (N,H,W,C) or list of same-sized images
+        cookies: list of per-image cookies (or None)
+        """
+        if cookies is None:
+            cookies = [None] * len(images)
+        cookies = [{} if cookie is None else cookie for cookie in cookies]
+        for image, cookie in zip(images, cookies):
+            cookie.update({"size": self._paddedSize(image)})
+        return super(RetinaNetDetector, self)._addImages(images,
+                                                         self.preprocessor,
+                                                         cookies)
+
+    def _streamResults(self, result, cookies, threshold=0.0, **kwargs):
+        """ Format each image's detections for stream, keeping those with a
+            confidence of at least `threshold` """
+        sizes = [cookie["size"] for cookie in cookies]
+        return self.format_results(result, sizes, threshold, **kwargs)
+
+    def format_results(self, detections, sizes, threshold, columnar=False,
+                       **kwargs):
+        """ Convert raw network output into detections per image
+
+        detections: np.ndarray raw network output for a batch
+        sizes: (height, width) of each image after padding to aspect ratio
+        threshold: minimum confidence of the predicted label to keep
+        columnar: if True, return a DetectionRecords per image instead of
+                  a list of Detection
+        frame: optional frame number of the first image
+        video_id: optional video id of the images
+        """
+        num_imgs = detections.shape[0]
+        sizes = np.array([size[:2] for size in sizes])
+        # correct boxes for image scale
+        # Keep in mind there is a shift here potentially to force
+        # an aspect ratio.
+        h_scale = (self.image_shape[0] / sizes[:,0]).astype(np.float32)
+        w_scale = (self.image_shape[1] / sizes[:,1]).astype(np.float32)
 
+        # clip to image shape
+        x0 = np.maximum(0, detections[:,:,0]) / w_scale[:,None]
+        y0 = np.maximum(0, detections[:,:,1]) / h_scale[:,None]
+        x1 = np.minimum(self.image_shape[1], detections[:,:,2]) \
+             / w_scale[:,None]
+        y1 = np.minimum(self.image_shape[0], detections[:,:,3]) \
+             / h_scale[:,None]
+
+        # Confidence of each predicted label; padding rows have a label of
+        # -1 which selects the label column itself, so are dropped too
+        labels = detections[:,:,4].astype(np.int64)
+        label_confidence = np.take_along_axis(detections[:,:,4:],
+                                              labels[:,:,None] + 1,
+                                              axis=2)[:,:,0]
+        keep = label_confidence >= threshold
+
+        num_classes = detections.shape[2] - 5
+        records = np.empty(detections.shape[:2],
+                           dtype=detectionDtype(num_classes))
         # change to (x, y, w, h) (MS COCO standard)
-        detections[:, :, 2] -= detections[:, :, 0]
-        detections[:, :, 3] -= detections[:, :, 1]
+        records['location'] = np.stack([x0, y0, x1 - x0, y1 - y0], axis=2)
+        records['confidence'] = detections[:,:,5:]
+        # OpenEM uses 1-based indexing
+        records['species'] = labels + 1
 
         results=[]
         frame = kwargs.get('frame', None)
         video_id = kwargs.get('video_id', None)
-        # compute predicted labels and scores
-        num_imgs = detections.shape[0]
         for img_idx in range(num_imgs):
             if not frame is None:
                 this_frame = frame + img_idx
             else:
                 this_frame = None
-
-            image_detections=[]
-            for detection in detections[img_idx, ...]:
-                label = int(detection[4])
-                max_confidence = detection[5+label]
-                if max_confidence >= threshold:
-                    detection = Detection(location=detection[:4].tolist(),
-                                          confidence=detection[5:].tolist(),
-                                          # OpenEM uses 1-based indexing
-                                          species=label+1,
-                                          frame=this_frame,
-                                          video_id=video_id)
-                    image_detections.append(detection)
-            results.append(image_detections)
+            image_records = DetectionRecords(records[img_idx][keep[img_idx]],
+                                             frame=this_frame,
+                                             video_id=video_id)
+            if columnar:
+                results.append(image_records)
+            else:
+                results.append(list(image_records))
 
         return results
@@ -1,18 +1,43 @@
 from openem.models import ImageModel
 from openem.models import Preprocessor
 
-import cv2
 import numpy as np
 import tensorflow as tf
 
 from collections import namedtuple
 
-from openem.Detect import Detection
+from openem.Detect import Detection, nonMaxSuppression
+from openem.Detect.tiling import TiledDetection
 
-class SSDDetector(ImageModel):
+class SSDDetector(TiledDetection, ImageModel):
     preprocessor=Preprocessor(1.0,
                               np.array([-103.939,-116.779,-123.68]),
                               False)
+    # Non-maximum suppression settings; set class_aware_nms to only
+    # suppress overlapping boxes of the same species
+    nms_threshold = 0.01
+    score_threshold = 0.45
+    max_detections = 200
+    class_aware_nms = False
+    compact = False
+
+    def __init__(self, model_path, *args, compact=False, **kwargs):
+        """ Create an SSD detector
+
+        model_path : str or path-like object
+                     Path to the frozen protobuf of the tensorflow graph
+        compact : bool
+                  Set if the graph was rewritten by compactGraph so it
+                  outputs the final detections instead of every prior
+        args, kwargs : Passed on to ImageModel
+        """
+        self.compact = compact
+        # Unless output_name was already given positionally, after
+        # image_dims, gpu_fraction and input_name
+        if compact and len(args) < 4:
+            kwargs.setdefault('output_name', COMPACT_OUTPUTS)
+        super(SSDDetector, self).__init__(model_path, *args, **kwargs)
+
     def addImage(self, image, cookie=None):
         """ Add an image to process in the underlying ImageModel after
             running preprocessing on it specific to this model.
@@ -26,6 +51,21 @@ class SSDDetector(ImageModel):
         cookie.update({"size": image.shape})
         return self._addImage(image, self.preprocessor, cookie)
 
+    def addImages(self, images, cookies=None):
+        """ Add a stack of same-sized images to process in the underlying
+            ImageModel, preprocessing them as a batch.
+
+            images: np.array (N,H,W,C) or list of images to add to the
+                    model's current batch.
+            cookies: list of per-image cookies (or None)
+        """
+        if cookies is None:
+            cookies = [None] * len(images)
+        cookies = [{} if cookie is None else cookie for cookie in cookies]
+        for image, cookie in zip(images, cookies):
+            cookie.update({"size": image.shape})
+        return self._addImages(images, self.preprocessor, cookies)
+
     def process(self):
         """ Runs network to find fish in batched images by performing object
             detection with a Single Shot Detector (SSD).
@@ -35,129 +75,202 @@ class SSDDetector(ImageModel):
         batch_result, cookies = super(SSDDetector, self).process()
         if batch_result is None:
             return batch_result
+        with self._stage('postprocess'):
+            return self._postprocess(batch_result, cookies)
+
+    def _streamResults(self, result, cookies, threshold=None, **kwargs):
+        return self._postprocess(result, cookies, threshold)
+
+    def _postprocess(self, batch_result, cookies, threshold=None):
+        """ Decode the raw network output into a list of Detection per
+            image
+
+        threshold: if given, only detections scoring above this are kept
+                   instead of above score_threshold
+        """
+        if threshold is None:
+            threshold = self.score_threshold
+        if self.compact:
+            return self._postprocessCompact(batch_result, cookies, threshold)
+
+        # Split out the tensor into bounding boxes for the whole batch
+        pred_stop = 4
+        conf_stop = batch_result.shape[2] - 8
+        anc_stop = conf_stop + 4
+        var_stop = anc_stop + 4
+        loc = batch_result[:,:,:pred_stop]
+        conf = batch_result[:,:,pred_stop:conf_stop]
+        anchors = batch_result[:,:,conf_stop:anc_stop]
+        variances = batch_result[:,:,anc_stop:var_stop]
+        sizes = np.array([cookie["size"][:2] for cookie in cookies])
+        with self._stage('decode_boxes'):
+            boxes = decodeBoxes(loc,
+                                anchors,
+                                variances,
+                                (sizes[:,0,None], sizes[:,1,None]))
+
+        # Best scoring class of each box, skipping the background class
+        class_index = np.argmax(conf[:,:,1:], axis=2)
+        scores = np.take_along_axis(conf[:,:,1:],
+                                    class_index[:,:,None],
+                                    axis=2)[:,:,0]
+        class_index += 1
 
         batch_detections=[]
-        # Split out the tensor into bounding bboxes per image
-        for image_idx,image_result in enumerate(batch_result):
-            image_dims=cookies[image_idx]["size"]
-            pred_stop = 4
-            conf_stop = image_result.shape[1] - 8
-            anc_stop = conf_stop + 4
-            var_stop = anc_stop + 4
-            loc = image_result[:,:pred_stop]
-            conf = image_result[:,pred_stop:conf_stop]
-            anchors = image_result[:,conf_stop:anc_stop]
-            variances = image_result[:,anc_stop:var_stop]
-            boxes = decodeBoxes(loc, anchors, variances, image_dims)
-            scores=np.zeros(loc.shape[0])
-            class_index=np.zeros(loc.shape[0])
-            for idx,r in enumerate(conf):
-                _,maxScore,__,maxIdx = cv2.minMaxLoc(r[1:])
-                scores[idx] = maxScore
-                class_index[idx] = maxIdx[1] + 1 # +1 for background class
-            indices = tf.image.non_max_suppression(boxes,
-                                                   scores,
-                                                   200,
-                                                   0.01,
-                                                   0.45)
+        for image_idx in range(len(batch_result)):
+            with self._stage('nms'):
+                indices = nonMaxSuppression(
+                    boxes[image_idx],
+                    scores[image_idx],
+                    self.nms_threshold,
+                    score_threshold=threshold,
+                    max_output=self.max_detections,
+                    classes=class_index[image_idx] \
+                            if self.class_aware_nms else None)
+            # Indices are already in descending order of confidence
             detections = []
-            for idx in indices.eval(session=self.tf_session):
+            for idx in indices:
                 detection = Detection(
-                    location = boxes[idx],
-                    confidence = scores[idx],
-                    species = class_index[idx],
+                    location = boxes[image_idx, idx],
+                    confidence = scores[image_idx, idx],
+                    species = class_index[image_idx, idx],
                     frame = None,
                     video_id = None)
                 detections.append(detection)
+            batch_detections.append(detections)
 
-            def get_confidence(detection):
-                return detection.confidence
-
-            detections.sort(key=get_confidence, reverse=True)
+        return batch_detections
 
+    def _postprocessCompact(self, batch_result, cookies, threshold=None):
+        """ Scale the detections output by a compactGraph to each image
+            and convert them to a list of Detection per image, keeping
+            those scoring above `threshold` """
+        boxes, scores, classes, num_detections = batch_result
+        batch_detections=[]
+        for image_idx, count in enumerate(num_detections):
+            image_height, image_width = cookies[image_idx]["size"][:2]
+            # Boxes are (y0, x0, y1, x1) relative to the image size
+            y0 = boxes[image_idx,:count,0] * image_height
+            x0 = boxes[image_idx,:count,1] * image_width
+            y1 = boxes[image_idx,:count,2] * image_height
+            x1 = boxes[image_idx,:count,3] * image_width
+            locations = np.stack([x0, y0, x1 - x0 + 1, y1 - y0 + 1], axis=1)
+            detections = []
+            for idx in range(count):
+                if threshold is not None and \
+                   scores[image_idx, idx] <= threshold:
+                    continue
+                detection = Detection(
+                    location = locations[idx],
+                    confidence = scores[image_idx, idx],
+                    species = int(classes[image_idx, idx]) + 1,
+                    frame = None,
+                    video_id = None)
+                detections.append(detection)
             batch_detections.append(detections)
 
         return batch_detections
+
+# Output tensors of a graph rewritten by compactGraph
+COMPACT_OUTPUTS = ['detection_boxes:0',
+                   'detection_scores:0',
+                   'detection_classes:0',
+                   'num_detections:0']
+
+def compactGraph(graph_def,
+                 output_name='output_node0:0',
+                 score_threshold=SSDDetector.score_threshold,
+                 nms_threshold=SSDDetector.nms_threshold,
+                 max_detections=SSDDetector.max_detections):
+    """ Append box decoding, score thresholding and non-maximum
+        suppression to a frozen SSD graph so only the final detections
+        are fetched from the device.
+
+    graph_def: tf.compat.v1.GraphDef of the frozen SSD graph
+    output_name: Name of the tensor holding the raw per-prior output
+    score_threshold: Boxes scoring at or below this are discarded
+    nms_threshold: Intersection over union above which boxes of the same
+                   class are suppressed
+    max_detections: Maximum number of detections kept per image
+
+    Returns a GraphDef with the outputs listed in COMPACT_OUTPUTS. Load it
+    with SSDDetector(..., compact=True). Unlike the default SSDDetector
+    postprocessing, suppression is done per class.
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        output, = tf.import_graph_def(graph_def,
+                                      return_elements=[output_name],
+                                      name='')
+        conf_stop = output.shape[2] - 8
+        loc = output[:,:,:4]
+        # Skip the background class
+        conf = output[:,:,5:conf_stop]
+        anchors = output[:,:,conf_stop:conf_stop+4]
+        variances = output[:,:,conf_stop+4:conf_stop+8]
+
+        # Same as decodeBoxes but relative to the image size
+        anchor_width = anchors[:,:,2] - anchors[:,:,0]
+        anchor_height = anchors[:,:,3] - anchors[:,:,1]
+        center_x = loc[:,:,0]*anchor_width*variances[:,:,0]
+        center_x += 0.5 * (anchors[:,:,2] + anchors[:,:,0])
+        center_y = loc[:,:,1]*anchor_height*variances[:,:,1]
+        center_y += 0.5 * (anchors[:,:,3] + anchors[:,:,1])
+        width = tf.exp(loc[:,:,2]*variances[:,:,2])*anchor_width
+        height = tf.exp(loc[:,:,3]*variances[:,:,3])*anchor_height
+        boxes = tf.maximum(tf.stack([center_y - 0.5 * height,
+                                     center_x - 0.5 * width,
+                                     center_y + 0.5 * height,
+                                     center_x + 0.5 * width],
+                                    axis=2),
+                           0.0)
+
+        nmsed = tf.image.combined_non_max_suppression(
+            tf.expand_dims(boxes, 2),
+            conf,
+            max_output_size_per_class=max_detections,
+            max_total_size=max_detections,
+            iou_threshold=nms_threshold,
+            score_threshold=score_threshold,
+            clip_boxes=False)
+        for tensor, name in zip(nmsed, COMPACT_OUTPUTS):
+            tf.identity(tensor, name=name.split(':')[0])
+    return graph.as_graph_def()
+
 def decodeBoxes(loc, anchors, variances, img_size):
     """ Decodes bounding box from network output
 
     loc: Bounding box parameters one box per element
     anchors: Anchors box parameters, one box per element
     variances: Variances per box
+    img_size: (height, width) of the image. For a batch of images (loc
+              etc. of shape Bx..x4) give per image arrays of shape Bx1.
 
-    Returns a Nx4 matrix of bounding boxes
+    Returns a Nx4 (or BxNx4) matrix of bounding boxes
     """
-    decoded=[]
     image_height = img_size[0]
     image_width = img_size[1]
 
-    anchor_width = anchors[:,2] - anchors[:,0]
-    anchor_height = anchors[:,3] - anchors[:,1]
+    anchor_width = anchors[...,2] - anchors[...,0]
+    anchor_height = anchors[...,3] - anchors[...,1]
 
-    anchor_center_x = 0.5 * (anchors[:,2] + anchors[:,0])
-    anchor_center_y = 0.5 * (anchors[:,3] + anchors[:,1])
-    decode_center_x = loc[:,0]*anchor_width*variances[:,0]
+    anchor_center_x = 0.5 * (anchors[...,2] + anchors[...,0])
+    anchor_center_y = 0.5 * (anchors[...,3] + anchors[...,1])
+    decode_center_x = loc[...,0]*anchor_width*variances[...,0]
     decode_center_x += anchor_center_x
-    decode_center_y = loc[:,1]*anchor_height*variances[:,1]
+    decode_center_y = loc[...,1]*anchor_height*variances[...,1]
     decode_center_y += anchor_center_y
 
-    decode_width = np.exp(loc[:,2]*variances[:,2])*anchor_width
-    decode_height = np.exp(loc[:,3]*variances[:,3])*anchor_height
+    decode_width = np.exp(loc[...,2]*variances[...,2])*anchor_width
+    decode_height = np.exp(loc[...,3]*variances[...,3])*anchor_height
 
     decode_x0 = np.maximum((decode_center_x - 0.5 * decode_width) * image_width,0)
     decode_y0 = np.maximum((decode_center_y - 0.5 * decode_height) * image_height,0)
     decode_x1 = np.maximum((decode_center_x + 0.5 * decode_width) * image_width,0)
     decode_y1 = np.maximum((decode_center_y + 0.5 * decode_height) * image_height,0)
-    decoded=np.zeros((len(decode_x0),4))
-    decoded[:,0] = decode_x0
-    decoded[:,1] = decode_y0
-    decoded[:,2] = decode_x1 - decode_x0 + 1
-    decoded[:,3] = decode_y1 - decode_y0 + 1
+    decoded=np.zeros((*decode_x0.shape,4))
+    decoded[...,0] = decode_x0
+    decoded[...,1] = decode_y0
+    decoded[...,2] = decode_x1 - decode_x0 + 1
+    decoded[...,3] = decode_y1 - decode_y0 + 1
     return decoded
-
-"""
-#Using tensorflow nms instead --- this one required a function that did
-#not work in opencv so well.
-
-def nmsBoxes(bboxes, scores, score_threshold, nms_threshold, top_k = 0):
-    \""" Performs non-maximum supression on a series of overlapping
-        bounding boxes
-
-        bboxes: list of bounding boxes
-        score_threshold a threshold used to filter boxes by score.
-        nms_threshold a threshold used in non maximum suppression.
-        indices the kept indices of bboxes after NMS.
-        top_k if `>0`, keep at most @p top_k picked indices.
-    \"""
-
-    # Sort the scores in descending order, create a new list keeping
-    # indices and value in a tuple value
-    score_sort_list=[]
-    for idx,score in enumerate(scores):
-        score_sort_list.append((idx,score))
-
-    # inline-function to get second element of tuple
-    def second_element(val):
-        return val[1]
-
-    # Sort the new list by the 2nd element (score) in descending order
-    score_sort_list.sort(key = second_element, reverse = True)
-
-    # If only keeping top_k, truncate the list
-    if top_k > 0:
-        score_sort_list[:top_k]
-
-    # Iterate over the scores/boxes and pick winners
-    winning_indices=[]
-    for idx_score in score_sort_list:
-        keep = True
-        for winner in winning_indices:
-            if not keep:
-                break
-            overlap = 1.0 - cv2.jaccardDistance(idx_score[0], winner)
-            keep = overlap <= nms_threshold
-        if keep:
-            winning_indices.append(idx_score[0])
-
-    return winning_indices
-"""
@@ -8,16 +8,229 @@ import tensorflow as tf
 from collections import namedtuple
 import csv
 
+from openem.columnar import FrameTable, FrameView, readColumns
+
 Detection=namedtuple('Detection', ['location',
                                    'confidence',
                                    'species',
                                    'frame',
                                    'video_id'])
 
+def detectionDtype(num_classes):
+    """ Returns the numpy structured dtype of a DetectionRecords array
+        for a detector with `num_classes` confidences per detection """
+    return np.dtype([('location', np.float32, (4,)),
+                     ('confidence', np.float32, (num_classes,)),
+                     ('species', np.int32)])
+
+class DetectionRecords:
+    """ Detections of one image held in a numpy structured array.
+
+        Behaves as a sequence of Detection, but each Detection is only
+        built when it is accessed. Use `array` to work on all detections
+        at once, e.g. `records.array['confidence']`.
+    """
+    def __init__(self, array, frame=None, video_id=None):
+        """ array: structured array with a detectionDtype
+            frame: frame number of the image, if known
+            video_id: video id of the image, if known
+        """
+        self.array = array
+        self.frame = frame
+        self.video_id = video_id
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, idx):
+        record = self.array[idx]
+        return Detection(location=record['location'].tolist(),
+                         confidence=record['confidence'].tolist(),
+                         species=int(record['species']),
+                         frame=self.frame,
+                         video_id=self.video_id)
+
+    def __iter__(self):
+        for idx in range(len(self.array)):
+            yield self[idx]
+
+def detectionBoxes(detections):
+    """ Returns the (x, y, w, h) boxes of a frame's detections as an Nx4
+        array, without building a Detection per row where possible
+
+    detections: list of Detection, DetectionRecords or a frame of a
+                DetectionBatch
+    """
+    if isinstance(detections, DetectionRecords):
+        return detections.array['location'].astype(np.float64)
+    if isinstance(detections, FrameView):
+        return detections.column('location').astype(np.float64)
+    return np.array([detection.location for detection in detections],
+                    dtype=np.float64).reshape(-1, 4)
+
+def nonMaxSuppression(bboxes, scores, nms_threshold, score_threshold=None,
+                      max_output=None, classes=None):
+    """ Performs greedy non-maximum suppression on a series of overlapping
+        bounding boxes
+
+    bboxes: Nx4 matrix of (x, y, w, h) bounding boxes
+    scores: score of each box
+    nms_threshold: boxes overlapping a kept box with an intersection over
+                   union greater than this are suppressed
+    score_threshold: if given, only boxes scoring above this are kept
+    max_output: if given, keep at most this many boxes
+    classes: if given, boxes only suppress others of the same class
+
+    Returns the indices of the kept boxes in descending order of score
+    """
+    scores = np.asarray(scores)
+    candidates = np.arange(len(scores))
+    if score_threshold is not None:
+        candidates = candidates[scores > score_threshold]
+    order = candidates[np.argsort(-scores[candidates], kind='stable')]
+    if max_output is None:
+        max_output = len(order)
+
+    if len(order) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    x0 = bboxes[:,0]
+    y0 = bboxes[:,1]
+    if classes is not None:
+        # Move each class to its own region so boxes of different classes
+        # never overlap
+        span = np.max(bboxes[:,:2] + bboxes[:,2:]) - np.min(bboxes[:,:2])
+        offset = np.asarray(classes) * (span + 1)
+        x0 = x0 + offset
+        y0 = y0 + offset
+    x1 = x0 + bboxes[:,2]
+    y1 = y0 + bboxes[:,3]
+    areas = bboxes[:,2] * bboxes[:,3]
+
+    keep = []
+    while len(order) > 0 and len(keep) < max_output:
+        best = order[0]
+        keep.append(best)
+        rest = order[1:]
+        width = np.minimum(x1[best], x1[rest]) - np.maximum(x0[best], x0[rest])
+        height = np.minimum(y1[best], y1[rest]) - np.maximum(y0[best], y0[rest])
+        intersection = np.maximum(width, 0) * np.maximum(height, 0)
+        union = areas[best] + areas[rest] - intersection
+        overlap = intersection / np.maximum(union, np.finfo(np.float64).eps)
+        order = rest[overlap <= nms_threshold]
+    return np.array(keep, dtype=np.int64)
+
+class DetectionBatch(FrameTable):
+    """ Detections of many frames as a struct of arrays, see
+        openem.columnar.
+
+        Indexing by frame number gives a view behaving as the list of
+        Detection of that frame; Detection tuples are only built for the
+        rows accessed. The columns are contiguous arrays: location (N,4),
+        confidence (N,) or (N,classes), species (N,), frames (N,) and
+        video_id (N,).
+    """
+    columns = ('location', 'confidence', 'species', 'video_id')
+
+    def __init__(self, location, confidence, species, frame, video_id,
+                 frame_count=None, first_frame=0):
+        """ Create a batch from per-row arrays, in any frame order
+
+        frame_count: number of frames; defaults to up to the last frame
+                     with a detection
+        first_frame: frame number of the first frame
+        """
+        order = self._order(frame)
+        self.location = np.ascontiguousarray(location[order])
+        self.confidence = np.ascontiguousarray(confidence[order])
+        self.species = np.ascontiguousarray(species[order])
+        self.video_id = video_id[order]
+        super(DetectionBatch, self).__init__(frame[order],
+                                             frame_count,
+                                             first_frame)
+
+    @classmethod
+    def fromDetections(cls, detections, first_frame=0, video_id=None):
+        """ Create a batch from a list of lists of Detection, one list per
+            frame starting at `first_frame`. Rows without a video_id get
+            `video_id`. """
+        rows, frames = cls._flatten(detections, first_frame)
+        return cls(np.array([row.location for row in rows],
+                            dtype=np.float64).reshape(-1, 4),
+                   np.array([row.confidence for row in rows],
+                            dtype=np.float64),
+                   np.array([row.species for row in rows], dtype=np.int64),
+                   frames,
+                   np.array([video_id if row.video_id is None
+                             else row.video_id for row in rows],
+                            dtype=object),
+                   len(detections),
+                   first_frame)
+
+    def maxConfidence(self):
+        """ Returns the confidence of each detection; the highest class
+            confidence if there is one per class """
+        rows = self._rows()
+        if self.confidence.ndim == 2:
+            return np.max(self.confidence[rows], axis=1)
+        return self.confidence[rows]
+
+    def withConfidence(self, threshold):
+        """ Returns the detections with a confidence of at least
+            `threshold` """
+        return self.select(self.maxConfidence() >= threshold)
+
+    def withSpecies(self, species):
+        """ Returns the detections of a species, or any of a list of
+            species """
+        return self.select(np.isin(self.species[self._rows()], species))
+
+    def _record(self, row):
+        if self.confidence.ndim == 2:
+            confidence = self.confidence[row].tolist()
+        else:
+            confidence = float(self.confidence[row])
+        return Detection(location=self.location[row],
+                         confidence=confidence,
+                         species=int(self.species[row]),
+                         frame=int(self.frames[row]),
+                         video_id=self.video_id[row])
+
+    def _pandasColumns(self, rows):
+        columns = {'video_id': self.video_id[rows],
+                   'frame': self.frames[rows],
+                   'x': self.location[rows,0],
+                   'y': self.location[rows,1],
+                   'w': self.location[rows,2],
+                   'h': self.location[rows,3]}
+        if self.confidence.ndim == 2:
+            for idx in range(self.confidence.shape[1]):
+                columns[f'detection_conf_{idx}'] = self.confidence[rows,idx]
+        else:
+            columns['detection_conf'] = self.confidence[rows]
+        columns['detection_species'] = self.species[rows]
+        return columns
+
 # Bring in SSD detector to top-level
 from openem.Detect.SSD import SSDDetector
 
 class IO:
+    def load(filepath_like):
+        """ Load a detection CSV (or Parquet) file into a DetectionBatch.
+            Much faster than from_csv for long videos and accepted
+            wherever its list of lists is. """
+        _, columns = readColumns(filepath_like, str_columns=['video_id'])
+        location = np.stack([columns['x'],
+                             columns['y'],
+                             columns['w'],
+                             columns['h']], axis=1).astype(np.float64)
+        return DetectionBatch(
+            location,
+            columns['detection_conf'].astype(np.float64),
+            columns['detection_species'].astype(np.float64).astype(np.int64),
+            columns['frame'].astype(np.float64).astype(np.int64),
+            columns['video_id'].astype(str).astype(object))
+
     def from_csv(filepath_like):
         detections=[]
         with open(filepath_like, 'r') as csv_file:
@@ -0,0 +1,124 @@
+""" Detection restricted to the region around the ruler """
+import itertools
+import json
+import os
+
+from openem.FindRuler import RulerRoi
+
+class RoiDetector:
+    """ Runs a detector on the rectified region around the ruler only.
+
+        The region is found once per video from the ruler masks of its
+        first frames and cached. Every frame is then rectified and cropped
+        to the region in one warp before detection, so the network sees
+        fewer, more relevant pixels, and the detections are mapped back to
+        the original frame coordinates.
+    """
+    def __init__(self, detector, mask_finder, mask_frames=16, h_margin=0,
+                 cache_path=None):
+        """ Create a region of interest detection stage
+
+        detector: Detect.SSDDetector or Detect.RetinaNet.RetinaNetDetector
+        mask_finder: FindRuler.RulerMaskFinder
+        mask_frames: int
+                     Number of frames at the start of each video used to
+                     find the ruler
+        h_margin: int
+                  Margin in pixels around the ruler, see FindRuler.findRoi
+        cache_path: str
+                    Optional JSON file the regions are kept in between runs
+        """
+        self.detector = detector
+        self.mask_finder = mask_finder
+        self.mask_frames = mask_frames
+        self.h_margin = h_margin
+        self.cache_path = cache_path
+        self._rois = {}
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path, 'r') as cache_file:
+                for video_id, values in json.load(cache_file).items():
+                    if values is None:
+                        self._rois[video_id] = None
+                    else:
+                        self._rois[video_id] = RulerRoi.fromDict(values)
+
+    def _save(self):
+        if self.cache_path is None:
+            return
+        values = {video_id: None if roi is None else roi.toDict()
+                  for video_id, roi in self._rois.items()}
+        with open(self.cache_path, 'w') as cache_file:
+            json.dump(values, cache_file)
+
+    def findRoi(self, video_id, frames):
+        """ Returns the region of interest of a video, finding it from
+            `frames` unless it is already cached. None if there is no
+            ruler in view.
+
+        video_id: str
+                  Key the region is cached under
+        frames: iterable of the first frames of the video
+        """
+        if video_id in self._rois:
+            return self._rois[video_id]
+
+        masks = []
+        frame_shape = None
+        frame_iter = iter(frames)
+        batch_size = self.mask_finder.batch_size
+        for _ in range(0, self.mask_frames, batch_size):
+            chunk = list(itertools.islice(frame_iter, batch_size))
+            if len(chunk) == 0:
+                break
+            frame_shape = chunk[0].shape
+            self.mask_finder.addImages(chunk)
+            masks.extend(self.mask_finder.process())
+
+        roi = None
+        if len(masks) > 0:
+            roi = RulerRoi.fromMasks(masks, frame_shape, self.h_margin)
+        self._rois[video_id] = roi
+        self._save()
+        return roi
+
+    def detect(self, video_id, frames, batch_size=None, **kwargs):
+        """ Detect objects in the region of interest of each frame
+
+        video_id: str
+                  Video the frames are from; its region is found from the
+                  first frames if not cached
+        frames: iterable of np.ndarray frames
+        batch_size: frames per network batch; defaults to the detector's
+        kwargs: passed on to the detector's postprocessing, e.g. threshold
+
+        Yields a list of Detection per frame, in original frame
+        coordinates
+        """
+        frame_iter = iter(frames)
+        if video_id not in self._rois:
+            # Frames used to find the region are still detected
+            first = list(itertools.islice(frame_iter, self.mask_frames))
+            self.findRoi(video_id, first)
+            frame_iter = itertools.chain(first, frame_iter)
+        roi = self._rois[video_id]
+
+        if roi is None:
+            # No ruler; detect on the whole frame
+            roi_frames = frame_iter
+        else:
+            roi_frames = (roi.extract(frame) for frame in frame_iter)
+
+        for _, detections in self.detector.stream(roi_frames,
+                                                  batch_size,
+                                                  **kwargs):
+            if roi is None or len(detections) == 0:
+                yield list(detections)
+                continue
+            boxes = roi.mapBoxes([detection.location
+                                  for detection in detections])
+            mapped = []
+            for detection, box in zip(detections, boxes):
+                if type(detection.location) == list:
+                    box = box.tolist()
+                mapped.append(detection._replace(location=box))
+            yield mapped
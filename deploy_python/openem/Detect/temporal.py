@@ -0,0 +1,165 @@
+""" Temporal frame skipping for detection on video """
+import cv2
+import numpy as np
+
+class FrameSkipper:
+    """ Decides which frames of a video to run the detector on.
+
+        Fish move slowly relative to the frame rate, so the detector only
+        needs to run every few frames; the boxes in between are
+        interpolated with interpolateDetections. A frame is detected when
+        `interval` frames have passed since the last detected frame, or
+        sooner if the frame differs enough from the last detected one
+        (motion) or its histogram no longer matches (scene change).
+    """
+    def __init__(self, interval=5, motion_threshold=None,
+                 scene_threshold=None, thumbnail_size=(64,36)):
+        """ Create a frame skipper
+
+        interval : int
+                   Maximum number of frames between detections
+        motion_threshold : float
+                           If given, detect as soon as the mean absolute
+                           grey level difference (0-255) from the last
+                           detected frame exceeds this
+        scene_threshold : float
+                          If given, detect as soon as the histogram
+                          correlation with the last detected frame drops
+                          below this
+        thumbnail_size : tuple
+                         (width, height) frames are shrunk to before
+                         being compared
+        """
+        self.interval = interval
+        self.motion_threshold = motion_threshold
+        self.scene_threshold = scene_threshold
+        self.thumbnail_size = thumbnail_size
+        self.reset()
+
+    def reset(self):
+        """ Forget the last detected frame, e.g. at the start of a video """
+        self._last_frame = None
+        self._thumbnail = None
+        self._histogram = None
+
+    def _adaptive(self):
+        return self.motion_threshold is not None or \
+               self.scene_threshold is not None
+
+    def shouldDetect(self, frame_num, image=None, last=False):
+        """ Returns True if the detector should run on this frame
+
+        frame_num : int
+                    Frame number within the video
+        image : np.ndarray
+                The frame; only needed for motion or scene change detection
+        last : bool
+               Set for the last frame of a video so it is always detected
+               and no frames are left to extrapolate
+        """
+        detect = last or self._last_frame is None or \
+                 frame_num - self._last_frame >= self.interval
+
+        if self._adaptive() and image is not None:
+            thumbnail = cv2.cvtColor(cv2.resize(image, self.thumbnail_size,
+                                                interpolation=cv2.INTER_AREA),
+                                     cv2.COLOR_BGR2GRAY)
+            # Without a detected image to compare to, e.g. if the last
+            # detection was forced without one, this frame becomes it
+            if not detect and self.motion_threshold is not None:
+                if self._thumbnail is None:
+                    detect = True
+                else:
+                    motion = np.mean(cv2.absdiff(thumbnail, self._thumbnail))
+                    detect = motion > self.motion_threshold
+            histogram = None
+            if self.scene_threshold is not None:
+                histogram = cv2.calcHist([thumbnail], [0], None, [32],
+                                         [0, 256])
+                if not detect:
+                    if self._histogram is None:
+                        detect = True
+                    else:
+                        correlation = cv2.compareHist(histogram,
+                                                      self._histogram,
+                                                      cv2.HISTCMP_CORREL)
+                        detect = correlation < self.scene_threshold
+            if detect:
+                self._thumbnail = thumbnail
+                self._histogram = histogram
+
+        if detect:
+            self._last_frame = frame_num
+        return detect
+
+def _iou(boxes_a, boxes_b):
+    """ Intersection over union of every pair of (x, y, w, h) boxes """
+    a = boxes_a[:,None,:]
+    b = boxes_b[None,:,:]
+    width = np.minimum(a[...,0] + a[...,2], b[...,0] + b[...,2]) - \
+            np.maximum(a[...,0], b[...,0])
+    height = np.minimum(a[...,1] + a[...,3], b[...,1] + b[...,3]) - \
+             np.maximum(a[...,1], b[...,1])
+    intersection = np.maximum(width, 0) * np.maximum(height, 0)
+    union = a[...,2] * a[...,3] + b[...,2] * b[...,3] - intersection
+    return intersection / np.maximum(union, np.finfo(np.float64).eps)
+
+def interpolateDetections(start_frame, start_detections,
+                          end_frame, end_detections,
+                          iou_threshold=0.1):
+    """ Interpolate detections for the frames between two detected frames
+
+    Detections of the two frames are paired greedily by overlap and each
+    pair's box and confidence are linearly interpolated. Detections without
+    a partner are not carried into the skipped frames.
+
+    start_frame, end_frame : int
+                             Frame numbers of the detected frames
+    start_detections, end_detections : list of Detection
+                                       Detections of those frames
+    iou_threshold : float
+                    Minimum overlap for two detections to be paired
+
+    Returns a list with a list of Detection for each frame strictly between
+    start_frame and end_frame
+    """
+    skipped = end_frame - start_frame - 1
+    if skipped <= 0:
+        return []
+    results = [[] for _ in range(skipped)]
+    if len(start_detections) == 0 or len(end_detections) == 0:
+        return results
+
+    start_boxes = np.array([d.location for d in start_detections],
+                           dtype=np.float64)
+    end_boxes = np.array([d.location for d in end_detections],
+                         dtype=np.float64)
+    overlaps = _iou(start_boxes, end_boxes)
+    pairs = []
+    while True:
+        start_idx, end_idx = np.unravel_index(np.argmax(overlaps),
+                                              overlaps.shape)
+        if overlaps[start_idx, end_idx] < iou_threshold:
+            break
+        pairs.append((start_idx, end_idx))
+        overlaps[start_idx, :] = -1
+        overlaps[:, end_idx] = -1
+
+    for offset in range(skipped):
+        frame = start_frame + offset + 1
+        weight = (offset + 1) / (end_frame - start_frame)
+        for start_idx, end_idx in pairs:
+            start = start_detections[start_idx]
+            end = end_detections[end_idx]
+            location = (1 - weight) * start_boxes[start_idx] + \
+                       weight * end_boxes[end_idx]
+            confidence = (1 - weight) * np.array(start.confidence) + \
+                         weight * np.array(end.confidence)
+            if type(start.location) == list:
+                location = location.tolist()
+            if type(start.confidence) == list:
+                confidence = confidence.tolist()
+            results[offset].append(start._replace(location=location,
+                                                  confidence=confidence,
+                                                  frame=frame))
+    return results
@@ -0,0 +1,148 @@
+""" Tiled detection of high resolution frames """
+import collections
+import itertools
+import math
+
+import numpy as np
+
+from openem.Detect import nonMaxSuppression
+
+def _tileStarts(length, tile, overlap):
+    """ Returns evenly spaced start positions of tiles of size `tile`
+        covering `length` with at least `overlap` fractional overlap """
+    if length <= tile:
+        return [0]
+    count = math.ceil((length - tile) / (tile * (1.0 - overlap))) + 1
+    return [round(start) for start in np.linspace(0, length - tile, count)]
+
+def tileWindows(frame_shape, tile_shape, overlap=0.25, max_tiles=16):
+    """ Split a frame into overlapping tiles the size of the network input
+
+    Tiles are grown by a common factor until at most `max_tiles` cover the
+    frame, so the number of tiles per frame is bounded whatever the
+    resolution. Grown tiles are resized down to the network input as
+    usual.
+
+    frame_shape: (height, width) of the frame
+    tile_shape: (height, width) of the network input
+    overlap: minimum fraction of a tile shared with its neighbour
+    max_tiles: maximum number of tiles per frame
+
+    Returns a list of (x, y, width, height) windows
+    """
+    if max_tiles < 1:
+        raise ValueError(f"max_tiles must be at least 1, got {max_tiles}")
+    frame_height, frame_width = frame_shape[:2]
+    scale = 1.0
+    while True:
+        tile_height = min(frame_height, round(tile_shape[0] * scale))
+        tile_width = min(frame_width, round(tile_shape[1] * scale))
+        rows = _tileStarts(frame_height, tile_height, overlap)
+        columns = _tileStarts(frame_width, tile_width, overlap)
+        if len(rows) * len(columns) <= max_tiles:
+            break
+        if tile_height == frame_height and tile_width == frame_width:
+            # A single tile already covers the whole frame
+            break
+        scale *= 1.1
+    return [(x, y, tile_width, tile_height)
+            for y, x in itertools.product(rows, columns)]
+
+class TiledDetection:
+    """ Adds a tiled inference mode to a detector.
+
+        Small objects in a high resolution frame become a few pixels when
+        the whole frame is squeezed into the network input. detectTiled
+        instead runs the network on overlapping network-sized tiles, maps
+        the boxes back to frame coordinates and merges detections that
+        straddle tile seams with non-maximum suppression.
+    """
+    def detectTiled(self, frames, overlap=0.25, max_tiles=16,
+                    nms_threshold=0.5, batch_size=None, **kwargs):
+        """ Detect objects in frames by tiling them. See streamTiled for
+            the arguments.
+
+        Returns a list of Detection per frame
+        """
+        return list(self.streamTiled(frames, overlap, max_tiles,
+                                     nms_threshold, batch_size, **kwargs))
+
+    def streamTiled(self, frames, overlap=0.25, max_tiles=16,
+                    nms_threshold=0.5, batch_size=None, **kwargs):
+        """ Detect objects in an iterable of frames by tiling them, e.g. a
+            generator reading a long video.
+
+        Tiles are cut from each frame as it is read and streamed through
+        the network (see ImageModel.stream), so only the frames of the
+        batches in flight are held at once. A frame's detections are
+        merged as soon as the result of its last tile returns.
+
+        frames: iterable of np.ndarray frames
+        overlap: minimum fraction of a tile shared with its neighbour
+        max_tiles: maximum number of tiles per frame
+        nms_threshold: intersection over union above which overlapping
+                       detections from neighbouring tiles are merged
+        batch_size: tiles per network batch. Defaults to the model's.
+        frame: optional frame number of the first frame
+        video_id: optional video id of the frames
+        kwargs: passed on to the detector's postprocessing, e.g. threshold
+
+        Yields a list of Detection per frame, in order
+        """
+        frame = kwargs.pop('frame', None)
+        video_id = kwargs.pop('video_id', None)
+        tile_shape = self.inputShape()[1:3]
+
+        # Windows of the tiles read so far, consumed as cookies in step
+        # with the tiles themselves
+        windows = collections.deque()
+        def tiles():
+            for frame_idx, image in enumerate(frames):
+                frame_windows = tileWindows(image.shape, tile_shape,
+                                            overlap, max_tiles)
+                for tile_idx, window in enumerate(frame_windows):
+                    last = tile_idx == len(frame_windows) - 1
+                    windows.append((frame_idx, window, last))
+                    x, y, width, height = window
+                    yield image[y:y+height, x:x+width]
+        def cookies():
+            while True:
+                yield windows.popleft()
+
+        boxes = []
+        for (frame_idx, window, last), detections in self.stream(tiles(),
+                                                                 batch_size,
+                                                                 cookies(),
+                                                                 **kwargs):
+            x, y, _, _ = window
+            for detection in detections:
+                location = np.array(detection.location, dtype=np.float64)
+                location[:2] += (x, y)
+                boxes.append((location, detection))
+            if last:
+                if not frame is None:
+                    this_frame = frame + frame_idx
+                else:
+                    this_frame = None
+                yield self._mergeTiles(boxes, nms_threshold, this_frame,
+                                       video_id)
+                boxes = []
+
+    def _mergeTiles(self, boxes, nms_threshold, frame, video_id):
+        """ Merge the (frame location, Detection) of each tile of a frame
+            into the frame's list of Detection """
+        if len(boxes) == 0:
+            return []
+        locations = np.array([box[0] for box in boxes])
+        scores = np.array([np.max(box[1].confidence) for box in boxes])
+        keep = nonMaxSuppression(locations, scores, nms_threshold)
+        frame_detections = []
+        for idx in keep:
+            location, detection = boxes[idx]
+            if type(detection.location) == list:
+                location = location.tolist()
+            frame_detections.append(
+                detection._replace(location=location,
+                                   frame=frame,
+                                   video_id=video_id))
+        return frame_detections
@@ -8,17 +8,33 @@ from openem.image import crop
 
 class RulerMaskFinder(ImageModel):
     """ Class for finding ruler masks from raw images """
-    def __init__(self, model_path, image_dims=None):
-        super(RulerMaskFinder,self).__init__(model_path, image_dims, optimize=False)
-        self.preprocessor = Preprocessor(1.0 / 128.0, -np.ones(image_dims[-1]), True)
-    def addImage(self, image):
+    preprocessor=Preprocessor(1.0 / 128.0,
+                              -1.0,
+                              True)
+
+    def __init__(self, model_path, image_dims=None, **kwargs):
+        super(RulerMaskFinder,self).__init__(model_path,
+                                             image_dims,
+                                             optimize=False,
+                                             **kwargs)
+    def addImage(self, image, cookie=None):
         """ Add an image to process in the underlying ImageModel after
             running preprocessing on it specific to this model.
 
         image: np.ndarray the underlying image (not pre-processed) to add
                to the model's current batch
         """
-        return self._addImage(image, self.preprocessor)
+        return self._addImage(image, self.preprocessor, cookie)
+
+    def addImages(self, images, cookies=None):
+        """ Add a stack of same-sized images to process in the underlying
+            ImageModel, preprocessing them as a batch.
+
+        images: np.ndarray (N,H,W,C) or list of images to add to the model's
+                current batch
+        cookies: list of per-image cookies (or None)
+        """
+        return self._addImages(images, self.preprocessor, cookies)
 
     def process(self, postprocess=True):
         """ Runs the base ImageModel and does a high-pass filter only allowing
@@ -30,7 +46,14 @@ class RulerMaskFinder(ImageModel):
         model_masks, image_cookies = super(RulerMaskFinder,self).process()
         if model_masks is None:
             return None
+        with self._stage('postprocess'):
+            return self._postprocess(model_masks, image_cookies, postprocess)
 
+    def _streamResults(self, result, cookies, postprocess=True, **kwargs):
+        return self._postprocess(result, cookies, postprocess)
+
+    def _postprocess(self, model_masks, image_cookies, postprocess=True):
+        """ Scale (and optionally threshold) the raw network masks """
         mask_images = []
         num_masks = model_masks.shape[0]
         for idx in range(num_masks):
@@ -138,6 +161,19 @@ def rulerEndpoints(image_mask):
     inverse = np.vstack([inverse, [0,0,1]])
     return cv2.perspectiveTransform(endpoints, inverse)[0]
 
+def rectifyMatrix(image_shape, endpoints):
+    """ Returns the 2x3 affine transform used by rectify
+        image_shape: tuple
+               (height, width) of the image
+        endpoints: array
+                   Represents 2 pair of endpoints for a ruler
+    """
+    dst = np.array([[image_shape[1]*.1, image_shape[0]/2],
+                    [image_shape[1]*.9, image_shape[0]/2]])
+    rt_matrix,_ = cv2.estimateAffinePartial2D(endpoints,
+                                            dst)
+    return rt_matrix
+
 def rectify(image, endpoints):
     """ Rectifies an image such that the ruler(in endpoints) is flat
         image: array
@@ -145,10 +181,7 @@ def rectify(image, endpoints):
         endpoints: array
                    Represents 2 pair of endpoints for a ruler
     """
-    dst = np.array([[image.shape[1]*.1, image.shape[0]/2],
-                    [image.shape[1]*.9, image.shape[0]/2]])
-    rt_matrix,_ = cv2.estimateAffinePartial2D(endpoints,
-                                            dst)
+    rt_matrix = rectifyMatrix(image.shape, endpoints)
     return cv2.warpAffine(image,
                           rt_matrix,
                           (image.shape[1],image.shape[0]))
@@ -185,4 +218,89 @@ def findRoi(image_mask, h_margin):
 
     return (margined_roi[0], margined_roi[1], margined_roi[2],margined_roi[3])
 
+class RulerRoi:
+    """ Region of interest around the ruler of a video.
+
+        Rectifying a frame and cropping it to the region are folded into a
+        single affine warp, so each frame is only resampled once and only
+        the pixels of the region are written.
+    """
+    def __init__(self, endpoints, roi, frame_shape):
+        """ Create a region of interest
+
+        endpoints: array
+                   Ruler endpoints in the original frame, see rulerEndpoints
+        roi: tuple
+             (x,y,w,h) region in the rectified frame, see findRoi
+        frame_shape: tuple
+                     (height, width) of the original frame
+        """
+        self.endpoints = np.array(endpoints, dtype=np.float64)
+        self.roi = tuple(float(value) for value in roi)
+        self.frame_shape = tuple(frame_shape[:2])
+        self.matrix = rectifyMatrix(self.frame_shape, self.endpoints)
+        # Crop the same pixels as image.crop would
+        x0 = int(self.roi[0])
+        y0 = int(self.roi[1])
+        self.matrix[:,2] -= (x0, y0)
+        self.inverse = cv2.invertAffineTransform(self.matrix)
+        self.size = (int(self.roi[0] + self.roi[2]) - x0,
+                     int(self.roi[1] + self.roi[3]) - y0)
+
+    @classmethod
+    def fromMasks(cls, masks, frame_shape, h_margin=0):
+        """ Find the region of interest from ruler masks of several frames
+            of a video, as returned by RulerMaskFinder.process
+
+        masks: array
+               Ruler masks at the network size
+        frame_shape: tuple
+                     (height, width) of the original frames
+        h_margin: int
+                  Margin in pixels, see findRoi
+
+        Returns a RulerRoi, or None if no ruler is found
+        """
+        mask_avg = np.mean(np.array(masks, dtype=np.float64), axis=0)
+        mask_avg = cv2.resize(mask_avg, (frame_shape[1], frame_shape[0]))
+        if np.max(mask_avg) <= 0:
+            return None
+        mask_avg = (mask_avg * (255.0 / np.max(mask_avg))).astype(np.uint8)
+        if not rulerPresent(mask_avg):
+            return None
+        endpoints = rulerEndpoints(mask_avg)
+        roi = findRoi(rectify(mask_avg, endpoints), h_margin)
+        return cls(endpoints, roi, frame_shape)
+
+    def toDict(self):
+        """ Returns a dictionary of plain values, e.g. for a JSON cache """
+        return {'endpoints': self.endpoints.tolist(),
+                'roi': list(self.roi),
+                'frame_shape': list(self.frame_shape)}
+
+    @classmethod
+    def fromDict(cls, values):
+        """ Create a RulerRoi from the output of toDict """
+        return cls(values['endpoints'], values['roi'], values['frame_shape'])
+
+    def extract(self, frame, out=None):
+        """ Returns the rectified region of interest of a frame """
+        return cv2.warpAffine(frame, self.matrix, self.size, dst=out)
 
+    def mapBoxes(self, boxes):
+        """ Map (x,y,w,h) boxes in the region back to the original frame.
+            Rectification rotates the frame, so each box becomes the
+            bounding box of its rotated corners. """
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        x0 = boxes[:,0]
+        y0 = boxes[:,1]
+        x1 = x0 + boxes[:,2]
+        y1 = y0 + boxes[:,3]
+        corners = np.stack([np.stack([x0, y0], axis=1),
+                            np.stack([x1, y0], axis=1),
+                            np.stack([x0, y1], axis=1),
+                            np.stack([x1, y1], axis=1)], axis=1)
+        mapped = corners @ self.inverse[:,:2].T + self.inverse[:,2]
+        low = np.min(mapped, axis=1)
+        high = np.max(mapped, axis=1)
+        return np.concatenate([low, high - low], axis=1)
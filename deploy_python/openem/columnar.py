@@ -0,0 +1,215 @@
+""" Columnar storage of per-frame results such as detections
+
+Results files hold one row per object with a frame column. Rather than a
+list of lists of namedtuples, a FrameTable keeps each column as a single
+numpy array sorted by frame, plus the offset of each frame's first row.
+Indexing a table by frame returns a lightweight FrameView that only builds
+namedtuples for the rows actually accessed. Tables can also be filtered by
+row and converted to pandas without building any namedtuples.
+"""
+import csv
+import os
+
+import numpy as np
+
+def readColumns(filepath_like, str_columns=()):
+    """ Read a CSV or Parquet file into numpy arrays
+
+    CSV files are parsed with pandas when it is installed, else with the
+    csv module. Parquet files (*.parquet) require pyarrow.
+
+    str_columns: names or positions of CSV columns to keep as strings, such
+                 as ids that may look numeric. Other columns are parsed as
+                 numbers where they can be.
+
+    Returns a tuple of (column names, dictionary of name to np.ndarray)
+    """
+    if os.path.splitext(str(filepath_like))[1] == '.parquet':
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("pyarrow is required to read parquet files")
+        table = pq.read_table(filepath_like)
+        names = table.column_names
+        return names, {name: table.column(name).to_numpy()
+                       for name in names}
+
+    try:
+        import pandas as pd
+    except ImportError:
+        pd = None
+
+    with open(filepath_like, 'r') as csv_file:
+        reader = csv.reader(csv_file)
+        names = next(reader)
+        if pd is None:
+            rows = list(reader)
+    str_names = {names[column] if isinstance(column, int) else column
+                 for column in str_columns}
+
+    if pd is not None:
+        frame = pd.read_csv(filepath_like,
+                            dtype={name: str for name in str_names})
+        return names, {name: frame[name].to_numpy() for name in names}
+
+    columns = {}
+    for idx, name in enumerate(names):
+        values = [row[idx] for row in rows]
+        if name in str_names:
+            columns[name] = np.array(values, dtype=object)
+            continue
+        try:
+            columns[name] = np.array(values, dtype=np.float64)
+        except ValueError:
+            columns[name] = np.array(values)
+    return names, columns
+
+class FrameView:
+    """ Rows of a single frame of a FrameTable; behaves as a list of the
+        table's namedtuple type """
+    def __init__(self, table, start, stop):
+        self._table = table
+        self._start = start
+        self._stop = stop
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(len(self))[idx]]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("frame row index out of range")
+        return self._table._record(self._start + idx)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def rows(self):
+        """ Returns the slice of the table's row arrays for this frame """
+        return slice(self._start, self._stop)
+
+    def column(self, name):
+        """ Returns a view of one of the table's row arrays for this frame,
+            e.g. view.column('location') """
+        return getattr(self._table, name)[self.rows()]
+
+class FrameTable:
+    """ Base class for columnar per-frame results.
+
+        Behaves as a list with one entry per frame, from frame 0 to the
+        last frame in the file, as the row based IO.from_csv functions
+        return. Subclasses list their row arrays in `columns`, hold them
+        as attributes and implement `_record` to build the namedtuple of a
+        row.
+    """
+    columns = ()
+
+    def __init__(self, frames, frame_count=None, first_frame=0):
+        """ frames: frame number of each row, sorted
+            frame_count: number of frames; defaults to up to the last frame
+                         with a row
+            first_frame: frame number of the first frame
+        """
+        self.frames = frames
+        if frame_count is None:
+            frame_count = int(frames[-1]) + 1 - first_frame \
+                          if len(frames) else 0
+        self.first_frame = first_frame
+        self.offsets = np.searchsorted(
+            frames,
+            np.arange(first_frame, first_frame + frame_count + 1),
+            side='left')
+
+    @staticmethod
+    def _order(frames):
+        """ Returns the row order sorting rows by frame, keeping file
+            order within a frame """
+        return np.argsort(frames, kind='stable')
+
+    def _slice(self, start, stop):
+        """ Returns a table of frames start to stop sharing this table's
+            rows """
+        table = object.__new__(type(self))
+        table.__dict__.update(self.__dict__)
+        table.offsets = self.offsets[start:stop+1]
+        table.first_frame = self.first_frame + start
+        return table
+
+    def _rows(self):
+        """ Returns the slice of the row arrays covered by this table """
+        return slice(int(self.offsets[0]), int(self.offsets[-1]))
+
+    def select(self, mask):
+        """ Returns a new table with only the rows where `mask` is true,
+            keeping every frame
+
+        mask: boolean array with one entry per row of this table
+        """
+        rows = self._rows()
+        table = object.__new__(type(self))
+        table.__dict__.update(self.__dict__)
+        for name in self.columns:
+            setattr(table, name, getattr(self, name)[rows][mask])
+        FrameTable.__init__(table,
+                            self.frames[rows][mask],
+                            len(self),
+                            self.first_frame)
+        return table
+
+    def toPandas(self):
+        """ Returns the rows as a pandas DataFrame whose columns share
+            memory with this table's arrays where pandas allows """
+        import pandas as pd
+        return pd.DataFrame(self._pandasColumns(self._rows()), copy=False)
+
+    def _pandasColumns(self, rows):
+        """ Returns a dictionary of column name to 1-D array for toPandas """
+        raise NotImplementedError
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step != 1:
+                raise ValueError("Only contiguous frame slices supported")
+            stop = max(start, stop)
+            return self._slice(start, stop)
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("frame index out of range")
+        return FrameView(self, int(self.offsets[idx]),
+                         int(self.offsets[idx+1]))
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def counts(self):
+        """ Returns the number of rows in each frame """
+        return np.diff(self.offsets)
+
+    def first(self):
+        """ Returns the row index of the first row of each frame, -1 for
+            frames without rows """
+        return np.where(self.counts() > 0, self.offsets[:-1], -1)
+
+    @staticmethod
+    def _flatten(frame_lists, first_frame):
+        """ Returns the rows of a list of lists of namedtuples, one list
+            per frame, and the frame number of each row """
+        rows = []
+        frames = []
+        for idx, frame_rows in enumerate(frame_lists):
+            rows.extend(frame_rows)
+            frames.extend([first_frame + idx] * len(frame_rows))
+        return rows, np.array(frames, dtype=np.int64)
+
+    def _record(self, row):
+        raise NotImplementedError
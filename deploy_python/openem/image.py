@@ -82,3 +82,77 @@ def force_aspect(image, required_aspect_ratio):
         image,sf = resize_and_fill(image, (new_img_height, img_width))
     assert math.isclose(sf[0],1.0) and math.isclose(sf[1],1.0)
     return image
+
+def aspect_padded_shape(image_shape, required_aspect_ratio):
+    """ Returns the (height, width) of an image after force_aspect pads it
+        to the given aspect ratio (width / height) """
+    img_height = image_shape[0]
+    img_width = image_shape[1]
+    img_aspect = img_width / img_height
+    if math.isclose(required_aspect_ratio, img_aspect):
+        return (img_height, img_width)
+    if img_aspect < required_aspect_ratio:
+        return (img_height, round(img_height * required_aspect_ratio))
+    return (round(img_width / required_aspect_ratio), img_width)
+
+def letterbox(image, desired_shape, out=None):
+    """
+    Resize an image to a desired shape (height,width) maintaining its aspect
+    ratio, in a single pass. As with force_aspect followed by a resize, the
+    right or bottom is filled with black; but no padded or float copy of the
+    full frame is made and the image keeps its type.
+
+    :param image: ndarray of the image
+    :param desired_shape: tuple describing the output shape
+    :param out: optional preallocated output of the desired shape and the
+                image's type
+
+    :returns image_resized,scale,offset:
+
+    image_resized is ndarray represented the scaled + padded image
+
+    scale (y,x) factor to apply to a pixel coordinate in the original to
+          land on the new image.
+
+    offset (y,x) of the original's origin in the new image; padding is on
+           the far sides so this is always (0,0).
+    """
+    desired_height = desired_shape[0]
+    desired_width = desired_shape[1]
+    padded_shape = aspect_padded_shape(image.shape,
+                                       desired_width / desired_height)
+    scale_y = desired_height / padded_shape[0]
+    scale_x = desired_width / padded_shape[1]
+
+    # Same pixel center alignment and edge handling as cv2.resize
+    matrix = np.array([[scale_x, 0, 0.5 * scale_x - 0.5],
+                       [0, scale_y, 0.5 * scale_y - 0.5]])
+    image_resized = cv2.warpAffine(image, matrix,
+                                   (desired_width, desired_height),
+                                   dst=out,
+                                   flags=cv2.INTER_LINEAR,
+                                   borderMode=cv2.BORDER_REPLICATE)
+
+    # Fade the image's far edge into the black bar, as interpolating the
+    # padded image would
+    if padded_shape[0] != image.shape[0]:
+        _fade_edge(image_resized, image.shape[0], scale_y, 0)
+    if padded_shape[1] != image.shape[1]:
+        _fade_edge(image_resized, image.shape[1], scale_x, 1)
+    return image_resized, (scale_y, scale_x), (0, 0)
+
+def _fade_edge(image, size, scale, axis):
+    """ Blend the rows or columns of a resized image past the original's
+        last pixel into black """
+    src = (np.arange(image.shape[axis]) + 0.5) / scale - 0.5
+    weight = np.clip(size - src, 0.0, 1.0)
+    start = np.searchsorted(-weight, -1.0, side='right')
+    edge = [slice(None)] * image.ndim
+    edge[axis] = slice(start, None)
+    edge = tuple(edge)
+    shape = [1] * image.ndim
+    shape[axis] = -1
+    faded = image[edge] * weight[start:].reshape(shape)
+    if np.issubdtype(image.dtype, np.integer):
+        faded = np.rint(faded)
+    image[edge] = faded
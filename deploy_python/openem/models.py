@@ -5,8 +5,14 @@ import os
 import tensorflow as tf
 import numpy as np
 import cv2
-from .optimizer import optimizeGraph
-from multiprocessing import Queue, RawArray, Value
+from .optimizer import optimizeGraph, optimizeGraphCpu
+from .profiling import NULL_STAGE
+import multiprocessing
+from concurrent.futures import Future, ThreadPoolExecutor
+import itertools
+import queue
+import threading
+import time
 import ctypes
 
 logger = logging.getLogger(__name__)
@@ -52,14 +58,573 @@ class Preprocessor:
 
         return image
 
-class ImageModel:
-    """ Base class for serving image-related models from tensorflow """
+    def resize(self, image, requiredWidth, requiredHeight, out=None):
+        """ Run only the geometric preprocessing steps, keeping the image
+            in its original type, for models that do the rest in the graph
+            (see graphTransform)
+
+        out : np.ndarray
+              Optional destination of shape (requiredHeight, requiredWidth,
+              C) and the image's type
+        """
+        if image.shape[0] != requiredHeight or image.shape[1] != requiredWidth:
+            if out is not None and out.dtype == image.dtype:
+                return cv2.resize(image, (requiredWidth, requiredHeight),
+                                  dst=out)
+            image = cv2.resize(image, (requiredWidth, requiredHeight))
+        if out is None:
+            return image
+        out[:] = image
+        return out
+
+    def graphTransform(self, tensor):
+        """ Returns the tensorflow equivalent of the steps after resize,
+            converting a raw image tensor to the network's float32 input
+
+        tensor : tf.Tensor
+                 Batch of resized images, e.g. uint8 (N,H,W,C)
+        """
+        image = tf.cast(tensor, tf.float32)
+        if self.rgb:
+            # BGR(A) to RGB(A) leaves alpha where it is
+            channels = int(image.shape[-1])
+            image = tf.gather(image, [2,1,0] + list(range(3, channels)),
+                              axis=-1)
+        if self.scale is not None:
+            image = image * self.scale
+        if self.bias is not None:
+            image = image + np.asarray(self.bias, dtype=np.float32)
+        return image
+
+    def batch(self, images, requiredWidth, requiredHeight, out=None):
+        """ Run the preprocessing steps on a stack of same-sized images,
+            writing the result into a single float32 batch tensor.
+
+        images : np.ndarray (N,H,W,C) or sequence of images with the same
+                 shape
+        out : np.ndarray
+              Optional preallocated float32 destination of shape
+              (N, requiredHeight, requiredWidth, C). Allocated if None.
+
+        Returns the batch tensor
+        """
+        count = len(images)
+        channels = images[0].shape[2]
+        if out is None:
+            out = np.empty((count, requiredHeight, requiredWidth, channels),
+                           dtype=np.float32)
+
+        # Fold the channel swap, scale and bias into a single affine
+        # transform applied per pixel: dst = M[:,:-1] * src + M[:,-1]
+        affine = np.zeros((channels, channels + 1), dtype=np.float32)
+        affine[:, :channels] = np.eye(channels)
+        if self.rgb:
+            # BGR(A) to RGB(A) leaves alpha where it is
+            affine[[0,2], :] = affine[[2,0], :]
+        if self.scale is not None:
+            affine[:, :channels] *= self.scale
+        if self.bias is not None:
+            affine[:, channels] = self.bias
+
+        # Scratch buffer is reused for each resize to avoid allocations
+        resized = None
+        for idx in range(count):
+            image = images[idx]
+            if image.shape[0] != requiredHeight or \
+               image.shape[1] != requiredWidth:
+                resized = cv2.resize(image,
+                                     (requiredWidth, requiredHeight),
+                                     dst=resized)
+                image = resized
+
+            # Assignment into the batch does the float32 cast, the rest is
+            # done in place in one pass
+            out[idx] = image
+            cv2.transform(out[idx], affine, dst=out[idx])
+
+        return out
+
+class FrameRing:
+    """ Ring of fixed-shape frame slots in shared memory.
+
+        Slots are handed between producer and consumer processes by index
+        over two queues; the frame data itself never goes through a queue.
+        Free slots are recycled in FIFO order so they are normally filled
+        and consumed in ring order, which lets a batch of consecutive slots
+        be handed to tensorflow as a view of the ring without a copy.
+    """
+    def __init__(self, slot_count, shape, dtype=np.float32, context=None):
+        """ Allocate the shared memory backing the ring
+
+        slot_count : int
+                     Number of frames the ring can hold
+        shape : tuple
+                Shape of a single frame, e.g. (<height>, <width>, <channels>)
+        dtype : np.dtype
+                Element type of a frame; np.uint8 or np.float32
+        context : multiprocessing context
+                  Context of the processes sharing the ring. Defaults to
+                  the multiprocessing default.
+        """
+        if context is None:
+            context = multiprocessing.get_context()
+        self.slot_count = slot_count
+        self.shape = tuple(int(dim) for dim in shape)
+        self.dtype = np.dtype(dtype)
+        slot_elements = int(np.prod(self.shape))
+        self._raw = context.RawArray(np.ctypeslib.as_ctypes_type(self.dtype),
+                                     slot_count * slot_elements)
+        self._free = context.Queue(maxsize=slot_count)
+        self._ready = context.Queue(maxsize=slot_count)
+        for idx in range(slot_count):
+            self._free.put(idx)
+        self._array = None
+        self._staging = None
+
+    def __getstate__(self):
+        # Views are per-process; they are rebuilt on first access
+        state = self.__dict__.copy()
+        state['_array'] = None
+        state['_staging'] = None
+        return state
+
+    @property
+    def nbytes(self):
+        """ Size of the shared memory backing the ring in bytes """
+        return ctypes.sizeof(self._raw)
+
+    def array(self):
+        """ Returns a (slot_count, *shape) view over every slot """
+        if self._array is None:
+            self._array = np.frombuffer(self._raw, dtype=self.dtype).reshape(
+                (self.slot_count, *self.shape))
+        return self._array
+
+    def slot(self, idx):
+        """ Returns a writable view of a single slot """
+        return self.array()[idx]
+
+    def slots(self, indices):
+        """ Returns a writable view of the given slots if they are
+            consecutive in the ring, else None """
+        start = indices[0]
+        if list(indices) != list(range(start, start + len(indices))):
+            return None
+        return self.array()[start:start+len(indices)]
+
+    def acquire(self):
+        """ Blocks until a free slot is available and returns its index """
+        return self._free.get()
+
+    def commit(self, idx, cookie=None):
+        """ Mark a filled slot as ready to be consumed """
+        self._ready.put((idx, cookie, time.time()))
+
+    def ready(self):
+        """ Returns the (approximate) number of slots ready to consume """
+        return self._ready.qsize()
+
+    def collect(self, count, max_wait=None, timeout=None):
+        """ Collect up to `count` ready slots without relying on qsize
+
+        count : int
+                Maximum number of slots to collect
+        max_wait : float
+                   Seconds after the first collected slot was committed to
+                   stop waiting for more. If None, waits for all `count`.
+        timeout : float
+                  Seconds to wait for the first slot. If None, blocks.
+
+        Returns a list of (index, cookie, commit_time) tuples, which is empty
+        if the timeout expired.
+        """
+        msgs = []
+        try:
+            msgs.append(self._ready.get(timeout=timeout))
+        except queue.Empty:
+            return msgs
+
+        deadline = None
+        if max_wait is not None:
+            deadline = msgs[0][2] + max_wait
+        while len(msgs) < count:
+            try:
+                if deadline is None:
+                    msg = self._ready.get()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining > 0:
+                        msg = self._ready.get(timeout=remaining)
+                    else:
+                        # Past the deadline only take what is already there
+                        msg = self._ready.get_nowait()
+            except queue.Empty:
+                break
+            msgs.append(msg)
+        return msgs
+
+    def gather(self, indices, count=None, out=None):
+        """ Returns the given slots as one contiguous batch
+
+        indices : list of int
+                  Slots to include, in order
+        count : int
+                Length of the returned batch, if larger than indices the
+                remaining frames are padding with undefined contents.
+        out : np.ndarray
+              Optional staging array of at least `count` frames to gather
+              into if the slots are not consecutive. Defaults to one owned by
+              the ring.
+
+        The batch is a view of the ring when the slots are consecutive,
+        otherwise they are gathered into the staging array. Either way it is
+        only valid until the slots are released.
+        """
+        if count is None:
+            count = len(indices)
+        start = indices[0]
+        if start + count <= self.slot_count:
+            batch = self.slots(indices)
+            if batch is not None:
+                return self.array()[start:start+count]
+
+        if out is None:
+            if self._staging is None or len(self._staging) < count:
+                self._staging = np.empty((count, *self.shape),
+                                         dtype=self.dtype)
+            out = self._staging
+        np.take(self.array(), indices, axis=0, out=out[:len(indices)])
+        return out[:count]
+
+    def take(self, count, out=None):
+        """ Blocks until `count` slots are ready and returns them as a batch
+
+        out : np.ndarray
+              Optional staging array of at least `count` frames to gather
+              into if the slots wrap. Defaults to one owned by the ring.
+
+        Returns a tuple of (batch, indices, cookies). See gather for the
+        lifetime of the batch.
+        """
+        msgs = self.collect(count)
+        indices = [msg[0] for msg in msgs]
+        cookies = [msg[1] for msg in msgs]
+        return self.gather(indices, out=out), indices, cookies
+
+    def release(self, indices):
+        """ Return consumed slots to the free list """
+        for idx in indices:
+            self._free.put(idx)
+
+def sessionConfig(gpu_fraction=1.0, cpu_only=False, cpu_threads=None):
+    """ Returns the tensorflow session configuration used by openem models
+
+    gpu_fraction : float
+                   Fraction of GPU allowed to be used by the session
+    cpu_only : bool
+               If true the session will only use the CPU
+    cpu_threads : int
+                  If given, limits the threads used within each CPU op
+    """
+    if cpu_only is True:
+        config = tf.compat.v1.ConfigProto(device_count = {'GPU' : 0})
+    else:
+        config = tf.compat.v1.ConfigProto()
+        config.gpu_options.allow_growth = True
+        config.gpu_options.per_process_gpu_memory_fraction = gpu_fraction
+    if cpu_threads is not None:
+        config.intra_op_parallelism_threads = cpu_threads
+        config.inter_op_parallelism_threads = 1
+    return config
+
+def loadGraphDef(model_path):
+    """ Load a frozen protobuf off of disk into a graph definition """
+    with tf.io.gfile.GFile(model_path, 'rb') as graph_file:
+        graph_def = tf.compat.v1.GraphDef()
+        graph_def.ParseFromString(graph_file.read())
+    return graph_def
+
+def graphInputShape(graph_def, input_name):
+    """ Returns the shape of an input placeholder of a graph definition as
+        a list, without importing the graph into a session """
+    node_name = input_name.split(':')[0]
+    for node in graph_def.node:
+        if node.name == node_name:
+            return tf.TensorShape(node.attr['shape'].shape).as_list()
+    raise ValueError(f"Graph has no input {input_name}")
+
+def prependInputTransform(graph_def, input_name, transform,
+                          dtype=tf.uint8):
+    """ Returns a graph definition taking raw images, converted to the
+        original float input by nodes prepended to the graph
+
+    Feeding uint8 frames instead of float32 ones quarters the bytes copied
+    into the session per frame, and the conversion runs on the device.
+
+    graph_def : tf.compat.v1.GraphDef
+                Frozen graph to prepend to
+    input_name : str
+                 Name of the tensor that serves as the image input
+    transform : callable
+                Builds the float input from the raw input tensor, e.g.
+                Preprocessor.graphTransform
+    dtype : tf.DType
+            Type of the new input
+
+    Returns a tuple of (graph definition, name of the new input tensor)
+    """
+    node_name = input_name.split(':')[0]
+    input_node = next(node for node in graph_def.node
+                      if node.name == node_name)
+    shape = tf.TensorShape(input_node.attr['shape'].shape)
+    graph = tf.Graph()
+    with graph.as_default():
+        raw_input = tf.compat.v1.placeholder(dtype,
+                                             shape=shape,
+                                             name=f"{node_name}_{dtype.name}")
+        # Scoped so prepended nodes can't clash with the graph's own
+        with tf.name_scope(f"{node_name}_transform"):
+            image = transform(raw_input)
+        tf.import_graph_def(graph_def,
+                            input_map={input_name: image},
+                            name='')
+    return graph.as_graph_def(), raw_input.name
+
+def importGraph(graph_def, return_elements, registry=None, name=None):
+    """ Import a graph definition and return the requested tensors
+
+    registry : models.ModelRegistry
+               If given, the graph is imported into the registry's shared
+               graph under the name scope `name`. Otherwise it goes into the
+               default graph.
+    """
+    if registry is None:
+        return tf.import_graph_def(graph_def,
+                                   return_elements=return_elements)
+    return registry.load(name, graph_def, return_elements)
+
+class ModelRegistry:
+    """ Shares one tensorflow graph and session between several models.
+
+        Each model's frozen graph is imported under its own name scope, so
+        a full pipeline (e.g. ruler, detect, classify, count) pays for a
+        single session startup and a single GPU memory reservation. Pass
+        the registry to each model's constructor; the models keep their
+        usual addImage / process interface.
+    """
+    def __init__(self, gpu_fraction=1.0, cpu_only=False):
+        """ Create the shared graph and session
+
+        gpu_fraction : float
+                       Fraction of GPU allowed to be used by all the models
+        cpu_only : bool
+                   If true will only use CPU for inference
+        """
+        self.cpu_only = cpu_only
+        self.graph = tf.Graph()
+        self.session = tf.compat.v1.Session(
+            graph=self.graph,
+            config=sessionConfig(gpu_fraction, cpu_only))
+        self.names = []
+
+    def load(self, name, graph_def, return_elements):
+        """ Import a graph definition under the name scope `name`
+
+        Returns the tensors named in return_elements, as
+        tf.import_graph_def does.
+        """
+        with self.graph.as_default():
+            # Same name twice gets a numbered scope, e.g. Classifier_1
+            scope = self.graph.unique_name(name, mark_as_used=False)
+            tensors = tf.import_graph_def(graph_def,
+                                          return_elements=return_elements,
+                                          name=scope)
+        self.names.append(scope)
+        return tensors
+
+class TensorflowModel:
+    """ Base class holding the tensorflow session and graph of a model.
+
+        Handles what every openem model shares: creating (or sharing via a
+        ModelRegistry) the session, optimizing the frozen graph for
+        TensorRT or the CPU, and timing session runs with a profiler.
+    """
     tf_session = None
     input_tensor = None
     input_shape = None
     output_tensor = None
     gpu_pid = None
     batch_size = None
+    optimizer_args = None
+    # Set if the graph was converted with TensorRT
+    tensorrt = False
+    profiler = None
+
+    def _loadGraph(self, model_path, gpu_fraction, input_name, output_name,
+                   optimize, optimizer_args, cpu_only, registry, name,
+                   graph_cache, cpu_optimizer_args, cpu_threads,
+                   input_transform=None):
+        """ Create the session and import the model's graph into it,
+            setting tf_session, input_tensor, output_tensor and input_shape.
+            See ImageModel for the arguments.
+
+        input_transform : callable
+                          If given, the graph is fed raw uint8 input which
+                          this converts to the original input in the graph
+                          (see prependInputTransform)
+        """
+        self.gpu_pid = os.getpid()
+        self.optimizer_args = optimizer_args
+
+        if registry is None:
+            # Create session first with requested gpu_fraction parameter
+            self.tf_session = tf.compat.v1.Session(
+                config=sessionConfig(gpu_fraction, cpu_only, cpu_threads))
+        else:
+            self.tf_session = registry.session
+            cpu_only = registry.cpu_only
+
+        # Load graph off of disk into a graph definition
+        graph_def = loadGraphDef(model_path)
+
+        if type(output_name) == list:
+            sensitive_nodes = output_name
+        else:
+            sensitive_nodes = [output_name]
+        if cpu_optimizer_args is not None and \
+           (cpu_only or not tf.test.is_gpu_available(cuda_only=True)):
+            graph_def = optimizeGraphCpu(graph_def,
+                                         [input_name],
+                                         sensitive_nodes,
+                                         cpu_optimizer_args,
+                                         cache=graph_cache)
+        elif optimize and not cpu_only:
+            graph_def = optimizeGraph(graph_def,
+                                      sensitive_nodes,
+                                      optimizer_args,
+                                      cache=graph_cache)
+            # Without a GPU the graph is passed through unconverted
+            self.tensorrt = tf.test.is_gpu_available(cuda_only=True)
+        if input_transform is not None:
+            graph_def, input_name = prependInputTransform(graph_def,
+                                                          input_name,
+                                                          input_transform)
+
+        if type(output_name) == list:
+            return_elements = [input_name, *output_name]
+        else:
+            return_elements = [input_name, output_name]
+
+        if name is None:
+            name = type(self).__name__
+        tensors = importGraph(graph_def, return_elements, registry, name)
+
+        # The first is an input
+        self.input_tensor = tensors[0]
+        # The rest are outputs
+        if type(output_name) == list:
+            self.output_tensor = tensors[1:]
+        else:
+            self.output_tensor = tensors[1]
+
+        self.input_shape = self.input_tensor.get_shape().as_list()
+
+    def setProfiler(self, profiler):
+        """ Record stage timings with a profiling.Profiler. Pass None to
+            stop profiling. """
+        self.profiler = profiler
+
+    def _stage(self, name):
+        """ Returns a context manager timing a stage of inference if a
+            profiler is attached """
+        if self.profiler is None:
+            return NULL_STAGE
+        return self.profiler.stage(name)
+
+    def _runSession(self, inputs):
+        """ Run the network on a batch of inputs, profiling the run if a
+            profiler is attached """
+        options, run_metadata = None, None
+        if self.profiler is not None:
+            options, run_metadata = self.profiler.runOptions()
+        with self._stage('session_run'):
+            result = self.tf_session.run(
+                self.output_tensor,
+                feed_dict={self.input_tensor: inputs},
+                options=options,
+                run_metadata=run_metadata)
+        if run_metadata is not None:
+            self.profiler.addRunMetadata(run_metadata)
+        return result
+
+class SequenceModel(TensorflowModel):
+    """ Base class for serving models of sequences of per-frame features
+        from tensorflow, such as the keyframe finder.
+
+        Inputs are (steps, features) arrays built by the subclass rather
+        than images, so there is no frame ring; runSequences feeds them to
+        the network at most batch_size at a time.
+    """
+    def __init__(self, model_path,
+                 gpu_fraction = 1.0,
+                 input_name = 'input_1:0',
+                 output_name = 'output_node0:0',
+                 optimize = False,
+                 optimizer_args = None,
+                 batch_size = 1,
+                 cpu_only = False,
+                 registry = None,
+                 name = None,
+                 graph_cache = None,
+                 cpu_optimizer_args = None,
+                 cpu_threads = None):
+        """ Initialize a sequence model object. See ImageModel for the
+            arguments; batch_size is the maximum number of sequences run
+            at once. Unlike image models the graph is only converted with
+            TensorRT if `optimize` is set, since the FP16 conversion changes
+            the network's outputs and adds to startup time.
+        """
+        self.batch_size = batch_size
+        self._loadGraph(model_path, gpu_fraction, input_name, output_name,
+                        optimize, optimizer_args, cpu_only, registry, name,
+                        graph_cache, cpu_optimizer_args, cpu_threads)
+
+    def sequenceLength(self):
+        """ Returns the number of steps in a sequence input """
+        return int(self.input_shape[1])
+
+    def featureCount(self):
+        """ Returns the number of features of each step """
+        return int(self.input_shape[2])
+
+    def runSequences(self, sequences):
+        """ Run the network on a list of (steps, features) sequences,
+            batch_size at a time.
+
+        Returns the network output for every sequence, concatenated along
+        the batch axis (a list of them for multiple outputs). None if the
+        process has changed since the model was loaded.
+        """
+        if os.getpid() != self.gpu_pid:
+            logger.error("Tensorflow crossed process boundary")
+            return None
+
+        results = []
+        for start in range(0, len(sequences), self.batch_size):
+            batch = np.array(sequences[start:start+self.batch_size])
+            results.append(self._runSession(batch))
+        if type(self.output_tensor) == list:
+            return [np.concatenate(tensors) for tensors in zip(*results)]
+        return np.concatenate(results)
+
+class ImageModel(TensorflowModel):
+    """ Base class for serving image-related models from tensorflow """
+    async_depth = None
+    scheduler = None
+    preprocessor = None
+    uint8_input = False
+    _preprocess_batch = None
+    _executor = None
 
     def __init__(self, model_path,
                  image_dims = None,
@@ -69,7 +634,17 @@ class ImageModel:
                  optimize = True,
                  optimizer_args = None,
                  batch_size = 1,
-                 cpu_only=False):
+                 cpu_only=False,
+                 async_depth = 2,
+                 registry = None,
+                 name = None,
+                 graph_cache = None,
+                 cpu_optimizer_args = None,
+                 cpu_threads = None,
+                 ring = None,
+                 uint8_input = False,
+                 frontend = False,
+                 ring_context = None):
         """ Initialize an image model object
         model_path : str or path-like object
                      Path to the frozen protobuf of the tensorflow graph
@@ -90,68 +665,87 @@ class ImageModel:
                      Maximum number of images to process as a batch
         cpu_only: bool
                   If true will only use CPU for inference
+        async_depth : int
+                      Maximum number of batches in flight at once when
+                      using processAsync
+        registry : models.ModelRegistry
+                   If given, the graph is imported into the registry's
+                   shared session instead of a new one. gpu_fraction and
+                   cpu_only are then taken from the registry.
+        name : str
+               Name scope of the graph within the registry. Defaults to
+               the class name.
+        graph_cache : optimizer.GraphCache
+                      If given, the optimized graph is loaded from or stored
+                      in this cache instead of being converted every time.
+        cpu_optimizer_args : dict
+                             If given, the graph is optimized for the CPU
+                             with these arguments (see
+                             optimizer.optimizeGraphCpu) when running CPU
+                             only or when no GPU is available.
+        cpu_threads : int
+                      If given, limits the threads used within each CPU op
+        ring : models.FrameRing
+               Existing frame ring to consume from (e.g. one shared with
+               other processes) instead of allocating a new one
+        uint8_input : bool
+                      If true, frames are only resized on the host and fed
+                      to the graph as uint8; the model's preprocessor's
+                      conversion to float is prepended to the graph (see
+                      prependInputTransform). The model's preprocessor must
+                      be set before this is called.
+        frontend : bool
+                   If true, no session is created and only the graph's input
+                   shape is read. The model can then only add images to its
+                   ring for models in other processes to run (see
+                   pool.InferencePool).
+        ring_context : multiprocessing context
+                       Context of the processes the new frame ring is
+                       shared with, see FrameRing
         """
 
-        self.gpu_pid = os.getpid()
         self.batch_size = batch_size
+        self.async_depth = async_depth
 
-        # Create session first with requested gpu_fraction parameter
-        if cpu_only is True:
-            config = tf.compat.v1.ConfigProto(device_count = {'GPU' : 0})
+        input_transform = None
+        if uint8_input:
+            if self.preprocessor is None:
+                raise ValueError("uint8_input requires the model's "
+                                 "preprocessor")
+            input_transform = self.preprocessor.graphTransform
+        self.uint8_input = uint8_input
+        if frontend:
+            self.gpu_pid = os.getpid()
+            self.optimizer_args = optimizer_args
+            self.input_shape = graphInputShape(loadGraphDef(model_path),
+                                               input_name)
         else:
-            config = tf.compat.v1.ConfigProto()
-            config.gpu_options.allow_growth = True
-            config.gpu_options.per_process_gpu_memory_fraction = gpu_fraction
-        self.tf_session = tf.compat.v1.Session(config=config)
-
-        with tf.io.gfile.GFile(model_path, 'rb') as graph_file:
-            # Load graph off of disk into a graph definition
-            graph_def = tf.compat.v1.GraphDef()
-            graph_def.ParseFromString(graph_file.read())
-            #for node in graph_def.node:
-            #   print(f"{node.name}")
-
-            if optimize and not cpu_only:
-                if type(output_name) == list:
-                    sensitive_nodes = output_name
-                else:
-                    sensitive_nodes = [output_name]
-                graph_def = optimizeGraph(graph_def,
-                                          sensitive_nodes,
-                                          optimizer_args)
-            if type(output_name) == list:
-                return_elements = [input_name, *output_name]
-                tensors = tf.import_graph_def(
-                    graph_def,
-                    return_elements=return_elements)
-                # The first is an input
-                self.input_tensor = tensors[0]
-                # The rest are outputs
-                self.output_tensor = tensors[1:]
-            else:
-                return_elements = [input_name, output_name]
-                self.input_tensor, self.output_tensor = tf.import_graph_def(
-                    graph_def,
-                    return_elements=return_elements)
-
-            self.input_shape = self.input_tensor.get_shape().as_list()
-
-            if image_dims is None:
-                image_dims = (self.input_shape[1],
-                              self.input_shape[2],
-                              self.input_shape[3])
-                print(f"Inferred image dims = {image_dims}")
-            # Each channel is 1 byte, width * height * # of channels
-            image_size_in_bytes = image_dims[0] * image_dims[1] * image_dims[2]
-            # Initialize the shared memory buffer
-            buffer_count=batch_size * 4
-            self._buffers=[]
-            self._inputQueue = Queue(maxsize=buffer_count)
-            self._processQueue = Queue(maxsize=buffer_count)
-            for buffer_num in range(buffer_count):
-                self._buffers.append(RawArray(ctypes.c_uint8, image_size_in_bytes*8))
-                self._inputQueue.put(buffer_num)
+            self._loadGraph(model_path, gpu_fraction, input_name,
+                            output_name, optimize, optimizer_args, cpu_only,
+                            registry, name, graph_cache, cpu_optimizer_args,
+                            cpu_threads, input_transform)
 
+        if image_dims is None:
+            image_dims = (self.input_shape[1],
+                          self.input_shape[2],
+                          self.input_shape[3])
+            print(f"Inferred image dims = {image_dims}")
+        elif len(image_dims) == 2:
+            image_dims = (*image_dims, self.input_shape[3])
+
+        # Initialize the shared memory frame ring; frames are stored
+        # preprocessed (or just resized for uint8 input) so they can be fed
+        # to the network directly. Leave room for every in flight batch
+        # plus one being filled.
+        ring_dtype = np.uint8 if uint8_input else np.float32
+        if ring is None:
+            slot_count = batch_size * max(4, async_depth + 2)
+            ring = FrameRing(slot_count, image_dims, ring_dtype,
+                             context=ring_context)
+        elif ring.dtype != ring_dtype:
+            raise ValueError(f"Frame ring holds {ring.dtype} frames, "
+                             f"model expects {np.dtype(ring_dtype)}")
+        self._ring = ring
 
     def inputShape(self):
         """ Returns the shape of the input image for this network """
@@ -165,14 +759,80 @@ class ImageModel:
                    Preprocessing logic to apply to image prior to insertion
             cookie: Extra info to pass back to caller based on image
         """
-        processed_image = preprocessor(image,
-                                       self.inputShape()[2],
-                                       self.inputShape()[1])
-        
-        idx = self._inputQueue.get()
-        flat = np.frombuffer(self._buffers[idx])
-        flat[:] = processed_image.reshape(-1)
-        self._processQueue.put((idx, cookie))
+        with self._stage('ring_acquire'):
+            idx = self._ring.acquire()
+        with self._stage('preprocess'):
+            if self.uint8_input:
+                # Resize straight into the ring; the graph does the rest
+                preprocessor.resize(image,
+                                    self.inputShape()[2],
+                                    self.inputShape()[1],
+                                    out=self._ring.slot(idx))
+            else:
+                self._ring.slot(idx)[:] = preprocessor(image,
+                                                       self.inputShape()[2],
+                                                       self.inputShape()[1])
+        self._ring.commit(idx, cookie)
+
+    def _addImages(self, images, preprocessor, cookies=None):
+        """ Adds a stack of same-sized images into the next to process
+            batch, preprocessing them together.
+            images: np.ndarray or list of np.ndarray
+                   Image data to add into the batch
+            preprocessor: models.Preprocessor
+                   Preprocessing logic to apply to images prior to insertion.
+                   Must implement `batch`, or `resize` for uint8 input.
+            cookies: list of extra info to pass back to caller per image
+        """
+        if cookies is None:
+            cookies = [None] * len(images)
+
+        # Never hold more slots than a batch at a time so a consumer
+        # can always make progress
+        for start in range(0, len(images), self.batch_size):
+            chunk = images[start:start+self.batch_size]
+            count = len(chunk)
+            with self._stage('ring_acquire'):
+                indices = [self._ring.acquire() for _ in range(count)]
+            # Preprocess straight into the ring unless the slots wrap
+            out = self._ring.slots(indices)
+            wrapped = out is None
+            if wrapped:
+                out = self._preprocessBatch(count)
+            with self._stage('preprocess'):
+                if self.uint8_input:
+                    for idx, image in enumerate(chunk):
+                        preprocessor.resize(image,
+                                            self.inputShape()[2],
+                                            self.inputShape()[1],
+                                            out=out[idx])
+                    processed = out
+                else:
+                    processed = preprocessor.batch(chunk,
+                                                   self.inputShape()[2],
+                                                   self.inputShape()[1],
+                                                   out=out)
+            for idx, slot_idx in enumerate(indices):
+                if wrapped:
+                    self._ring.slot(slot_idx)[:] = processed[idx]
+                self._ring.commit(slot_idx, cookies[start+idx])
+
+    def _preprocessBatch(self, count):
+        """ Returns a reusable tensor of the ring's type to preprocess
+            `count` images into """
+        shape = (self.batch_size, *self._ring.shape)
+        if self._preprocess_batch is None or \
+           self._preprocess_batch.shape != shape:
+            self._preprocess_batch = np.empty(shape, dtype=self._ring.dtype)
+        return self._preprocess_batch[:count]
+
+    def setScheduler(self, scheduler):
+        """ Form batches dynamically with a scheduler.BatchScheduler
+            whenever process is called without a batch size. Pass None to
+            go back to processing whatever is ready. """
+        if scheduler is not None:
+            scheduler.attach(self)
+        self.scheduler = scheduler
 
     def process(self, batch_size=None):
         """ Process the current batch of image(s).
@@ -183,30 +843,207 @@ class ImageModel:
             logger.error("Tensorflow crossed process boundary")
             return None,None
 
+        if batch_size is None and self.scheduler is not None:
+            return self._processScheduled()
+
         if batch_size is None:
             # Default to whatever is ready to process
-            batch_size = self._processQueue.qsize()
+            batch_size = self._ring.ready()
 
         if batch_size == 0:
             return None,None
 
-        images=[]
-        image_indices=[]
-        image_cookies=[]
-        for idx in range(batch_size):
-            msg = self._processQueue.get()
-            if msg is not None:
-                image_idx = msg[0]
-                cookie = msg[1]
-                image_indices.append(image_idx)
-                image_cookies.append(cookie)
-                flat = np.frombuffer(self._buffers[image_idx])
-                images.append(flat.reshape(self.inputShape()[1:]))
-        result = self.tf_session.run(
-            self.output_tensor,
-            feed_dict={self.input_tensor: np.array(images)})
-
-        # Return image buffers to the free queue
-        for idx in image_indices:
-            self._inputQueue.put(idx)
+        with self._stage('ring_wait'):
+            images, image_indices, image_cookies = \
+                self._ring.take(batch_size)
+        return self._run(images, image_indices, image_cookies)
+
+    def _postprocess(self, result, cookies):
+        """ Convert the raw network output of a batch into this model's
+            results. Subclasses override this; by default the raw
+            (result, cookies) tuple is returned. """
+        return result, cookies
+
+    def _processScheduled(self):
+        """ Process the next batch formed by the scheduler, dropping the
+            results for any padding """
+        with self._stage('ring_wait'):
+            images, image_indices, image_cookies, commit_times = \
+                self.scheduler.next(self._ring)
+        if images is None:
+            return None,None
+
+        result, image_cookies = self._run(images,
+                                          image_indices,
+                                          image_cookies)
+        count = len(image_indices)
+        if len(images) != count:
+            if type(result) == list:
+                result = [tensor[:count] for tensor in result]
+            else:
+                result = result[:count]
+        self.scheduler.record(commit_times, len(images))
+        return result, image_cookies
+
+    def _streamResults(self, result, cookies, **kwargs):
+        """ Returns a list with one result per image of a batch for stream.
+            By default these are each image's rows of the raw network
+            output, as a list with one per tensor for multiple outputs.
+            Models with postprocessing override this. """
+        if type(result) == list:
+            return [list(tensors) for tensors in zip(*result)]
+        return list(result)
+
+    def stream(self, frames, batch_size=None, cookies=None, **kwargs):
+        """ Run the model over an iterable of frames, yielding results in
+            order as they become available.
+
+        Frames are read and preprocessed into the frame ring on a background
+        thread while the network runs on the previous batch. Only a few
+        batches are ever held at once, so arbitrarily long videos run in
+        constant memory. The model's addImages is used, so frames within a
+        batch should be the same size.
+
+        frames : iterable of np.ndarray
+                 Images to process, e.g. a generator reading a video
+        batch_size : int
+                     Frames per batch. Defaults to the model's batch size.
+        cookies : iterable
+                  Per-frame cookies to yield with each result. Defaults to
+                  the frame number.
+        kwargs : Passed on to the model's postprocessing
+
+        Yields (cookie, result) tuples
+        """
+        if os.getpid() != self.gpu_pid:
+            logger.error("Tensorflow crossed process boundary")
+            return
+
+        if batch_size is None:
+            batch_size = self.batch_size
+        # Keep at least two batches worth of room in the ring
+        batch_size = max(1, min(batch_size, self._ring.slot_count // 2))
+        if cookies is None:
+            cookies = itertools.count()
+
+        # Batch sizes that have been added but not processed; bounded so the
+        # reader never runs far ahead
+        batch_counts = queue.Queue(maxsize=2)
+        stop = threading.Event()
+        def produce():
+            try:
+                frame_iter = iter(frames)
+                cookie_iter = iter(cookies)
+                while not stop.is_set():
+                    chunk = list(itertools.islice(frame_iter, batch_size))
+                    if len(chunk) == 0:
+                        break
+                    # Subclasses add their own info to dictionary cookies
+                    chunk_cookies = [{"stream": next(cookie_iter)}
+                                     for _ in chunk]
+                    self.addImages(chunk, chunk_cookies)
+                    batch_counts.put(len(chunk))
+                batch_counts.put(None)
+            except Exception as e:
+                batch_counts.put(e)
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+
+        try:
+            while True:
+                count = batch_counts.get()
+                if count is None:
+                    break
+                if isinstance(count, Exception):
+                    raise count
+                with self._stage('ring_wait'):
+                    images, indices, batch_cookies = self._ring.take(count)
+                result, batch_cookies = self._run(images,
+                                                  indices,
+                                                  batch_cookies)
+                with self._stage('postprocess'):
+                    results = self._streamResults(result,
+                                                  batch_cookies,
+                                                  **kwargs)
+                for cookie, image_result in zip(batch_cookies, results):
+                    yield cookie["stream"], image_result
+        finally:
+            # If the caller stopped early the reader may be blocked on a
+            # full ring; discard frames until it notices and exits
+            stop.set()
+            while producer.is_alive():
+                try:
+                    batch_counts.get_nowait()
+                except queue.Empty:
+                    pass
+                self._drain()
+            self._drain()
+
+    def _drain(self):
+        """ Discard any frames waiting in the ring """
+        msgs = self._ring.collect(self._ring.slot_count,
+                                  max_wait=0,
+                                  timeout=0.01)
+        self._ring.release([msg[0] for msg in msgs])
+
+    def processAsync(self, batch_size=None):
+        """ Submit the current batch of image(s) to run in the background.
+
+        Up to `async_depth` batches run at once, each holding its own ring
+        slots, so producers can keep filling frames while the accelerator
+        is busy. Blocks while `async_depth` batches are already in flight.
+
+        Returns a concurrent.futures.Future resolving to the same
+        (result, cookies) tuple as process.
+        """
+        if os.getpid() != self.gpu_pid:
+            logger.error("Tensorflow crossed process boundary")
+            return None
+
+        if batch_size is None:
+            batch_size = self._ring.ready()
+
+        if batch_size == 0:
+            future = Future()
+            future.set_result((None,None))
+            return future
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.async_depth)
+            # Each in flight batch gets its own staging buffer in case its
+            # slots wrap around the end of the ring
+            self._free_staging = queue.Queue()
+            self._staging = []
+            for staging_idx in range(self.async_depth):
+                self._staging.append(
+                    np.empty((self.batch_size, *self._ring.shape),
+                             dtype=self._ring.dtype))
+                self._free_staging.put(staging_idx)
+
+        staging_idx = self._free_staging.get()
+        if len(self._staging[staging_idx]) < batch_size:
+            self._staging[staging_idx] = np.empty(
+                (batch_size, *self._ring.shape),
+                dtype=self._ring.dtype)
+        with self._stage('ring_wait'):
+            images, image_indices, image_cookies = self._ring.take(
+                batch_size,
+                out=self._staging[staging_idx])
+
+        def run():
+            try:
+                return self._run(images, image_indices, image_cookies)
+            finally:
+                self._free_staging.put(staging_idx)
+        return self._executor.submit(run)
+
+    def _run(self, images, image_indices, image_cookies):
+        """ Run the network on a batch taken from the ring and release its
+            slots """
+        try:
+            result = self._runSession(images)
+        finally:
+            # Return image buffers to the free queue; the feed has been
+            # copied into the session by the time run returns
+            self._ring.release(image_indices)
         return result, image_cookies
@@ -3,22 +3,274 @@ Module to define optomizing a graph prior to loading into a session
 
 Defaults to using TensorRT, if not available, will revert to passing through
 the original graph. This allows for code to run on platforms without tensorrt.
+For CPU-only inference `optimizeGraphCpu` runs the tensorflow graph transform
+tool instead.
+
+Optimized graphs can be cached on disk with a `GraphCache` so the conversion
+only runs the first time a given graph is loaded with a given set of
+arguments.
 """
 
+import hashlib
+import logging
+import os
+import tempfile
+import time
+
 import tensorflow as tf
-def optimizeGraph(graph_def, output_nodes, user_trt_args=None):
+
+logger = logging.getLogger(__name__)
+
+# Defaults passed to TrtGraphConverter; user arguments override these
+TRT_DEFAULTS={'is_dynamic_op':True,
+              'maximum_cached_engines':10,
+              'minimum_segment_size': 6,
+              'max_batch_size':4}
+
+# Graph transforms run for CPU inference, in order
+CPU_TRANSFORMS=['strip_unused_nodes',
+                'remove_nodes(op=Identity, op=CheckNumerics)',
+                'fold_constants(ignore_errors=true)',
+                'fold_batch_norms',
+                'fold_old_batch_norms',
+                'fuse_pad_and_conv',
+                'merge_duplicate_nodes',
+                'sort_by_execution_order']
+
+# Appended to the CPU transforms to store weights as int8
+QUANTIZE_TRANSFORMS=['quantize_weights']
+
+CPU_DEFAULTS={'transforms': CPU_TRANSFORMS,
+              'quantize': False}
+
+def engineBatchSizes(batch_size, user_trt_args=None, tensorrt=True):
+    """ Returns the batch sizes worth padding to for a graph optimized with
+        `user_trt_args` and run with batches of at most `batch_size`.
+
+        Dynamic TensorRT engines are built and cached per input shape, so
+        keeping to a few power of two sizes (plus the largest) means each
+        engine is built once and reused, up to `maximum_cached_engines`.
+        No size exceeds the engines' `max_batch_size`. If the graph was not
+        converted with TensorRT (`tensorrt` is False) the engine limits do
+        not apply and sizes go up to `batch_size`.
+    """
+    trt_args = dict(TRT_DEFAULTS)
+    if user_trt_args:
+        trt_args.update(user_trt_args)
+    if tensorrt:
+        batch_size = min(batch_size, trt_args['max_batch_size'])
+    sizes = []
+    size = 1
+    while size < batch_size:
+        sizes.append(size)
+        size *= 2
+    sizes.append(batch_size)
+    if not tensorrt:
+        return sizes
+    # Prefer the larger sizes if there are more than the engine cache holds
+    return sizes[-trt_args['maximum_cached_engines']:]
+
+class GraphCache:
+    """ On-disk cache of optimized graph definitions.
+
+        Entries are keyed by a hash of the input graph, the output nodes,
+        the optimizer arguments and the kind of optimization (TensorRT or
+        CPU) so a changed model or setting never loads a stale graph.
+        Least recently used entries are evicted once the cache exceeds
+        `max_bytes`, and any entry older than `max_age` seconds is dropped.
+    """
+    def __init__(self, path=None, max_bytes=4*1024**3, max_age=30*24*3600):
+        """ Open (creating if needed) a cache directory
+
+        path : str
+               Directory to store graphs in. Defaults to $OPENEM_GRAPH_CACHE
+               or ~/.cache/openem/graphs
+        max_bytes : int
+                    Maximum total size of the cache in bytes
+        max_age : float
+                  Maximum age of an entry in seconds since it was last used
+        """
+        if path is None:
+            path = os.getenv('OPENEM_GRAPH_CACHE',
+                             os.path.join(os.path.expanduser('~'),
+                                          '.cache', 'openem', 'graphs'))
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, graph_def, output_nodes, args, mode):
+        """ Returns the cache key for a graph optimized with `args` """
+        digest = hashlib.sha256()
+        digest.update(graph_def.SerializeToString(deterministic=True))
+        digest.update(repr(sorted(output_nodes)).encode())
+        digest.update(repr(sorted((args or {}).items(),
+                                  key=lambda item: item[0])).encode())
+        digest.update(mode.encode())
+        digest.update(tf.version.VERSION.encode())
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, f"{key}.pb")
+
+    def get(self, key):
+        """ Returns the cached graph definition for `key` or None """
+        entry = self._entry(key)
+        try:
+            with open(entry, 'rb') as graph_file:
+                graph_def = tf.compat.v1.GraphDef()
+                graph_def.ParseFromString(graph_file.read())
+        except (OSError, ValueError):
+            return None
+        # Mark as recently used for eviction purposes
+        os.utime(entry)
+        return graph_def
+
+    def put(self, key, graph_def):
+        """ Store a graph definition under `key` and apply eviction """
+        # Write to a temporary file first so concurrent readers never see
+        # a partially written graph
+        handle, temp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as graph_file:
+            graph_file.write(graph_def.SerializeToString())
+        os.replace(temp_path, self._entry(key))
+        self.evict()
+
+    def evict(self):
+        """ Remove expired entries, then the least recently used until the
+            cache fits in max_bytes """
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.pb'):
+                continue
+            entry = os.path.join(self.path, name)
+            try:
+                stat = os.stat(entry)
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.max_age:
+                _remove(entry)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            _remove(entry)
+            total -= size
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _nodeNames(output_nodes):
+    """ Strip tensor suffixes (e.g. ':0') to get node names """
+    return [node.split(':')[0] for node in output_nodes]
+
+def _prune(graph_def, output_nodes):
+    """ Prune the graph to what is needed to compute the outputs """
+    graph_def = tf.compat.v1.graph_util.remove_training_nodes(
+        graph_def,
+        protected_nodes=_nodeNames(output_nodes))
+    return tf.compat.v1.graph_util.extract_sub_graph(
+        graph_def,
+        _nodeNames(output_nodes))
+
+def _cached(cache, graph_def, output_nodes, args, mode, optimize):
+    """ Run `optimize(graph_def)` through the cache, if there is one """
+    if cache is None:
+        return optimize(graph_def)
+
+    key = cache.key(graph_def, output_nodes, args, mode)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    optimized = optimize(graph_def)
+    if optimized is not graph_def:
+        cache.put(key, optimized)
+    return optimized
+
+def optimizeGraph(graph_def, output_nodes, user_trt_args=None, cache=None):
+    """ Optimize a graph definition for inference
+
+    graph_def : tf.compat.v1.GraphDef
+                Frozen graph to optimize
+    output_nodes : list of str
+                   Nodes that must be preserved by the optimization
+    user_trt_args : dict
+                    Overrides for the TensorRT converter arguments
+    cache : GraphCache
+            If given, previously optimized graphs are loaded from the cache
+            and newly optimized ones are stored in it.
+    """
     if tf.test.is_gpu_available(cuda_only=True) is False:
         print("No GPU available to optimize for")
+        if cache is None:
+            return graph_def
+        # Nothing to convert, but a pruned graph is still worth caching
+        return _cached(cache, graph_def, output_nodes, None, 'prune',
+                       lambda graph_def: _prune(graph_def, output_nodes))
+
+    return _cached(cache, graph_def, output_nodes, user_trt_args, 'tensorrt',
+                   lambda graph_def: _optimizeTensorRT(graph_def,
+                                                       output_nodes,
+                                                       user_trt_args))
+
+def optimizeGraphCpu(graph_def, input_nodes, output_nodes, user_cpu_args=None,
+                     cache=None):
+    """ Optimize a graph definition for inference on the CPU
+
+    Runs the tensorflow graph transform tool to strip training-only nodes,
+    fold constants and batch norms into the preceding convolutions and fuse
+    padding into convolutions. Optionally quantizes weights to 8 bits.
+
+    graph_def : tf.compat.v1.GraphDef
+                Frozen graph to optimize
+    input_nodes : list of str
+                  Input nodes of the graph
+    output_nodes : list of str
+                   Nodes that must be preserved by the optimization
+    user_cpu_args : dict
+                    Overrides for CPU_DEFAULTS:
+                    'quantize': bool, store weights as int8
+                    'transforms': list of str, transforms to run
+    cache : GraphCache
+            If given, previously optimized graphs are loaded from the cache
+            and newly optimized ones are stored in it.
+    """
+    cpu_args = dict(CPU_DEFAULTS)
+    if user_cpu_args:
+        cpu_args.update(user_cpu_args)
+    transforms = list(cpu_args['transforms'])
+    if cpu_args['quantize']:
+        transforms += QUANTIZE_TRANSFORMS
+
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+    except ImportError:
+        logger.warning("Graph transform tool not available, not optimizing "
+                       "graph for CPU")
         return graph_def
+
+    def optimize(graph_def):
+        return TransformGraph(graph_def,
+                              _nodeNames(input_nodes),
+                              _nodeNames(output_nodes),
+                              transforms)
+
+    return _cached(cache, graph_def, output_nodes, cpu_args, 'cpu', optimize)
+
+def _optimizeTensorRT(graph_def, output_nodes, user_trt_args=None):
     try:
         from tensorflow.python.compiler.tensorrt import trt_convert as trt
         tensor_rt_args={'input_graph_def':graph_def,
                         'nodes_blacklist':output_nodes,
                         'precision_mode':trt.TrtPrecisionMode.FP16,
-                        'is_dynamic_op':True,
-                        'maximum_cached_engines':10,
-                        'minimum_segment_size': 6,
-                        'max_batch_size':4}
+                        **TRT_DEFAULTS}
         if user_trt_args:
             tensor_rt_args.update(user_trt_args)
         converter = trt.TrtGraphConverter(**tensor_rt_args)
@@ -26,4 +278,3 @@ def optimizeGraph(graph_def, output_nodes, user_trt_args=None):
     except:
         print("WARNING: Unable to optomize graph.")
         return graph_def
-    
@@ -0,0 +1,149 @@
+""" Data-parallel inference across several processes """
+import multiprocessing
+import os
+import queue
+import traceback
+
+class InferencePool:
+    """ Runs copies of an ImageModel in several worker processes.
+
+        ImageModel.process only runs in the process that created the model,
+        so a single model leaves most cores of a large CPU server idle. The
+        pool builds a front end of the model in the calling process, which
+        has no session and only preprocesses frames into a shared frame
+        ring, plus one full copy per worker process, each with its own
+        session, consuming from that same ring.
+
+        Workers take whole batches off the ring in turn. `process` returns
+        the results one batch at a time in the order frames were added, in
+        the same form the model's own process method returns them, so the
+        pool can stand in for a single model.
+    """
+    def __init__(self, model_class, *args, workers=None, max_wait=0.05,
+                 **kwargs):
+        """ Start the worker processes
+
+        model_class : class
+                      ImageModel subclass to run, e.g. Detect.SSDDetector
+        args, kwargs : Arguments to construct model_class with. Unless
+                       given, cpu_only is set and cpu_threads is split
+                       evenly between the workers.
+        workers : int
+                  Number of worker processes. Defaults to the CPU count.
+        max_wait : float
+                   Seconds a worker waits for a batch to fill before
+                   running a partial one
+        """
+        if workers is None:
+            workers = os.cpu_count()
+        kwargs.setdefault('cpu_only', True)
+        kwargs.setdefault('cpu_threads', max(1, os.cpu_count() // workers))
+        self._pending = 0
+        self._next_batch = 0
+        self._done = {}
+
+        # Workers are spawned rather than forked so none of them inherit
+        # the tensorflow state of this process
+        context = multiprocessing.get_context('spawn')
+        self._lock = context.Lock()
+        self._counter = context.Value('l', 0)
+        self._results = context.Queue()
+        self._stop = context.Event()
+        # Only the preprocessing front end runs here; it allocates the ring
+        # shared with the workers
+        self.model = model_class(*args,
+                                 frontend=True,
+                                 ring_context=context,
+                                 **kwargs)
+        kwargs['ring'] = self.model._ring
+        self._workers = []
+        for _ in range(workers):
+            worker = context.Process(target=_worker,
+                                     args=(model_class,
+                                           args,
+                                           kwargs,
+                                           self.model.batch_size,
+                                           max_wait,
+                                           self._lock,
+                                           self._counter,
+                                           self._results,
+                                           self._stop),
+                                     daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def inputShape(self):
+        """ Returns the shape of the input image for the network """
+        return self.model.inputShape()
+
+    def addImage(self, *args, **kwargs):
+        """ Add an image, see the model's addImage """
+        self._pending += 1
+        return self.model.addImage(*args, **kwargs)
+
+    def addImages(self, images, *args, **kwargs):
+        """ Add a stack of same-sized images, see the model's addImages """
+        self._pending += len(images)
+        return self.model.addImages(images, *args, **kwargs)
+
+    def process(self):
+        """ Returns the results of the next batch in frame order, blocking
+            until a worker has finished it. With no frames outstanding this
+            returns whatever the model returns for an empty batch. """
+        if self._pending == 0:
+            return self.model.process()
+
+        while self._next_batch not in self._done:
+            try:
+                msg = self._results.get(timeout=1.0)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self._workers):
+                    raise RuntimeError("Inference worker exited")
+                continue
+            batch_no, count, output, error = msg
+            if error is not None:
+                raise RuntimeError(f"Inference worker failed:\n{error}")
+            self._done[batch_no] = (count, output)
+
+        count, output = self._done.pop(self._next_batch)
+        self._next_batch += 1
+        self._pending -= count
+        return output
+
+    def close(self):
+        """ Stop the worker processes """
+        self._stop.set()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+def _worker(model_class, args, kwargs, batch_size, max_wait, lock, counter,
+            results, stop):
+    """ Worker process main loop for InferencePool """
+    try:
+        model = model_class(*args, **kwargs)
+    except Exception:
+        results.put((None, 0, None, traceback.format_exc()))
+        return
+
+    ring = model._ring
+    while not stop.is_set():
+        # Numbering batches under the same lock used to take them keeps
+        # batch numbers in the order the frames were added
+        with lock:
+            msgs = ring.collect(batch_size, max_wait=max_wait, timeout=0.1)
+            if len(msgs) == 0:
+                continue
+            batch_no = counter.value
+            counter.value += 1
+
+        indices = [msg[0] for msg in msgs]
+        cookies = [msg[1] for msg in msgs]
+        try:
+            result, cookies = model._run(ring.gather(indices),
+                                         indices,
+                                         cookies)
+            output = model._postprocess(result, cookies)
+            results.put((batch_no, len(indices), output, None))
+        except Exception:
+            results.put((batch_no, len(indices), None, traceback.format_exc()))
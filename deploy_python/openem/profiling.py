@@ -0,0 +1,127 @@
+""" Lightweight profiling of openem inference stages """
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+import tensorflow as tf
+
+# Returned by ImageModel._stage when no profiler is attached
+NULL_STAGE = contextlib.nullcontext()
+
+class Profiler:
+    """ Records how long each stage of inference takes.
+
+        Attach to a model with its `setProfiler`. Stages recorded
+        include preprocessing, waits on the frame ring, `session.run` and
+        model specific postprocessing. Every `trace_every` batches the
+        session run also collects tensorflow step stats, which are merged
+        into the Chrome trace.
+    """
+    def __init__(self, trace_every=0, max_events=100000):
+        """ Create a profiler
+
+        trace_every : int
+                      Collect tensorflow RunMetadata for one in every
+                      `trace_every` batches. 0 disables it.
+        max_events : int
+                     Number of most recent timed events kept for the
+                     Chrome trace
+        """
+        self.trace_every = trace_every
+        self._lock = threading.Lock()
+        self._totals = collections.defaultdict(lambda: [0, 0.0, 0.0])
+        self._events = collections.deque(maxlen=max_events)
+        self._step_stats = []
+        self._runs = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Context manager timing the enclosed block as stage `name` """
+        start = time.time()
+        before = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - before
+            with self._lock:
+                totals = self._totals[name]
+                totals[0] += 1
+                totals[1] += duration
+                totals[2] = max(totals[2], duration)
+                self._events.append((name,
+                                     start,
+                                     duration,
+                                     threading.get_ident()))
+
+    def runOptions(self):
+        """ Returns (options, run_metadata) for the next session run; both
+            are None unless this run is sampled for tensorflow step stats """
+        with self._lock:
+            self._runs += 1
+            sample = self.trace_every and self._runs % self.trace_every == 0
+        if not sample:
+            return None, None
+        options = tf.compat.v1.RunOptions(
+            trace_level=tf.compat.v1.RunOptions.FULL_TRACE)
+        return options, tf.compat.v1.RunMetadata()
+
+    def addRunMetadata(self, run_metadata):
+        """ Keep the step stats of a sampled session run """
+        with self._lock:
+            self._step_stats.append(run_metadata.step_stats)
+
+    def stats(self):
+        """ Returns a dictionary of stage name to count, total, mean and max
+            seconds """
+        with self._lock:
+            return {name: {'count': count,
+                           'total': total,
+                           'mean': total / count,
+                           'max': longest}
+                    for name, (count, total, longest) in self._totals.items()}
+
+    def summary(self):
+        """ Returns a table of stage timings, most expensive first """
+        stats = self.stats()
+        grand_total = sum(stage['total'] for stage in stats.values())
+        lines = [f"{'stage':<20}{'count':>10}{'total ms':>12}"
+                 f"{'mean ms':>10}{'max ms':>10}{'%':>7}"]
+        for name, stage in sorted(stats.items(),
+                                  key=lambda item: item[1]['total'],
+                                  reverse=True):
+            percent = 100.0 * stage['total'] / grand_total
+            lines.append(f"{name:<20}{stage['count']:>10}"
+                         f"{stage['total']*1000:>12.1f}"
+                         f"{stage['mean']*1000:>10.2f}"
+                         f"{stage['max']*1000:>10.2f}"
+                         f"{percent:>7.1f}")
+        return '\n'.join(lines)
+
+    def chromeTrace(self, path):
+        """ Write recorded events (and any tensorflow step stats) as a
+            Chrome trace JSON file, viewable in chrome://tracing """
+        pid = os.getpid()
+        with self._lock:
+            events = list(self._events)
+            step_stats = list(self._step_stats)
+        trace = [{'name': name,
+                  'cat': 'openem',
+                  'ph': 'X',
+                  'ts': start * 1e6,
+                  'dur': duration * 1e6,
+                  'pid': pid,
+                  'tid': tid}
+                 for name, start, duration, tid in events]
+
+        if step_stats:
+            from tensorflow.python.client import timeline
+            for stats in step_stats:
+                tf_trace = json.loads(
+                    timeline.Timeline(stats).generate_chrome_trace_format())
+                trace.extend(tf_trace['traceEvents'])
+
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': trace}, trace_file)
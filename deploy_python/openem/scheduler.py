@@ -0,0 +1,118 @@
+""" Dynamic batching for openem image models """
+import bisect
+import collections
+import threading
+import time
+
+import numpy as np
+
+from .optimizer import engineBatchSizes
+
+class BatchScheduler:
+    """ Forms batches for an ImageModel as frames arrive.
+
+        A batch is flushed once it is full or once the oldest frame in it has
+        waited `max_wait` seconds. Batches are padded up to the next of a
+        fixed set of sizes so an optimized graph sees a handful of shapes.
+
+        Attach to a model with `ImageModel.setScheduler`; the model's
+        `process()` then uses the scheduler whenever no explicit batch size
+        is given.
+    """
+    def __init__(self, max_wait=0.05, batch_sizes=None, timeout=None,
+                 window=1000):
+        """ Create a scheduler
+
+        max_wait : float
+                   Maximum seconds a frame may wait for its batch to fill
+        batch_sizes : list of int
+                      Sizes batches are padded up to. If None, derived from
+                      the model's batch size and, if its graph was
+                      converted with TensorRT, the engine limits in its
+                      optimizer arguments.
+        timeout : float
+                  Seconds the model's process() waits for a first frame
+                  before returning None. If None, it blocks.
+        window : int
+                 Number of recent frames used for latency percentiles
+        """
+        self.max_wait = max_wait
+        self.batch_sizes = batch_sizes
+        self.timeout = timeout
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._frames = 0
+        self._padded_frames = 0
+        self._batches = 0
+        self._start = None
+        self._end = None
+
+    def attach(self, model):
+        """ Called by the model when the scheduler is attached """
+        if self.batch_sizes is None:
+            self.batch_sizes = engineBatchSizes(model.batch_size,
+                                                model.optimizer_args,
+                                                model.tensorrt)
+        self.batch_sizes = sorted(self.batch_sizes)
+
+    def paddedSize(self, count):
+        """ Returns the batch size `count` frames are padded up to """
+        idx = bisect.bisect_left(self.batch_sizes, count)
+        if idx == len(self.batch_sizes):
+            return count
+        return self.batch_sizes[idx]
+
+    def next(self, ring, out=None):
+        """ Form the next batch from a models.FrameRing
+
+        out : np.ndarray
+              Optional staging array passed on to FrameRing.gather
+
+        Returns a tuple of (batch, indices, cookies, commit_times); the batch
+        may be longer than indices due to padding. All are None if the
+        timeout expired with no frames.
+        """
+        msgs = ring.collect(self.batch_sizes[-1],
+                            max_wait=self.max_wait,
+                            timeout=self.timeout)
+        if len(msgs) == 0:
+            return None, None, None, None
+        indices = [msg[0] for msg in msgs]
+        cookies = [msg[1] for msg in msgs]
+        commit_times = [msg[2] for msg in msgs]
+        batch = ring.gather(indices,
+                            count=self.paddedSize(len(indices)),
+                            out=out)
+        return batch, indices, cookies, commit_times
+
+    def record(self, commit_times, padded_size):
+        """ Record a completed batch """
+        now = time.time()
+        with self._lock:
+            if self._start is None:
+                self._start = min(commit_times)
+            self._latencies.extend(now - t for t in commit_times)
+            self._frames += len(commit_times)
+            self._padded_frames += padded_size
+            self._batches += 1
+            self._end = now
+
+    def stats(self):
+        """ Returns a dictionary of counters for batches processed so far
+
+        latency_p50, latency_p99: seconds from a frame being added to its
+                                  batch result being available
+        throughput: frames per second since the first frame was added
+        fill: fraction of network inputs that were real (not padding)
+        """
+        with self._lock:
+            if self._batches == 0:
+                return {'frames': 0, 'batches': 0}
+            latencies = np.array(self._latencies)
+            elapsed = self._end - self._start
+            return {'frames': self._frames,
+                    'batches': self._batches,
+                    'latency_p50': float(np.percentile(latencies, 50)),
+                    'latency_p99': float(np.percentile(latencies, 99)),
+                    'throughput': self._frames / elapsed if elapsed else 0.0,
+                    'fill': self._frames / self._padded_frames}
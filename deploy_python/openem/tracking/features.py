@@ -1,6 +1,7 @@
 import tensorflow as tf
 import numpy as np
 from openem.models import ImageModel
+from openem.models import importGraph, loadGraphDef, sessionConfig
 from openem.optimizer import optimizeGraph
 import cv2
 
@@ -40,39 +41,38 @@ class FeaturesExtractor(ImageModel):
                                                        cookie)
 
 class FeaturesComparator:
-    def __init__(self, model_path, gpu_fraction = 1.0):
+    def __init__(self, model_path, gpu_fraction = 1.0, registry=None,
+                 name=None, graph_cache=None):
         self._img_0_input=[]
         self._img_1_input=[]
         self._preprocessor=FeaturesPreprocessor()
-        config = tf.compat.v1.ConfigProto()
-        config.gpu_options.allow_growth = True
-        config.gpu_options.per_process_gpu_memory_fraction = gpu_fraction
-        self._tf_session = tf.compat.v1.Session(config=config)
-        with tf.io.gfile.GFile(model_path, 'rb') as graph_file:
-            # Load graph off of disk into a graph definition
-            graph_def = tf.compat.v1.GraphDef()
-            graph_def.ParseFromString(graph_file.read())
-            user_args = {"minimum_segment_size": 32}
+        if registry is None:
+            self._tf_session = tf.compat.v1.Session(
+                config=sessionConfig(gpu_fraction))
+        else:
+            self._tf_session = registry.session
+        graph_def = loadGraphDef(model_path)
+        user_args = {"minimum_segment_size": 32}
 
-            graph_def = optimizeGraph(graph_def,
-                                          ['model_1_1/leaky_re_lu_1/LeakyRelu',
-                                           'model_1/leaky_re_lu_1/LeakyRelu',
-                                           'dense_2/Sigmoid'],
-                                      user_trt_args=user_args
-                                          )
-            #for node in graph_def.node:
-            #    print(f"{node.name}")
-            #    for attr in node.attr:
-            #        print(f"\t{attr}")
-            return_elements = ['input_2:0', 'input_3:0', 'dense_2/Sigmoid:0']
-            tensors = tf.import_graph_def(
-                graph_def,
-                return_elements=return_elements)
-            # The first is an input
-            self._img_0 = tensors[0]
-            self._img_1 = tensors[1]
-            # The rest are outputs
-            self._distance = tensors[2]
+        graph_def = optimizeGraph(graph_def,
+                                  ['model_1_1/leaky_re_lu_1/LeakyRelu',
+                                   'model_1/leaky_re_lu_1/LeakyRelu',
+                                   'dense_2/Sigmoid'],
+                                  user_trt_args=user_args,
+                                  cache=graph_cache)
+        #for node in graph_def.node:
+        #    print(f"{node.name}")
+        #    for attr in node.attr:
+        #        print(f"\t{attr}")
+        return_elements = ['input_2:0', 'input_3:0', 'dense_2/Sigmoid:0']
+        if name is None:
+            name = type(self).__name__
+        tensors = importGraph(graph_def, return_elements, registry, name)
+        # The first is an input
+        self._img_0 = tensors[0]
+        self._img_1 = tensors[1]
+        # The rest are outputs
+        self._distance = tensors[2]
         self._image_shape = self._img_0.shape[1:3]
         print(f"Image shape = {self._image_shape}")
         print(f"Output shape = {self._distance.shape} {self._distance.name}")
@@ -1,6 +1,9 @@
 import unittest
 import os
+import threading
 from openem.Classify import Classifier
+from openem.Detect import Detection
+from openem.models import FrameRing
 import cv2
 import numpy as np
 import tensorflow as tf
@@ -97,4 +100,65 @@ class ClassifyTest(tf.test.TestCase):
                 self.assertAllClose(self.covers[idx],
                                     classification.cover,
                                     rtol=0.10)
-                
+
+class FakeSession:
+    """ Returns each crop's first pixel as its species and cover """
+    def run(self, output_tensor, feed_dict, options=None, run_metadata=None):
+        inputs, = feed_dict.values()
+        pixel = inputs[:, 0, 0, 0]
+        return [np.stack([pixel, -pixel], axis=1),
+                np.stack([pixel] * 3, axis=1)]
+
+class DetectionCropsTest(tf.test.TestCase):
+    def setUp(self):
+        # A classifier with a 4 slot ring, without a network to run
+        self.classifier = object.__new__(Classifier)
+        self.classifier.batch_size = 1
+        self.classifier.input_shape = [None, 8, 8, 3]
+        self.classifier.gpu_pid = os.getpid()
+        self.classifier.tf_session = FakeSession()
+        self.classifier._ring = FrameRing(4, (8, 8, 3), np.float32)
+        self.classifier._detection_crops = []
+        self.classifier._detection_cookies = []
+
+    def test_moreThanRing(self):
+        # Each detection covers a region of a different shade
+        count = 10
+        image = np.zeros((20, 20 * count, 3), dtype=np.uint8)
+        detections = []
+        for idx in range(count):
+            image[:, idx*20:(idx+1)*20] = idx * 10
+            detections.append(Detection(location=[idx*20, 0, 20, 20],
+                                        confidence=1.0,
+                                        species=1,
+                                        frame=7,
+                                        video_id='v'))
+        # Entirely outside of the frame so skipped
+        detections.append(Detection(location=[-30, 0, 20, 20],
+                                    confidence=1.0,
+                                    species=1,
+                                    frame=7,
+                                    video_id='v'))
+
+        results = []
+        def run():
+            self.classifier.addDetections(image,
+                                          detections,
+                                          ids=range(100, 100 + count + 1),
+                                          frame=7,
+                                          video_id='v')
+            results.extend(self.classifier.processDetections())
+        worker = threading.Thread(target=run, daemon=True)
+        worker.start()
+        worker.join(10.0)
+        # More crops than slots are fed to the ring in turn
+        self.assertFalse(worker.is_alive())
+
+        self.assertEqual([detection_id for detection_id, _ in results],
+                         list(range(100, 100 + count)))
+        for idx, (_, classification) in enumerate(results):
+            pixel = idx * 10 / 127.5 - 1
+            self.assertAllClose(classification.species, [pixel, -pixel])
+            self.assertEqual(classification.frame, 7)
+            self.assertEqual(classification.video_id, 'v')
+        self.assertIsNone(self.classifier.processDetections())
@@ -0,0 +1,146 @@
+import unittest
+import os
+import sys
+import tempfile
+from unittest import mock
+import openem.Detect
+import openem.Classify
+from openem.columnar import readColumns
+
+import numpy as np
+import tensorflow as tf
+
+class ColumnarTest(tf.test.TestCase):
+    def setUp(self):
+        self.deploy_dir = os.getenv('deploy_dir')
+        if self.deploy_dir == None:
+            raise 'Must set ENV:deploy_dir'
+
+        self.count_dir = os.path.join(self.deploy_dir, "count")
+        self.detections_csv = os.path.join(self.count_dir,
+                                           "test_detect_sequence.csv")
+        self.classification_csv = os.path.join(self.count_dir,
+                                               "test_classify_sequence.csv")
+
+    def assertDetectionsEqual(self, frame_rows, expected):
+        self.assertEqual(len(frame_rows), len(expected))
+        for row, detection in zip(frame_rows, expected):
+            self.assertAllClose(row.location, detection.location)
+            self.assertAlmostEqual(row.confidence, detection.confidence)
+            self.assertEqual(row.species, detection.species)
+            self.assertEqual(row.frame, detection.frame)
+            self.assertEqual(row.video_id, detection.video_id)
+
+    def assertClassificationsEqual(self, frame_rows, expected):
+        self.assertEqual(len(frame_rows), len(expected))
+        for row, classification in zip(frame_rows, expected):
+            self.assertAllClose(row.species, classification.species)
+            self.assertAllClose(row.cover, classification.cover)
+            self.assertEqual(row.frame, int(float(classification.frame)))
+            self.assertEqual(row.video_id, classification.video_id)
+
+    def test_detections(self):
+        expected = openem.Detect.IO.from_csv(self.detections_csv)
+        batch = openem.Detect.IO.load(self.detections_csv)
+        self.assertEqual(len(batch), len(expected))
+        for frame_rows, frame_expected in zip(batch, expected):
+            self.assertDetectionsEqual(frame_rows, frame_expected)
+
+        # Slices are indexed from their first frame
+        start, stop = len(expected) // 3, 2 * len(expected) // 3
+        sliced = batch[start:stop]
+        self.assertEqual(len(sliced), stop - start)
+        for idx in range(stop - start):
+            self.assertDetectionsEqual(sliced[idx], expected[start + idx])
+
+        # Filtering rows keeps every frame
+        threshold = np.median(batch.maxConfidence())
+        selected = batch.withConfidence(threshold)
+        self.assertEqual(len(selected), len(expected))
+        for frame_rows, frame_expected in zip(selected, expected):
+            self.assertDetectionsEqual(
+                frame_rows,
+                [detection for detection in frame_expected
+                 if detection.confidence >= threshold])
+
+        first = batch.first()
+        for idx, frame_expected in enumerate(expected):
+            if len(frame_expected) == 0:
+                self.assertEqual(first[idx], -1)
+            else:
+                self.assertAllClose(batch.location[first[idx]],
+                                    frame_expected[0].location)
+
+    def test_classifications(self):
+        expected = openem.Classify.IO.from_csv(self.classification_csv)
+        batch = openem.Classify.IO.load(self.classification_csv)
+        self.assertEqual(len(batch), len(expected))
+        for frame_rows, frame_expected in zip(batch, expected):
+            self.assertClassificationsEqual(frame_rows, frame_expected)
+
+        sliced = batch[1:]
+        self.assertEqual(len(sliced), len(expected) - 1)
+        for idx in range(len(sliced)):
+            self.assertClassificationsEqual(sliced[idx], expected[idx + 1])
+
+        selected = batch.select(batch.frames % 2 == 0)
+        self.assertEqual(len(selected), len(expected))
+        for idx, frame_rows in enumerate(selected):
+            self.assertClassificationsEqual(
+                frame_rows,
+                expected[idx] if idx % 2 == 0 else [])
+
+        first = batch.first()
+        for idx, frame_expected in enumerate(expected):
+            if len(frame_expected) == 0:
+                self.assertEqual(first[idx], -1)
+            else:
+                self.assertAllClose(batch.cover[first[idx]],
+                                    frame_expected[0].cover)
+
+class ReadColumnsTest(tf.test.TestCase):
+    """ Reads small inline files, so no deploy_dir is needed """
+    def writeCsv(self, text):
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w') as csv_file:
+            csv_file.write(text)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def readers(self):
+        """ Runs the body with pandas, if installed, and without it """
+        yield 'default'
+        with mock.patch.dict(sys.modules, {'pandas': None}):
+            yield 'csv'
+
+    def test_numericIds(self):
+        path = self.writeCsv("video_id,frame,x,y,w,h,"
+                             "detection_conf,detection_species\n"
+                             "1234,1,1.5,2,3,4,0.5,1\n"
+                             "0012,0,1,2,3,4,0.25,2\n")
+        for reader in self.readers():
+            with self.subTest(reader=reader):
+                names, columns = readColumns(path, str_columns=['video_id'])
+                self.assertEqual(names[0], 'video_id')
+                self.assertEqual(list(columns['video_id']), ['1234', '0012'])
+                self.assertAllClose(columns['x'], [1.5, 1])
+
+                batch = openem.Detect.IO.load(path)
+                self.assertEqual(list(batch.video_id), ['0012', '1234'])
+                self.assertEqual(batch[1][0].video_id, '1234')
+                self.assertEqual(batch[1][0].species, 1)
+                self.assertAllClose(batch[1][0].location, [1.5, 2, 3, 4])
+
+    def test_classificationIds(self):
+        path = self.writeCsv("frame,vid,species__,species_a,"
+                             "no_fish,covered,clear\n"
+                             "0,1234,0.25,0.75,0.1,0.2,0.7\n"
+                             "2,1234,0.5,0.5,0.3,0.3,0.4\n")
+        for reader in self.readers():
+            with self.subTest(reader=reader):
+                batch = openem.Classify.IO.load(path)
+                self.assertEqual(len(batch), 3)
+                self.assertEqual(list(batch.video_id), ['1234', '1234'])
+                self.assertEqual(len(batch[1]), 0)
+                self.assertAllClose(batch[2][0].species, [0.5, 0.5])
+                self.assertAllClose(batch[2][0].cover, [0.3, 0.3, 0.4])
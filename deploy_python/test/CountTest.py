@@ -40,6 +40,21 @@ class CountTest(tf.test.TestCase):
         # There should be 5 unique fish in this video
         self.assertEqual(len(keyframes), 5)
 
+    def test_streaming(self):
+        finder=KeyframeFinder(self.pb_file, 720, 360, batch_size=2)
+        detections = openem.Detect.IO.from_csv(self.detections_csv)
+        classifications = openem.Classify.IO.from_csv(self.classification_csv)
+        keyframes = finder.process(classifications,detections)
+
+        # Feeding frames one at a time finds the same keyframes
+        streamed = []
+        for frame_classifications, frame_detections in zip(classifications,
+                                                           detections):
+            streamed.extend(finder.addFrame(frame_classifications,
+                                            frame_detections))
+        streamed.extend(finder.finish())
+        self.assertEqual(streamed, keyframes)
+
     def test_errorChecks(self):
         finder=KeyframeFinder(self.pb_file, 720, 360)
         raised=False
@@ -0,0 +1,74 @@
+import unittest
+import threading
+from openem.models import FrameRing
+
+import numpy as np
+import tensorflow as tf
+
+class FrameRingTest(tf.test.TestCase):
+    def setUp(self):
+        self.ring = FrameRing(4, (2,3,1), np.uint8)
+
+    def test_takeOrder(self):
+        ring = self.ring
+        self.assertEqual(ring.nbytes, 4*2*3)
+        for value in range(3):
+            idx = ring.acquire()
+            ring.slot(idx)[:] = value
+            ring.commit(idx, cookie=f"frame{value}")
+
+        batch, indices, cookies = ring.take(3)
+        # Slots are handed out and consumed in ring order, so the batch is
+        # a view of the ring
+        self.assertEqual(indices, [0, 1, 2])
+        self.assertEqual(cookies, ["frame0", "frame1", "frame2"])
+        self.assertEqual(batch.shape, (3,2,3,1))
+        self.assertEqual(batch.dtype, np.uint8)
+        self.assertTrue(np.shares_memory(batch, ring.array()))
+        for value in range(3):
+            self.assertTrue((batch[value] == value).all())
+
+    def test_releaseReuse(self):
+        ring = self.ring
+        indices = [ring.acquire() for _ in range(4)]
+        self.assertEqual(indices, [0, 1, 2, 3])
+        for idx in indices:
+            ring.commit(idx)
+        _, taken, _ = ring.take(2)
+        ring.release(taken)
+
+        # Released slots are reused in the order they were released
+        ring.release([2, 3])
+        self.assertEqual([ring.acquire() for _ in range(4)], [0, 1, 2, 3])
+
+    def test_wrappedGather(self):
+        ring = self.ring
+        for idx in [3, 0]:
+            ring.slot(idx)[:] = idx + 1
+        batch = ring.gather([3, 0])
+        # Wrapped slots are copied into the staging array
+        self.assertFalse(np.shares_memory(batch, ring.array()))
+        self.assertTrue((batch[0] == 4).all())
+        self.assertTrue((batch[1] == 1).all())
+
+    def test_blockWhenFull(self):
+        ring = self.ring
+        for _ in range(4):
+            ring.acquire()
+
+        acquired = []
+        waiter = threading.Thread(target=lambda: acquired.append(
+            ring.acquire()))
+        waiter.start()
+        waiter.join(0.2)
+        # Every slot is in use so the producer waits
+        self.assertTrue(waiter.is_alive())
+        self.assertEqual(acquired, [])
+
+        ring.release([1])
+        waiter.join(5.0)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(acquired, [1])
+
+    def test_collectTimeout(self):
+        self.assertEqual(self.ring.collect(2, timeout=0.05), [])
@@ -0,0 +1,45 @@
+import unittest
+from openem.image import force_aspect, letterbox
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+class ImageTest(tf.test.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        # Smooth content so both paths interpolate similar values
+        noise = rng.integers(0, 256, (12, 16, 3), dtype=np.uint8)
+        self.image = cv2.resize(noise, (640, 480))
+
+    def reference(self, image, desired_shape):
+        """ Pad to aspect ratio then resize, as before letterbox """
+        padded = force_aspect(image, desired_shape[1] / desired_shape[0])
+        padded = padded.astype(image.dtype)
+        return cv2.resize(padded, (desired_shape[1], desired_shape[0])), \
+               padded.shape
+
+    def test_matchesPadAndResize(self):
+        # Padding on the right or bottom, downscaling and upscaling
+        for desired_shape in [(360, 720), (300, 200), (960, 1920),
+                              (600, 400), (240, 320)]:
+            with self.subTest(desired_shape=desired_shape):
+                expected, padded_shape = self.reference(self.image,
+                                                        desired_shape)
+                resized, scale, offset = letterbox(self.image, desired_shape)
+                self.assertEqual(resized.shape, expected.shape)
+                self.assertEqual(resized.dtype, np.uint8)
+                difference = np.abs(resized.astype(np.int32) -
+                                    expected.astype(np.int32))
+                self.assertLessEqual(difference.max(), 1)
+                self.assertAllClose(scale,
+                                    (desired_shape[0] / padded_shape[0],
+                                     desired_shape[1] / padded_shape[1]))
+                self.assertEqual(offset, (0, 0))
+
+    def test_out(self):
+        out = np.empty((360, 720, 3), dtype=np.uint8)
+        resized, _, _ = letterbox(self.image, (360, 720), out=out)
+        self.assertTrue(np.shares_memory(resized, out))
+        expected, _, _ = letterbox(self.image, (360, 720))
+        self.assertAllEqual(out, expected)
@@ -0,0 +1,74 @@
+import unittest
+from openem.Count import findKeyframePeaks, peak_sum
+from openem.Count import PEAK_THRESHOLD, AREA_THRESHOLD, MIN_SPACING
+
+import numpy as np
+import tensorflow as tf
+
+def referencePeaks(scores, clear):
+    """ Repeatedly take the highest score and zero out around it """
+    scores = np.array(scores, dtype=np.float64)
+    keyframes = []
+    while True:
+        max_idx = np.argmax(scores)
+        if scores[max_idx] < PEAK_THRESHOLD:
+            return sorted(keyframes)
+        area_sum = peak_sum(scores, max_idx, MIN_SPACING)
+        low_idx = max(max_idx - MIN_SPACING, 0)
+        limit = min(max_idx + MIN_SPACING + 1, len(scores))
+        if area_sum > AREA_THRESHOLD:
+            max_clear = 0.0
+            clear_idx = None
+            for area_idx in range(low_idx, limit):
+                if clear[area_idx] > max_clear:
+                    max_clear = clear[area_idx]
+                    clear_idx = area_idx
+            if clear_idx is not None:
+                keyframes.append(clear_idx)
+        scores[low_idx:limit] = 0.0
+
+class KeyframePeaksTest(tf.test.TestCase):
+    def assertMatchesReference(self, scores, clear, expected=None):
+        keyframes = findKeyframePeaks(np.array(scores), np.array(clear))
+        self.assertEqual(keyframes.tolist(), referencePeaks(scores, clear))
+        if expected is not None:
+            self.assertEqual(keyframes.tolist(), expected)
+
+    def test_cases(self):
+        clear = [0.5] * 8
+        cases = [
+            # Single peak picks the clearest frame around it
+            ([0, 0, 0.02, 0.2, 0.02, 0, 0, 0],
+             [0.1, 0.1, 0.2, 0.9, 0.3, 0.1, 0.1, 0.1], [3]),
+            # Ties go to the earliest peak, suppressing its neighbour
+            ([0, 0.2, 0.2, 0, 0, 0.2, 0.2, 0], clear, [0, 4]),
+            # Plateau, visited from its start
+            ([0, 0.1, 0.1, 0.1, 0.1, 0.1, 0, 0], clear, [0, 2]),
+            # Peaks at the first and last frames
+            ([0.3, 0, 0, 0, 0, 0, 0, 0.3], clear, [0, 6]),
+            # Everything below the peak threshold
+            ([0.02, 0.029, 0.01, 0, 0.02, 0.02, 0.02, 0], clear, []),
+            # Peaks too small in area
+            ([0, 0.05, 0, 0, 0, 0.04, 0.04, 0], clear, []),
+            # A peak without a clear frame around it
+            ([0, 0.5, 0, 0, 0, 0.5, 0, 0],
+             [0, 0, 0, 0.4, 0.3, 0.2, 0.1, 0], [4]),
+        ]
+        for scores, clear, expected in cases:
+            with self.subTest(scores=scores):
+                self.assertMatchesReference(scores, clear, expected)
+
+    def test_random(self):
+        rng = np.random.default_rng(0)
+        for _ in range(200):
+            scores = rng.random(40) * 0.2
+            # Quantize to get ties and plateaus
+            scores = np.round(scores, 2)
+            clear = np.round(rng.random(40), 1)
+            self.assertMatchesReference(scores, clear)
+
+    def test_batch(self):
+        scores = np.array([[0, 0.3, 0, 0], [0, 0, 0, 0]])
+        clear = np.ones((2, 4))
+        keyframes = findKeyframePeaks(scores, clear)
+        self.assertEqual([row.tolist() for row in keyframes], [[0], []])
@@ -0,0 +1,57 @@
+import unittest
+from openem.Detect import nonMaxSuppression
+
+import numpy as np
+import tensorflow as tf
+
+class NmsTest(tf.test.TestCase):
+    def setUp(self):
+        # Boxes 0 and 1 overlap with an IoU of 0.6; box 2 overlaps neither
+        # and box 3 is a near copy of box 2 in the negative quadrant
+        self.boxes = np.array([[0, 0, 10, 10],
+                               [0, 2, 10, 10],
+                               [50, 50, 10, 10],
+                               [-20, -20, 10, 10]], dtype=np.float64)
+        self.scores = np.array([0.9, 0.8, 0.3, 0.5])
+        self.classes = np.array([1, 2, 1, 1])
+
+    def test_classAgnostic(self):
+        keep = nonMaxSuppression(self.boxes, self.scores, 0.5)
+        self.assertEqual(keep.tolist(), [0, 3, 2])
+        # Boxes overlapping exactly at the threshold are kept
+        keep = nonMaxSuppression(self.boxes, self.scores, 2/3)
+        self.assertEqual(keep.tolist(), [0, 1, 3, 2])
+
+    def test_classAware(self):
+        keep = nonMaxSuppression(self.boxes, self.scores, 0.5,
+                                 classes=self.classes)
+        # Box 1 is another class so survives box 0
+        self.assertEqual(keep.tolist(), [0, 1, 3, 2])
+
+        # Boxes of the same class are still suppressed
+        keep = nonMaxSuppression(self.boxes, self.scores, 0.5,
+                                 classes=np.array([1, 1, 1, 2]))
+        self.assertEqual(keep.tolist(), [0, 3, 2])
+
+    def test_scoreThreshold(self):
+        keep = nonMaxSuppression(self.boxes, self.scores, 0.5,
+                                 score_threshold=0.3)
+        # Only boxes scoring above the threshold are kept
+        self.assertEqual(keep.tolist(), [0, 3])
+        keep = nonMaxSuppression(self.boxes, self.scores, 0.5,
+                                 score_threshold=0.95)
+        self.assertEqual(keep.tolist(), [])
+
+    def test_maxOutput(self):
+        keep = nonMaxSuppression(self.boxes, self.scores, 0.5, max_output=2)
+        self.assertEqual(keep.tolist(), [0, 3])
+        keep = nonMaxSuppression(self.boxes, self.scores, 0.5,
+                                 max_output=2, classes=self.classes)
+        self.assertEqual(keep.tolist(), [0, 1])
+
+    def test_empty(self):
+        for classes in [None, np.zeros(0, dtype=np.int64)]:
+            keep = nonMaxSuppression(np.zeros((0, 4)), np.zeros(0), 0.5,
+                                     classes=classes)
+            self.assertEqual(keep.dtype, np.int64)
+            self.assertEqual(len(keep), 0)
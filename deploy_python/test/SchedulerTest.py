@@ -0,0 +1,52 @@
+import unittest
+from types import SimpleNamespace
+from openem.optimizer import engineBatchSizes
+from openem.scheduler import BatchScheduler
+
+import tensorflow as tf
+
+class SchedulerTest(tf.test.TestCase):
+    def test_engineBatchSizes(self):
+        self.assertEqual(engineBatchSizes(1), [1])
+        self.assertEqual(engineBatchSizes(3), [1, 2, 3])
+        self.assertEqual(engineBatchSizes(12, {'max_batch_size': 16}),
+                         [1, 2, 4, 8, 12])
+        # Only the largest sizes are kept if the engine cache is small
+        self.assertEqual(engineBatchSizes(16, {'max_batch_size': 16,
+                                               'maximum_cached_engines': 2}),
+                         [8, 16])
+        # Engines never accept more than max_batch_size
+        self.assertEqual(engineBatchSizes(8), [1, 2, 4])
+        self.assertEqual(engineBatchSizes(8, {'max_batch_size': 6}),
+                         [1, 2, 4, 6])
+        # Unless the graph was not converted with TensorRT
+        self.assertEqual(engineBatchSizes(16, {'maximum_cached_engines': 2},
+                                          tensorrt=False),
+                         [1, 2, 4, 8, 16])
+
+    def test_paddedSize(self):
+        model = SimpleNamespace(batch_size=8,
+                                optimizer_args={'max_batch_size': 6},
+                                tensorrt=True)
+        scheduler = BatchScheduler()
+        scheduler.attach(model)
+        self.assertEqual(scheduler.batch_sizes, [1, 2, 4, 6])
+        self.assertEqual([scheduler.paddedSize(count)
+                          for count in range(1, 7)],
+                         [1, 2, 4, 4, 6, 6])
+
+    def test_unconverted(self):
+        # CPU only, unoptimized or GPU-less models schedule up to their
+        # own batch size whatever the TensorRT defaults
+        model = SimpleNamespace(batch_size=16, optimizer_args=None,
+                                tensorrt=False)
+        scheduler = BatchScheduler()
+        scheduler.attach(model)
+        self.assertEqual(scheduler.batch_sizes, [1, 2, 4, 8, 16])
+        self.assertEqual(scheduler.paddedSize(5), 8)
+        self.assertEqual(scheduler.paddedSize(16), 16)
+
+        # Explicit sizes are used as given
+        scheduler = BatchScheduler(batch_sizes=[8, 2])
+        scheduler.attach(model)
+        self.assertEqual(scheduler.paddedSize(3), 8)
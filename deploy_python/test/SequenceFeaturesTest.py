@@ -0,0 +1,100 @@
+import unittest
+from openem.Count import KeyframeFinder, KEYFRAME_OFFSET
+from openem.Count import sequenceFeatures, _sequenceColumns
+from openem.Detect import DetectionBatch
+from openem.Classify import ClassificationBatch
+
+import numpy as np
+import tensorflow as tf
+
+class SequenceFeaturesTest(tf.test.TestCase):
+    def setUp(self):
+        self.img_width = 200
+        self.img_height = 100
+        # Frames 0 and 3 have a detection, frame 1 only a classification,
+        # frame 2 nothing and frame 3 a second detection that is ignored
+        self.detections = DetectionBatch(
+            np.array([[20, 10, 40, 30],
+                      [100, 50, 20, 10],
+                      [0, 0, 1, 1]], dtype=np.float64),
+            np.array([0.9, 0.6, 0.1]),
+            np.array([1, 2, 1]),
+            np.array([0, 3, 3]),
+            np.array(['v'] * 3, dtype=object),
+            frame_count=4)
+        self.classifications = ClassificationBatch(
+            np.array([[0.1, 0.7, 0.2],
+                      [0.5, 0.3, 0.2],
+                      [0.2, 0.2, 0.6]]),
+            np.array([[0.1, 0.1, 0.8],
+                      [0.3, 0.3, 0.4],
+                      [0.6, 0.2, 0.2]]),
+            np.array([0, 1, 3]),
+            np.array(['v'] * 3, dtype=object),
+            frame_count=4)
+        # Species, cover, normalized location, confidence, SSD species
+        self.expected = np.array([
+            [0.1, 0.7, 0.2, 0.1, 0.1, 0.8, 0.1, 0.1, 0.2, 0.3, 0.9, 1],
+            [1.0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+            [1.0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+            [0.2, 0.2, 0.6, 0.6, 0.2, 0.2, 0.5, 0.5, 0.1, 0.1, 0.6, 2]])
+
+    def features(self, classifications, detections, num_features=None):
+        *columns, clear = _sequenceColumns(classifications, detections)
+        self.assertAllClose(clear, [0.8, 0.4, 0.0, 0.2])
+        return sequenceFeatures(*columns,
+                                self.img_width,
+                                self.img_height,
+                                num_features)
+
+    def test_oneModel(self):
+        for classifications, detections in [
+                (self.classifications, self.detections),
+                (list(self.classifications), list(self.detections))]:
+            rows = self.features(classifications, detections)
+            self.assertAllClose(rows, self.expected)
+
+    def test_twoModels(self):
+        rows = self.features(self.classifications, self.detections, 24)
+        present = [0, 3]
+        self.assertAllClose(rows[present, :12], self.expected[present])
+        self.assertAllClose(rows[present, 12:], self.expected[present])
+        # Frames without a detection only flag the first feature set
+        self.assertAllClose(rows[[1, 2]], np.eye(1, 24).repeat(2, axis=0))
+
+    def test_badLength(self):
+        with self.assertRaises(Exception):
+            self.features(self.classifications, self.detections, 36)
+
+    def test_windowPadding(self):
+        # A finder with 4 frame windows, without a network to run them
+        finder = object.__new__(KeyframeFinder)
+        finder.input_shape = [None, 4 + KEYFRAME_OFFSET * 2, 12]
+        finder.img_width = self.img_width
+        finder.img_height = self.img_height
+        finder.batch_size = 8
+        finder.reset()
+        frame_count = 4 * 2 + KEYFRAME_OFFSET
+        rows = np.tile(self.expected, (frame_count // 4, 1))
+        finder.addFrames(list(self.classifications) * (frame_count // 4),
+                         list(self.detections) * (frame_count // 4))
+
+        # The first two windows are complete; before the start of the video
+        # is flagged as no species
+        self.assertEqual(len(finder._windows), 2)
+        for window, (start, inputs, clear) in enumerate(finder._windows):
+            pad = KEYFRAME_OFFSET - start
+            self.assertEqual(start, window * 4)
+            self.assertAllClose(inputs[:pad], np.eye(1, 12).repeat(pad, 0))
+            self.assertAllClose(inputs[pad:], rows[:len(inputs) - pad])
+            self.assertAllClose(clear, [0.8, 0.4, 0.0, 0.2])
+
+        # The next window reaches past the end of the video, which is zeros
+        finder._addWindow()
+        start, inputs, _ = finder._windows[-1]
+        pad = KEYFRAME_OFFSET - start
+        stop = pad + frame_count
+        self.assertLess(stop, len(inputs))
+        self.assertAllClose(inputs[pad:stop], rows)
+        self.assertAllClose(inputs[stop:],
+                            np.zeros((len(inputs) - stop, 12)))
@@ -0,0 +1,35 @@
+import unittest
+from openem.Detect.temporal import FrameSkipper
+
+import numpy as np
+import tensorflow as tf
+
+class TemporalTest(tf.test.TestCase):
+    def setUp(self):
+        self.image = np.full((72,128,3), 100, dtype=np.uint8)
+
+    def test_interval(self):
+        skipper = FrameSkipper(interval=3)
+        detected = [skipper.shouldDetect(frame) for frame in range(8)]
+        self.assertEqual(detected, [True, False, False, True,
+                                    False, False, True, False])
+        self.assertTrue(skipper.shouldDetect(8, last=True))
+
+    def test_motion(self):
+        skipper = FrameSkipper(interval=10, motion_threshold=10)
+        self.assertTrue(skipper.shouldDetect(0, self.image))
+        self.assertFalse(skipper.shouldDetect(1, self.image + 5))
+        self.assertTrue(skipper.shouldDetect(2, self.image + 50))
+        self.assertFalse(skipper.shouldDetect(3, self.image + 50))
+
+    def test_firstFrameWithoutImage(self):
+        # The forced first detection has no image to compare later frames
+        # to, so the first frame with one is detected and kept
+        for kwargs in [{'motion_threshold': 10},
+                       {'scene_threshold': 0.9},
+                       {'motion_threshold': 10, 'scene_threshold': 0.9}]:
+            with self.subTest(**kwargs):
+                skipper = FrameSkipper(interval=10, **kwargs)
+                self.assertTrue(skipper.shouldDetect(0))
+                self.assertTrue(skipper.shouldDetect(1, self.image))
+                self.assertFalse(skipper.shouldDetect(2, self.image))
@@ -0,0 +1,27 @@
+import unittest
+from openem.Detect.tiling import tileWindows
+
+import tensorflow as tf
+
+class TilingTest(tf.test.TestCase):
+    def test_tileWindows(self):
+        windows = tileWindows((10,10), (4,4), overlap=0.0, max_tiles=4)
+        self.assertEqual(windows, [(0,0,5,5), (5,0,5,5),
+                                   (0,5,5,5), (5,5,5,5)])
+
+        # Tiles are grown to keep to max_tiles and cover the frame
+        for max_tiles in [1, 2, 9, 16]:
+            with self.subTest(max_tiles=max_tiles):
+                windows = tileWindows((720,1280), (300,300),
+                                      max_tiles=max_tiles)
+                self.assertLessEqual(len(windows), max_tiles)
+                self.assertEqual(max(x + w for x, _, w, _ in windows), 1280)
+                self.assertEqual(max(y + h for _, y, _, h in windows), 720)
+
+        # A network input larger than the frame is a single tile
+        self.assertEqual(tileWindows((10,10), (40,40), max_tiles=1),
+                         [(0,0,10,10)])
+
+    def test_maxTiles(self):
+        with self.assertRaises(ValueError):
+            tileWindows((10,10), (4,4), max_tiles=0)
@@ -4,8 +4,17 @@ import tensorflow as tf
 
 from test.FindRulerTest import FindRulerTest
 from test.DetectionTest import DetectionTest
-from test.ClassifyTest import ClassifyTest
+from test.ClassifyTest import ClassifyTest, DetectionCropsTest
 from test.CountTest import CountTest
+from test.ColumnarTest import ColumnarTest, ReadColumnsTest
+from test.FrameRingTest import FrameRingTest
+from test.SchedulerTest import SchedulerTest
+from test.NmsTest import NmsTest
+from test.TilingTest import TilingTest
+from test.TemporalTest import TemporalTest
+from test.ImageTest import ImageTest
+from test.SequenceFeaturesTest import SequenceFeaturesTest
+from test.KeyframePeaksTest import KeyframePeaksTest
 
 if __name__=="__main__":
     tf.test.main()
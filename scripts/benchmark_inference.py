@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+
+""" Benchmark portions of the OpenEM inference pipeline
+
+Each sub-command times an optimized code path against the original one on
+the same inputs and reports frames per second for both.
+
+- `preprocess`: per-image `Preprocessor.__call__` versus the batched
+  `Preprocessor.batch` path used by `ImageModel._addImages`.
+- `cpu-graph`: CPU-only inference on the raw frozen graph versus the graph
+  optimized by `optimizer.optimizeGraphCpu` (optionally int8 weights).
+- `ssd-postprocess`: the original per-prior loop with a tensorflow NMS op
+  added per image versus the vectorized `SSDDetector` postprocessing, on
+  the same network output.
+- `uint8-input`: a model fed float32 frames preprocessed on the host
+  versus the same model fed uint8 frames with the conversion prepended to
+  its graph.
+- `profile`: runs a model end to end with a `profiling.Profiler` attached
+  and prints where the time went; optionally writes a Chrome trace.
+
+Images can be supplied as files (e.g. the test images in the deploy
+directory); if none are given a random frame of `--frame-size` is used.
+"""
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+from openem.models import ImageModel, Preprocessor
+from openem.Classify import Classifier
+from openem.Detect import Detection, SSDDetector
+from openem.Detect.SSD import decodeBoxes
+from openem.Detect.RetinaNet import RetinaNetDetector, RetinaNetPreprocessor
+from openem.FindRuler import RulerMaskFinder
+from openem.profiling import Profiler
+
+PREPROCESSORS = {
+    'classify': lambda: Preprocessor(1.0/127.5, np.array([-1,-1,-1]), True),
+    'detect': lambda: Preprocessor(1.0,
+                                   np.array([-103.939,-116.779,-123.68]),
+                                   False),
+    'find_ruler': lambda: Preprocessor(1.0 / 128.0, -np.ones(3), True),
+    'retinanet': lambda: RetinaNetPreprocessor(meanImage=None)
+}
+
+MODELS = {
+    'classify': Classifier,
+    'detect': SSDDetector,
+    'find_ruler': RulerMaskFinder,
+    'retinanet': RetinaNetDetector
+}
+
+def _load_frames(args):
+    """ Returns a stack of `args.batch_size` same-sized frames """
+    if args.images:
+        images = [cv2.imread(path) for path in args.images]
+        height, width = images[0].shape[:2]
+        images = [cv2.resize(image, (width, height)) for image in images]
+    else:
+        height, width = args.frame_size
+        images = [np.random.randint(0, 255, (height, width, 3), np.uint8)]
+    frames = [images[idx % len(images)] for idx in range(args.batch_size)]
+    return np.array(frames)
+
+def _report(name, frames, duration):
+    fps = frames / duration
+    print(f"{name:>12}: {frames} frames in {duration*1000:.1f}ms; "
+          f"{fps:.1f} fps")
+    return fps
+
+def benchmark_preprocess(args):
+    frames = _load_frames(args)
+    preprocessor = PREPROCESSORS[args.model]()
+    width = args.network_size[1]
+    height = args.network_size[0]
+    out = np.empty((len(frames), height, width, frames.shape[3]),
+                   dtype=np.float32)
+
+    # Warm up both paths once
+    preprocessor(frames[0], width, height)
+    preprocessor.batch(frames, width, height, out=out)
+
+    before = time.time()
+    for _ in range(args.iterations):
+        for frame in frames:
+            preprocessor(frame, width, height)
+    per_image = _report("per-image",
+                        len(frames) * args.iterations,
+                        time.time() - before)
+
+    before = time.time()
+    for _ in range(args.iterations):
+        preprocessor.batch(frames, width, height, out=out)
+    batched = _report("batched",
+                      len(frames) * args.iterations,
+                      time.time() - before)
+    print(f"Speedup: {batched / per_image:.2f}x")
+
+def _time_model(name, model, frames, iterations):
+    """ Time the network alone (no model specific postprocessing) """
+    model.addImages(frames)
+    result, _ = ImageModel.process(model)
+
+    before = time.time()
+    for _ in range(iterations):
+        model.addImages(frames)
+        ImageModel.process(model)
+    _report(name, len(frames) * iterations, time.time() - before)
+    if type(result) == list:
+        result = result[0]
+    return result
+
+def benchmark_cpu_graph(args):
+    frames = _load_frames(args)
+    model_class = MODELS[args.model]
+    raw = model_class(args.graph_pb,
+                      batch_size=len(frames),
+                      cpu_only=True)
+    raw_result = _time_model("raw", raw, frames, args.iterations)
+    cpu_args = {'quantize': args.quantize}
+    optimized = model_class(args.graph_pb,
+                            batch_size=len(frames),
+                            cpu_only=True,
+                            cpu_optimizer_args=cpu_args)
+    optimized_result = _time_model("optimized", optimized, frames,
+                                   args.iterations)
+    print("Max output difference: "
+          f"{np.max(np.abs(raw_result - optimized_result))}")
+
+def benchmark_uint8_input(args):
+    frames = _load_frames(args)
+    model_class = MODELS[args.model]
+    results = []
+    for name, uint8_input in [("float32", False), ("uint8", True)]:
+        model = model_class(args.graph_pb,
+                            batch_size=len(frames),
+                            cpu_only=args.cpu_only,
+                            uint8_input=uint8_input)
+        frame_bytes = model._ring.nbytes // model._ring.slot_count
+        print(f"{name:>12}: {frame_bytes} bytes fed per frame")
+        results.append(_time_model(name, model, frames, args.iterations))
+    print("Max output difference: "
+          f"{np.max(np.abs(results[0] - results[1]))}")
+
+def _legacy_ssd_postprocess(batch_result, sizes, session):
+    """ SSD postprocessing as originally implemented, for comparison """
+    batch_detections=[]
+    for image_idx,image_result in enumerate(batch_result):
+        conf_stop = image_result.shape[1] - 8
+        loc = image_result[:,:4]
+        conf = image_result[:,4:conf_stop]
+        anchors = image_result[:,conf_stop:conf_stop+4]
+        variances = image_result[:,conf_stop+4:conf_stop+8]
+        boxes = decodeBoxes(loc, anchors, variances, sizes[image_idx])
+        scores=np.zeros(loc.shape[0])
+        class_index=np.zeros(loc.shape[0])
+        for idx,r in enumerate(conf):
+            _,maxScore,__,maxIdx = cv2.minMaxLoc(r[1:])
+            scores[idx] = maxScore
+            class_index[idx] = maxIdx[1] + 1
+        indices = tf.image.non_max_suppression(boxes, scores, 200, 0.01, 0.45)
+        detections = [Detection(location=boxes[idx],
+                                confidence=scores[idx],
+                                species=class_index[idx],
+                                frame=None,
+                                video_id=None)
+                      for idx in indices.eval(session=session)]
+        detections.sort(key=lambda detection: detection.confidence,
+                        reverse=True)
+        batch_detections.append(detections)
+    return batch_detections
+
+def benchmark_ssd_postprocess(args):
+    frames = _load_frames(args)
+    detector = SSDDetector(args.graph_pb,
+                           batch_size=len(frames),
+                           cpu_only=args.cpu_only)
+    cookies = [{"size": frame.shape} for frame in frames]
+    sizes = [cookie["size"] for cookie in cookies]
+    detector.addImages(frames)
+    batch_result, _ = ImageModel.process(detector)
+
+    graph = detector.tf_session.graph
+    nodes = len(graph.as_graph_def().node)
+    before = time.time()
+    for _ in range(args.iterations):
+        legacy = _legacy_ssd_postprocess(batch_result,
+                                         sizes,
+                                         detector.tf_session)
+    original = _report("original", len(frames) * args.iterations,
+                       time.time() - before)
+    print(f"Graph grew by {len(graph.as_graph_def().node) - nodes} nodes")
+
+    before = time.time()
+    for _ in range(args.iterations):
+        vectorized = detector._postprocess(batch_result, cookies)
+    fast = _report("vectorized", len(frames) * args.iterations,
+                   time.time() - before)
+    print(f"Speedup: {fast / original:.2f}x")
+    print("Detections per image (original, vectorized): "
+          f"{[(len(a), len(b)) for a, b in zip(legacy, vectorized)]}")
+
+def benchmark_profile(args):
+    frames = _load_frames(args)
+    model = MODELS[args.model](args.graph_pb,
+                               batch_size=len(frames),
+                               cpu_only=args.cpu_only)
+    # Warm up before profiling so graph setup is not counted
+    model.addImages(frames)
+    model.process()
+
+    profiler = Profiler(trace_every=args.trace_every)
+    model.setProfiler(profiler)
+    before = time.time()
+    for _ in range(args.iterations):
+        model.addImages(frames)
+        model.process()
+    _report("profiled", len(frames) * args.iterations, time.time() - before)
+    print(profiler.summary())
+    if args.chrome_trace:
+        profiler.chromeTrace(args.chrome_trace)
+        print(f"Wrote Chrome trace to {args.chrome_trace}")
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    preprocess = subparsers.add_parser('preprocess',
+                                       help="Per-image vs batched "
+                                            "preprocessing")
+    preprocess.add_argument("--model",
+                            choices=PREPROCESSORS.keys(),
+                            default='detect')
+    preprocess.add_argument("--network-size",
+                            nargs=2,
+                            type=int,
+                            default=[360, 720],
+                            help="Network input (height width)")
+    preprocess.add_argument("--frame-size",
+                            nargs=2,
+                            type=int,
+                            default=[1080, 1920],
+                            help="Synthetic frame (height width)")
+    preprocess.add_argument("--batch-size", type=int, default=4)
+    preprocess.add_argument("--iterations", type=int, default=50)
+    preprocess.add_argument("images", nargs="*")
+    preprocess.set_defaults(func=benchmark_preprocess)
+
+    cpu_graph = subparsers.add_parser('cpu-graph',
+                                      help="Raw vs CPU optimized graph")
+    cpu_graph.add_argument("--model",
+                           choices=MODELS.keys(),
+                           default='detect')
+    cpu_graph.add_argument("--graph-pb", required=True)
+    cpu_graph.add_argument("--quantize",
+                           action="store_true",
+                           help="Quantize weights to int8")
+    cpu_graph.add_argument("--frame-size",
+                           nargs=2,
+                           type=int,
+                           default=[360, 720],
+                           help="Synthetic frame (height width)")
+    cpu_graph.add_argument("--batch-size", type=int, default=4)
+    cpu_graph.add_argument("--iterations", type=int, default=10)
+    cpu_graph.add_argument("images", nargs="*")
+    cpu_graph.set_defaults(func=benchmark_cpu_graph)
+
+    ssd_postprocess = subparsers.add_parser('ssd-postprocess',
+                                            help="Original vs vectorized "
+                                                 "SSD postprocessing")
+    ssd_postprocess.add_argument("--graph-pb", required=True)
+    ssd_postprocess.add_argument("--cpu-only", action="store_true")
+    ssd_postprocess.add_argument("--frame-size",
+                                 nargs=2,
+                                 type=int,
+                                 default=[360, 720],
+                                 help="Synthetic frame (height width)")
+    ssd_postprocess.add_argument("--batch-size", type=int, default=4)
+    ssd_postprocess.add_argument("--iterations", type=int, default=10)
+    ssd_postprocess.add_argument("images", nargs="*")
+    ssd_postprocess.set_defaults(func=benchmark_ssd_postprocess)
+
+    uint8_input = subparsers.add_parser('uint8-input',
+                                        help="Host float32 vs in-graph "
+                                             "uint8 conversion")
+    uint8_input.add_argument("--model",
+                             choices=MODELS.keys(),
+                             default='detect')
+    uint8_input.add_argument("--graph-pb", required=True)
+    uint8_input.add_argument("--cpu-only", action="store_true")
+    uint8_input.add_argument("--frame-size",
+                             nargs=2,
+                             type=int,
+                             default=[360, 720],
+                             help="Synthetic frame (height width)")
+    uint8_input.add_argument("--batch-size", type=int, default=4)
+    uint8_input.add_argument("--iterations", type=int, default=10)
+    uint8_input.add_argument("images", nargs="*")
+    uint8_input.set_defaults(func=benchmark_uint8_input)
+
+    profile = subparsers.add_parser('profile',
+                                    help="Per-stage timings of a model")
+    profile.add_argument("--model",
+                         choices=MODELS.keys(),
+                         default='detect')
+    profile.add_argument("--graph-pb", required=True)
+    profile.add_argument("--cpu-only", action="store_true")
+    profile.add_argument("--trace-every",
+                         type=int,
+                         default=0,
+                         help="Collect tensorflow step stats every N batches")
+    profile.add_argument("--chrome-trace",
+                         help="Path to write a Chrome trace JSON file to")
+    profile.add_argument("--frame-size",
+                         nargs=2,
+                         type=int,
+                         default=[360, 720],
+                         help="Synthetic frame (height width)")
+    profile.add_argument("--batch-size", type=int, default=4)
+    profile.add_argument("--iterations", type=int, default=10)
+    profile.add_argument("images", nargs="*")
+    profile.set_defaults(func=benchmark_profile)
+
+    args = parser.parse_args()
+    args.func(args)
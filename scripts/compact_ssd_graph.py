@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+"""
+Rewrites a frozen SSD detector graph (*.pb) so box decoding, score
+thresholding and non-maximum suppression run inside the graph. Only the
+final detections are then copied off the device. Load the output with
+`openem.Detect.SSDDetector(..., compact=True)`.
+"""
+import argparse
+
+from openem.Detect.SSD import SSDDetector, compactGraph
+from openem.models import loadGraphDef
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("input", help="Input frozen graph (*.pb)")
+    parser.add_argument("output", help="Output file (*.pb)")
+    parser.add_argument("--output-name",
+                        default="output_node0:0",
+                        help="Raw per-prior output tensor of the input graph")
+    parser.add_argument("--score-threshold",
+                        type=float,
+                        default=SSDDetector.score_threshold)
+    parser.add_argument("--nms-threshold",
+                        type=float,
+                        default=SSDDetector.nms_threshold)
+    parser.add_argument("--max-detections",
+                        type=int,
+                        default=SSDDetector.max_detections)
+    args = parser.parse_args()
+
+    graph_def = compactGraph(loadGraphDef(args.input),
+                             args.output_name,
+                             score_threshold=args.score_threshold,
+                             nms_threshold=args.nms_threshold,
+                             max_detections=args.max_detections)
+    with open(args.output, 'wb') as output:
+        output.write(graph_def.SerializeToString())
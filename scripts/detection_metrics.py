@@ -82,10 +82,11 @@ def _intersection_over_union(boxA, boxB):
 
 def max_score(row):
     vals=np.array(str(row).split(":"))
-    vals=vals.astype(np.float)
+    vals=vals.astype(float)
     return vals.max()
 
-def calculateStats(truth, detections, keep_threshold, recall_by_species):
+def calculateStats(truth, detections, keep_threshold, recall_by_species,
+                   iou_threshold=0.4):
     eval_detects = detections
     eval_detects['max_score'] = eval_detects['det_conf'].transform(max_score)
     eval_detects = eval_detects.loc[eval_detects.max_score > keep_threshold]
@@ -111,7 +112,7 @@ def calculateStats(truth, detections, keep_threshold, recall_by_species):
                 truth_box = _rowToBoxDict(truth_row)
                 canidate_box = _rowToBoxDict(row)
                 iou = _intersection_over_union(truth_box, canidate_box)
-                if iou > args.iou_threshold:
+                if iou > iou_threshold:
                     got_match = True
                     if truth_row.name in matches:
                         double_counts += 1
@@ -159,7 +160,7 @@ def calculateStats(truth, detections, keep_threshold, recall_by_species):
                         truth_box = _rowToBoxDict(truth_row)
                         for _,det_row in boxes_in_detection.iterrows():
                             det_box = _rowToBoxDict(det_row)
-                            if _intersection_over_union(truth_box, det_box) > args.iou_threshold:
+                            if _intersection_over_union(truth_box, det_box) > iou_threshold:
                                 match_found = True
                                 break
                         if match_found is False:
@@ -188,7 +189,7 @@ def calculateStats(truth, detections, keep_threshold, recall_by_species):
                     truth_box = _rowToBoxDict(truth_row)
                     for _,det_row in boxes_in_detection.iterrows():
                         det_box = _rowToBoxDict(det_row)
-                        if _intersection_over_union(truth_box, det_box) > args.iou_threshold:
+                        if _intersection_over_union(truth_box, det_box) > iou_threshold:
                             match_found = True
                             break
                     if match_found is False:
@@ -236,7 +237,7 @@ if __name__=="__main__":
                                   args.keep_threshold_steps)
     bar = progressbar.ProgressBar(redirect_stdout=True)
     for keep_threshold in bar(keep_thresholds):
-        threshold_results, confusion_matrix = calculateStats(truth, detections, keep_threshold, args.recall_by_species)
+        threshold_results, confusion_matrix = calculateStats(truth, detections, keep_threshold, args.recall_by_species, args.iou_threshold)
         for species in threshold_results:
             if species not in results:
                 results[species] = []
@@ -18,6 +18,12 @@ The input csv work file can be in a couple of flavors.
   of <vid_id>/<frame:04d>.<img-ext>.
 - The video format which can be any CSV file where the first column is a path to a video file
 
+In video mode the detector can skip frames (`--detect-every`, optionally
+detecting sooner on motion or a scene change). Boxes for skipped frames are
+interpolated between the detected frames and marked in an `interpolated`
+column of the output. With `--truth` the output is scored with
+`detection_metrics.py` alongside the throughput achieved.
+
 """
 
 import argparse
@@ -25,6 +31,7 @@ from multiprocessing import Process,Queue
 import threading
 import pandas as pd
 from openem.Detect import Detection, RetinaNet
+from openem.Detect.temporal import FrameSkipper, interpolateDetections
 from tqdm import tqdm
 import cv2
 import os
@@ -46,7 +53,56 @@ def process_batch_result(args, image_count, result_queue):
         print("Result Queue Stuffed")
         result_queue.put(results)
 
-def process_retinanet_result(args, network_results):
+network_frames = 0
+
+def frame_skipping(args):
+    return args.detect_every > 1 or \
+           args.motion_threshold is not None or \
+           args.scene_threshold is not None
+
+def detection_record(video_id, frame, result, interpolated=False):
+    """ Returns an output CSV row for a detection """
+    confidence_array=np.array(result.confidence)
+    conf_as_string = confidence_array.astype(str)
+    confidence_formatted = ':'.join(list(conf_as_string))
+    record = {'video_id': video_id,
+              'frame': frame,
+              'x': result.location[0],
+              'y': result.location[1],
+              'w': result.location[2],
+              'h': result.location[3],
+              'det_species': result.species,
+              'det_conf': confidence_formatted}
+    if frame_skipping(args):
+        record['interpolated'] = interpolated
+    return record
+
+def process_interpolated_results(args, keyframes):
+    """ Write interpolated detections between each pair of detected
+        frames of a video
+
+    keyframes: dictionary of frame number to (video_id, detections)
+    """
+    data = []
+    frames = sorted(keyframes.keys())
+    for start, end in zip(frames[:-1], frames[1:]):
+        video_id, start_detections = keyframes[start]
+        _, end_detections = keyframes[end]
+        interpolated = interpolateDetections(start,
+                                             start_detections,
+                                             end,
+                                             end_detections)
+        for offset, frame_results in enumerate(interpolated):
+            for result in frame_results:
+                data.append(detection_record(video_id,
+                                             start + offset + 1,
+                                             result,
+                                             interpolated=True))
+    new_df = pd.DataFrame(columns=result_cols,
+                          data=data)
+    new_df.to_csv(args.output_csv, mode='a', header=False,index=False)
+
+def process_retinanet_result(args, network_results, keyframes=None):
     raw_results=network_results[0]
     cookies = network_results[1]
     sizes=[cookie["size"] for cookie in cookies]
@@ -57,23 +113,16 @@ def process_retinanet_result(args, network_results):
                                      threshold=args.keep_threshold)
     data = []
     for batch_idx,batch_result in enumerate(results):
+        video_id, frame = batch_info[batch_idx]
+        kept = []
         for result in batch_result:
-            confidence_array=np.array(result.confidence)
-            confidence = np.max(confidence_array)
+            confidence = np.max(np.array(result.confidence))
             if confidence < args.keep_threshold:
                 continue
-
-            conf_as_string = confidence_array.astype(np.str)
-            confidence_formatted = ':'.join(list(conf_as_string))
-            new_record = {'video_id': batch_info[batch_idx][0],
-                          'frame': batch_info[batch_idx][1],
-                          'x': result.location[0],
-                          'y': result.location[1],
-                          'w': result.location[2],
-                          'h': result.location[3],
-                          'det_species': result.species,
-                          'det_conf': confidence_formatted}
-            data.append(new_record)
+            kept.append(result)
+            data.append(detection_record(video_id, frame, result))
+        if keyframes is not None:
+            keyframes[frame] = (video_id, kept)
     new_df = pd.DataFrame(columns=result_cols,
                           data=data)
     new_df.to_csv(args.output_csv, mode='a', header=False,index=False)
@@ -97,6 +146,11 @@ def process_frame(image, preprocess_funcs, cookie, queue):
                 current_frames-=args.batch_size
 
 def process_video(video_q, preprocess_funcs, queue):
+    skipper = None
+    if frame_skipping(args):
+        skipper = FrameSkipper(interval=args.detect_every,
+                               motion_threshold=args.motion_threshold,
+                               scene_threshold=args.scene_threshold)
     video_tuple = video_q.get()
     while video_tuple != None:
         video_path, video_id = video_tuple
@@ -106,8 +160,16 @@ def process_video(video_q, preprocess_funcs, queue):
         frame_num = 0
         threads = []
         ok = True
+        if skipper:
+            skipper.reset()
         while ok:
             ok, image_data = video_reader.read()
+            if ok and skipper and \
+               not skipper.shouldDetect(frame_num,
+                                        image_data,
+                                        last=frame_num == vid_len - 1):
+                frame_num += 1
+                continue
             if ok:
                 for idx,thread in enumerate(threads):
                     if thread.is_alive() == False:
@@ -147,11 +209,13 @@ def process_image_data(image_data, preprocess_funcs):
     return image_data
 
 def image_consumer(q, result_q,vid_len):
+    global network_frames
     with tqdm(total=vid_len, desc="Frames", leave=True) as bar:
         batch_result = q.get()
         print(f"Initial batch size = {batch_result}")
         while batch_result is not None:
             process_batch_result(args, batch_result, result_q)
+            network_frames += batch_result
             bar.update(batch_result)
             try:
                 batch_result = q.get_nowait()
@@ -177,13 +241,16 @@ def result_consumer_v2(name_q,result_q):
     name = name_q.get()
     while name is not None:
         print(f"Results for {name}")
+        keyframes = {} if frame_skipping(args) else None
         result = result_q.get()
         while result is not None:
-            process_retinanet_result(args, result)
+            process_retinanet_result(args, result, keyframes)
             try:
                 result = result_q.get_nowait()
             except:
                 result = result_q.get()
+        if keyframes:
+            process_interpolated_results(args, keyframes)
         name = name_q.get()
     print("Exiting results")
     
@@ -230,6 +297,25 @@ if __name__=="__main__":
                         help="Module name that contains preprocessing function(s) to call on the image prior to insertion into the network")
     parser.add_argument("--cpu-only",
                         action="store_true")
+    parser.add_argument("--uint8-input",
+                        action="store_true",
+                        help="Feed uint8 frames and subtract the mean in the graph")
+    parser.add_argument("--detect-every",
+                        type=int,
+                        default=1,
+                        help="Video only: run the detector every N frames and interpolate between")
+    parser.add_argument("--motion-threshold",
+                        type=float,
+                        help="Video only: also detect when the mean grey level change since the last detected frame exceeds this (0-255)")
+    parser.add_argument("--scene-threshold",
+                        type=float,
+                        help="Video only: also detect when the histogram correlation with the last detected frame drops below this")
+    parser.add_argument("--truth",
+                        help="Truth CSV; if given, report accuracy of the output with detection_metrics.py")
+    parser.add_argument("--iou-threshold",
+                        type=float,
+                        default=0.4,
+                        help="IoU threshold for a true positive in the accuracy report")
     parser.add_argument("work_csv", help="CSV with file per row")
     args = parser.parse_args()
 
@@ -259,7 +345,8 @@ if __name__=="__main__":
     retinanet = RetinaNet.RetinaNetDetector(args.graph_pb,
                                             imageShape=image_dims,
                                             batch_size=args.batch_size,
-                                            cpu_only=args.cpu_only)
+                                            cpu_only=args.cpu_only,
+                                            uint8_input=args.uint8_input)
 
 
     preprocess_funcs=[]
@@ -276,6 +363,8 @@ if __name__=="__main__":
     image_cnt = 0
     # OpenEM result columns
     result_cols=['video_id', 'frame', 'x','y','w','h', 'det_conf', 'det_species']
+    if frame_skipping(args):
+        result_cols.append('interpolated')
     results_df=pd.DataFrame(columns=result_cols)
     results_df.to_csv(args.output_csv, index=False)
     print(f"Outputing results to {args.output_csv}")
@@ -285,6 +374,8 @@ if __name__=="__main__":
     name_queue=Queue(maxsize=2)
     name_res_queue=Queue(maxsize=2)
     media_files = work_df[0].unique()
+    start_time = time.time()
+    total_frames = 0
     if args.csv_flavor != "video":
         # We are iterating over images
         def image_reader(b_queue):
@@ -313,6 +404,7 @@ if __name__=="__main__":
 
         # Run the Tensorflow stuff in the main thread
         image_consumer(batch_queue, result_queue, len(media_files))
+        total_frames = len(media_files)
 
         reader_thread.join()
         results_thread.join()
@@ -342,6 +434,7 @@ if __name__=="__main__":
             video_path=image_path
             video_reader = cv2.VideoCapture(video_path)
             vid_len = int(video_reader.get(cv2.CAP_PROP_FRAME_COUNT))
+            total_frames += vid_len
             del video_reader
 
             name_queue.put((video_path,video_id))
@@ -356,3 +449,24 @@ if __name__=="__main__":
         print("Joining reader thread")
         results_thread.join()
         print("Joining results thread")
+
+    elapsed = time.time() - start_time
+    print(f"{network_frames} of {total_frames} frames run through the "
+          f"network in {elapsed:.1f}s; {total_frames / elapsed:.1f} fps "
+          f"effective")
+    if args.truth:
+        from detection_metrics import calculateStats
+        detections = pd.read_csv(args.output_csv)
+        truth = pd.read_csv(args.truth)
+        threshold_results, _ = calculateStats(truth,
+                                              detections,
+                                              args.keep_threshold,
+                                              False,
+                                              args.iou_threshold)
+        precision, recall, double_count = threshold_results[None]
+        print(f"Precision = {precision:.3f}; Recall = {recall:.3f}; "
+              f"Double count = {double_count:.3f}")
+        if frame_skipping(args):
+            interpolated = detections.interpolated.sum()
+            print(f"{interpolated} of {len(detections)} detections "
+                  f"interpolated")
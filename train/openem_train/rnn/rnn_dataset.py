@@ -21,6 +21,7 @@ import random
 from sklearn.model_selection import train_test_split
 import pandas as pd
 import numpy as np
+from openem.Count import sequenceFeatures
 
 class RNNDataset:
     """Class for interfacing with RNN training data.
@@ -84,14 +85,24 @@ class RNNDataset:
                 on='frame',
                 how='left'
             )
-            ds_combined.x /= self.config.detect_width()
-            ds_combined.y /= self.config.detect_height()
-            ds_combined.w /= self.config.detect_width()
-            ds_combined.h /= self.config.detect_height()
             all_frames = pd.DataFrame({'frame': list(range(nb_frames))})
-            ds_combined = all_frames.merge(ds_combined, on='frame', how='left').fillna(0.0)
+            ds_combined = all_frames.merge(ds_combined, on='frame', how='left')
+            # Frames are only featured if they have both a classification
+            # and a detection, as at inference
+            present = ds_combined.x.notna().to_numpy()
+            ds_combined = ds_combined.fillna(0.0)
             ds_combined['species__'] = 1.0 - sum([ds_combined[scol] for scol in species_cols])
-            video_data[video_id] = ds_combined.as_matrix(columns=columns)
+            ds_present = ds_combined[present]
+            video_data[video_id] = sequenceFeatures(
+                present,
+                ds_present[['species__'] + species_cols].to_numpy(),
+                ds_present[['no_fish', 'covered', 'clear']].to_numpy(),
+                ds_present[['x', 'y', 'w', 'h']].to_numpy(),
+                ds_present['det_conf'].to_numpy(),
+                ds_present['det_species'].to_numpy(),
+                self.config.detect_width(),
+                self.config.detect_height(),
+                self.config.count_num_features())
 
             all_frames = pd.DataFrame({'frame': list(range(nb_frames))})
             gt_combined = all_frames.merge(
@@ -124,6 +135,9 @@ class RNNDataset:
         res_stop = nb_steps - self.config.count_num_steps_crop() + steps_after
         vid_start = offset - steps_before
         vid_stop = offset + nb_res_steps + steps_after
+        # Steps before the start of the video are flagged as having no
+        # species, as at inference
+        res[:res_start, 0] = 1.0
         res[res_start:res_stop, :] = self.video_data[video_id][vid_start:vid_stop, :]
         return res
 